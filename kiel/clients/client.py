@@ -3,8 +3,11 @@ import logging
 import six
 from tornado import gen, iostream
 
-from kiel.exc import BrokerConnectionError, UnhandledResponseError
+from kiel.exc import (
+    BrokerConnectionError, RequestTimeoutError, UnhandledResponseError
+)
 from kiel.cluster import Cluster
+from kiel.pool import LEAST_LOADED
 
 
 log = logging.getLogger(__name__)
@@ -15,11 +18,28 @@ class Client(object):
     Base class for all client classes.
 
     Handles basic cluster management and request sending.
+
+    The optional ``connection_options`` are handed to the underlying
+    ``Cluster`` and used for each of its broker connections, as are the
+    ``pool_size`` and ``pool_policy`` of the pool of connections kept for
+    each broker, the ``control_connections`` flag and the
+    ``lazy_connections`` flag along with the ``idle_timeout`` for them.  Any
+    other ``Cluster`` options (e.g. ``connect_timeout`` or ``heal_backoff``)
+    can be given in the ``cluster_options`` dictionary.
     """
-    def __init__(self, brokers):
+    def __init__(
+            self, brokers, connection_options=None,
+            pool_size=1, pool_policy=LEAST_LOADED, control_connections=False,
+            lazy_connections=False, idle_timeout=None, cluster_options=None,
+    ):
         super(Client, self).__init__()
 
-        self.cluster = Cluster(brokers)
+        self.cluster = Cluster(
+            brokers, connection_options, pool_size, pool_policy,
+            control_connections,
+            lazy_connections=lazy_connections, idle_timeout=idle_timeout,
+            **(cluster_options or {})
+        )
 
         self.heal_cluster = False
         self.closing = False
@@ -66,22 +86,48 @@ class Client(object):
         a ``handle_<response.api>_response`` method available to handle an
         incoming response object.
 
-        If an error occurs in a response, the ``heal_cluster`` flag is set
-        and the ``heal()`` method on the cluster is called after processing
-        each response.
+        If an error occurs in a response (or a request times out), the
+        ``heal_cluster`` flag is set and the ``heal()`` method on the cluster
+        is called after processing each response.  Timed out requests are
+        handed to the subclass's ``handle_<request.api>_timeout`` method, if
+        it has one.
 
         Responses are handled in the order they come in, but this method does
         not yield a value until all responses are handled.
+
+        Each request goes over the broker connection the cluster picks for
+        its api, see ``Cluster.connection()``.  Brokers not connected to yet
+        are connected to first, requests to brokers that can't be connected
+        to are dropped and the ``heal_cluster`` flag is set.
         """
-        iterator = gen.WaitIterator(**{
-            str(broker_id): self.cluster[broker_id].send(request)
-            for broker_id, request in six.iteritems(request_by_broker)
-        })
+        yield self.cluster.ensure_connections(list(request_by_broker))
+
+        to_send = {}
+        for broker_id, request in six.iteritems(request_by_broker):
+            if broker_id not in self.cluster:
+                log.info("No connection to broker %s", broker_id)
+                self.heal_cluster = True
+                continue
+            to_send[str(broker_id)] = self.cluster.connection(
+                broker_id, request.api
+            ).send(request)
+
+        iterator = gen.WaitIterator(**to_send)
 
         results = {}
         while not iterator.done():
             try:
                 response = yield iterator.next()
+            except RequestTimeoutError as e:
+                log.warn(e)
+                self.heal_cluster = True
+                request = request_by_broker[int(iterator.current_index)]
+                handler = getattr(
+                    self, "handle_%s_timeout" % request.api, None
+                )
+                if handler is not None:
+                    yield gen.maybe_future(handler(request))
+                continue
             except BrokerConnectionError as e:
                 log.info("Connection to %s:%s lost", e.host, e.port)
                 self.heal_cluster = True
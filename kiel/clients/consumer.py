@@ -7,14 +7,22 @@ import six
 from tornado import gen
 
 from kiel.exc import NoOffsetsError
+from kiel.connection import DEFAULT_DECODE_THRESHOLD
+from kiel.pool import LEAST_LOADED
 from kiel.protocol import fetch, errors
-from kiel.constants import CONSUMER_REPLICA_ID, ERROR_CODES
+from kiel.constants import (
+    CONSUMER_REPLICA_ID, READ_UNCOMMITTED, ERROR_CODES,
+    NEW_FETCH_SESSION_ID, INITIAL_FETCH_EPOCH,
+)
 
 from .client import Client
 
 
 log = logging.getLogger(__name__)
 
+# fetch session epochs wrap around to 1 after the highest Int32 value
+MAX_FETCH_EPOCH = 2 ** 31 - 1
+
 
 class BaseConsumer(Client):
     """
@@ -22,6 +30,32 @@ class BaseConsumer(Client):
 
     Allows for customizing the ``deserialier`` used.  Default is a JSON
     deserializer.
+
+    If ``zero_copy`` is set the deserializer is handed ``memoryview`` slices
+    of the fetch response payload instead of copied and UTF-8 decoded values,
+    so it must be able to handle those.
+
+    Fetch responses of at least ``decode_threshold`` bytes are decoded and
+    decompressed in the ``decode_executor`` if one is given, see
+    ``Connection``.
+
+    Brokers that support fetch version 7 or higher are fetched from with
+    incremental fetch sessions, one `FetchSession` per broker and topic.
+
+    Given a ``DictionaryStore`` as ``dictionaries``, values compressed with
+    its zstd dictionaries (by a producer sharing the store) are decompressed
+    before being deserialized.
+
+    The ``pool_size`` and ``pool_policy`` options set up a pool of
+    connections to each broker, see ``ConnectionPool``.  Metadata, offset
+    and group membership requests get connections of their own with
+    ``control_connections``, see ``Cluster``.  With ``lazy_connections``
+    brokers are only connected to once they're needed, and connections idle
+    for ``idle_timeout`` milliseconds are closed.
+
+    Other options for each broker ``Connection`` (e.g. ``max_in_flight`` or
+    ``request_timeout``) go in the ``connection_options`` dictionary, other
+    ``Cluster`` options in ``cluster_options``.
     """
     def __init__(
             self,
@@ -30,12 +64,37 @@ class BaseConsumer(Client):
             max_wait_time=1000,  # in milliseconds
             min_bytes=1,
             max_bytes=(1024 * 1024),
+            zero_copy=False,
+            decode_executor=None,
+            decode_threshold=DEFAULT_DECODE_THRESHOLD,
+            dictionaries=None,
+            pool_size=1,
+            pool_policy=LEAST_LOADED,
+            control_connections=False,
+            lazy_connections=False,
+            idle_timeout=None,
+            connection_options=None,
+            cluster_options=None,
     ):
-        super(BaseConsumer, self).__init__(brokers)
+        connection_options = dict(connection_options or {})
+        connection_options.update({
+            "zero_copy": zero_copy,
+            "decode_executor": decode_executor,
+            "decode_threshold": decode_threshold,
+        })
+
+        super(BaseConsumer, self).__init__(
+            brokers, connection_options=connection_options,
+            pool_size=pool_size, pool_policy=pool_policy,
+            control_connections=control_connections,
+            lazy_connections=lazy_connections, idle_timeout=idle_timeout,
+            cluster_options=cluster_options,
+        )
 
         self.name = ":".join([socket.gethostname(), str(id(self))])
 
         self.deserializer = deserializer or json.loads
+        self.dictionaries = dictionaries
 
         self.max_wait_time = max_wait_time
         self.min_bytes = min_bytes
@@ -46,6 +105,9 @@ class BaseConsumer(Client):
         )
         self.synced_offsets = set()
 
+        self.fetch_sessions = {}
+        self.session_requests = {}
+
     @property
     def allocation(self):
         """
@@ -80,6 +142,9 @@ class BaseConsumer(Client):
         If a topic is unknown entirely the cluster's ``heal()`` method is
         called and the check retried.
 
+        Partitions whose leader can't be connected to are skipped for now and
+        the cluster healed.
+
         Since error codes and deserialization are taken care of by
         `handle_fetch_response` this method merely yields to wait on the
         deserialized results and returns a flattened list.
@@ -108,31 +173,164 @@ class BaseConsumer(Client):
             leader = self.cluster.get_leader(topic, partition_id)
             ordered[leader].append(partition_id)
 
+        yield self.cluster.ensure_connections(list(ordered))
+
         requests = {}
         for leader, partitions in six.iteritems(ordered):
+            if leader not in self.cluster:
+                log.warn("No connection to leader %s of %s", leader, topic)
+                self.heal_cluster = True
+                continue
             max_partition_bytes = int(self.max_bytes / len(partitions))
-            requests[leader] = fetch.FetchRequest(
-                replica_id=CONSUMER_REPLICA_ID,
-                max_wait_time=self.max_wait_time,
-                min_bytes=self.min_bytes,
-                topics=[
-                    fetch.TopicRequest(name=topic, partitions=[
-                        fetch.PartitionRequest(
-                            partition_id=partition_id,
-                            offset=self.offsets[topic][partition_id],
-                            max_bytes=max_partition_bytes,
-                        )
-                        for partition_id in partitions
-                    ])
-                ]
-            )
+            requests[leader] = self.fetch_request(leader, topic, dict(
+                (
+                    partition_id,
+                    (self.offsets[topic][partition_id], max_partition_bytes)
+                )
+                for partition_id in partitions
+            ))
+
+        try:
+            results = yield self.send(requests)
+        finally:
+            for request in requests.values():
+                session = self.session_requests.pop(
+                    request.correlation_id, None
+                )
+                if session and session.pending is not None:
+                    # no usable response came back, start over
+                    session.reset()
 
-        results = yield self.send(requests)
         raise gen.Return([
             msg for messageset in results.values() for msg in messageset
             if messageset
         ])
 
+    def fetch_request(self, leader, topic, wanted):
+        """
+        Creates a fetch request for a topic suited to the leader broker.
+
+        The ``wanted`` argument is a dictionary of partition ids to
+        (<offset>, <max bytes>) tuples.
+
+        Brokers supporting fetch version 7 and up are sent requests as part
+        of the `FetchSession` for the topic, see `session_fetch_request()`.
+
+        Versions 3 and up also limit the size of the response as a whole to
+        ``max_bytes``, and version 4 and up get v2 record batches back.
+        """
+        version = self.cluster[leader].api_version("fetch")
+        if version >= 7:
+            return self.session_fetch_request(version, leader, topic, wanted)
+
+        topics = [
+            fetch.TopicRequest(name=topic, partitions=[
+                fetch.PartitionRequest(
+                    partition_id=partition_id,
+                    offset=offset,
+                    max_bytes=max_bytes,
+                )
+                for partition_id, (offset, max_bytes) in sorted(
+                    six.iteritems(wanted)
+                )
+            ])
+        ]
+
+        if version >= 4:
+            return fetch.FetchV4Request(
+                replica_id=CONSUMER_REPLICA_ID,
+                max_wait_time=self.max_wait_time,
+                min_bytes=self.min_bytes,
+                max_bytes=self.max_bytes,
+                isolation_level=READ_UNCOMMITTED,
+                topics=topics
+            )
+        if version == 3:
+            return fetch.FetchV3Request(
+                replica_id=CONSUMER_REPLICA_ID,
+                max_wait_time=self.max_wait_time,
+                min_bytes=self.min_bytes,
+                max_bytes=self.max_bytes,
+                topics=topics
+            )
+
+        return fetch.FetchRequest(
+            replica_id=CONSUMER_REPLICA_ID,
+            max_wait_time=self.max_wait_time,
+            min_bytes=self.min_bytes,
+            topics=topics
+        )
+
+    def session_fetch_request(self, version, leader, topic, wanted):
+        """
+        Creates a v7+ fetch request within the leader's session for a topic.
+
+        The first request of a session lists every wanted partition, the
+        following ones only list partitions that are new or whose offsets
+        changed (i.e. had messages consumed) and those no longer wanted as
+        "forgotten".  Idle partitions are left out entirely.
+
+        Version 10 requests are the same, but allow for zstd compressed
+        record batches in the response and carry each partition's leader
+        epoch (always -1, i.e. unchecked).
+
+        The request's correlation id is mapped to the session so that
+        `handle_fetch_response()` can update it.
+        """
+        key = (leader, topic)
+        if key not in self.fetch_sessions:
+            self.fetch_sessions[key] = FetchSession()
+        session = self.fetch_sessions[key]
+
+        changed, forgotten = session.prepare(wanted)
+
+        request_class = fetch.FetchV7Request
+        topic_class = fetch.TopicV7Request
+        partition_class = fetch.PartitionV7Request
+        partition_options = {}
+        if version >= 10:
+            request_class = fetch.FetchV10Request
+            topic_class = fetch.TopicV9Request
+            partition_class = fetch.PartitionV9Request
+            partition_options["current_leader_epoch"] = -1
+
+        topics = []
+        if changed:
+            topics.append(
+                topic_class(name=topic, partitions=[
+                    partition_class(
+                        partition_id=partition_id,
+                        offset=offset,
+                        log_start_offset=-1,
+                        max_bytes=max_bytes,
+                        **partition_options
+                    )
+                    for partition_id, (offset, max_bytes) in sorted(
+                        six.iteritems(changed)
+                    )
+                ])
+            )
+        forgotten_topics = []
+        if forgotten:
+            forgotten_topics.append(
+                fetch.ForgottenTopic(name=topic, partitions=sorted(forgotten))
+            )
+
+        request = request_class(
+            replica_id=CONSUMER_REPLICA_ID,
+            max_wait_time=self.max_wait_time,
+            min_bytes=self.min_bytes,
+            max_bytes=self.max_bytes,
+            isolation_level=READ_UNCOMMITTED,
+            session_id=session.session_id,
+            session_epoch=session.epoch,
+            topics=topics,
+            forgotten_topics=forgotten_topics,
+        )
+        self.session_requests[request.correlation_id] = session
+
+        return request
+
     def handle_fetch_response(self, response):
         """
         Handler for responses from the message "fetch" api.
@@ -146,13 +344,29 @@ class BaseConsumer(Client):
         of range will cause the offending topic's offsets to be redetermined
         on the next call to `consume()`.
 
+        Responses to requests made within a `FetchSession` update it first,
+        a session-level error resets the session so that the next request
+        is a full one.
+
         .. note::
           This class and its subclasses assume that fetch requests are made
           on one topic at a time, so this handler only deals with the first
           topic returned.
         """
+        session = self.session_requests.pop(response.correlation_id, None)
+        if session and not session.handle_response(response):
+            log.warn(
+                "Fetch session error %s, resetting session",
+                ERROR_CODES.get(response.error_code, response.error_code)
+            )
+            return []
+
         messages = []
 
+        # incremental fetch responses leave out partitions with no data
+        if not response.topics:
+            return messages
+
         # we only fetch one topic so we can assume only one comes back
         topic = response.topics[0].name
         for partition in response.topics[0].partitions:
@@ -182,19 +396,125 @@ class BaseConsumer(Client):
 
         After each successful deserialization the ``self.offsets`` entry for
         the particular topic/partition pair is incremented.
+
+        Messages from before the offset that was fetched (which Kafka can
+        include when returning compressed message sets) are skipped without
+        being decoded.
+
+        Values compressed with one of the ``dictionaries`` are decompressed
+        first.
+
+        Since message sets are parsed and decompressed lazily, as they're
+        iterated over, errors in doing so (e.g. a corrupt batch or a missing
+        codec) surface here.  They're logged and the rest of the partition is
+        skipped, the messages gathered up to that point are still returned.
         """
-        messages = []
-        for offset, msg in partition.message_set.messages:
-            try:
-                value = self.deserializer(msg.value)
-            except Exception:
-                log.exception(
-                    "Error deserializing message: '%r'",
-                    getattr(msg, "value", "No value on msg!")
-                )
-                continue
+        fetched_offset = self.offsets[topic_name][partition.partition_id]
 
-            messages.append(value)
-            self.offsets[topic_name][partition.partition_id] = offset + 1
+        messages = []
+        try:
+            for offset, msg in partition.message_set.iterate(fetched_offset):
+                try:
+                    value = msg.value
+                    if self.dictionaries:
+                        value = self.dictionaries.decompress(value)
+                    value = self.deserializer(value)
+                except Exception:
+                    log.exception(
+                        "Error deserializing message: '%r'",
+                        getattr(msg, "value", "No value on msg!")
+                    )
+                    continue
+
+                messages.append(value)
+                self.offsets[topic_name][partition.partition_id] = offset + 1
+        except Exception:
+            log.exception(
+                "Error decoding messages for topic %s partition %s",
+                topic_name, partition.partition_id
+            )
 
         return messages
+
+
+class FetchSession(object):
+    """
+    Client-side state of an incremental fetch session with a broker.
+
+    Brokers supporting fetch version 7 and up keep track of the partitions
+    (and offsets) a client fetches, so that after an initial full request
+    the client only has to send what changed.  The ``partitions`` dictionary
+    mirrors what the broker knows: partition ids mapped to the (<offset>,
+    <max bytes>) tuple last sent for them.
+
+    The ``pending`` attribute holds the full set of wanted partitions while
+    a request is in flight, it replaces ``partitions`` once the response
+    comes back without error.
+    """
+    def __init__(self):
+        self.session_id = NEW_FETCH_SESSION_ID
+        self.epoch = INITIAL_FETCH_EPOCH
+        self.partitions = {}
+        self.pending = None
+
+    def prepare(self, wanted):
+        """
+        Determines what to send in a request for the ``wanted`` partitions.
+
+        Returns a tuple of the dictionary of partitions to send along with
+        the list of partition ids to tell the broker to forget.  Requests
+        that start a new session send all of the wanted partitions.
+        """
+        self.pending = wanted
+
+        if self.epoch == INITIAL_FETCH_EPOCH:
+            return dict(wanted), []
+
+        changed = dict(
+            (partition_id, fetch_info)
+            for partition_id, fetch_info in six.iteritems(wanted)
+            if self.partitions.get(partition_id) != fetch_info
+        )
+        forgotten = [
+            partition_id for partition_id in self.partitions
+            if partition_id not in wanted
+        ]
+
+        return changed, forgotten
+
+    def handle_response(self, response):
+        """
+        Updates the session from a response, returns ``False`` on error.
+
+        Any top-level error code (an unknown session id, an out of sync
+        epoch) resets the session.  A broker is free to not create a
+        session at all, in which case every request stays a full one.
+        """
+        if response.error_code != errors.no_error:
+            self.reset()
+            return False
+
+        if self.epoch == INITIAL_FETCH_EPOCH:
+            self.session_id = response.session_id
+
+        if self.session_id == NEW_FETCH_SESSION_ID:
+            self.reset()
+            return True
+
+        self.partitions = self.pending
+        self.pending = None
+        if self.epoch == MAX_FETCH_EPOCH:
+            self.epoch = 1
+        else:
+            self.epoch += 1
+
+        return True
+
+    def reset(self):
+        """
+        Drops the session, the next request will be a full one.
+        """
+        self.session_id = NEW_FETCH_SESSION_ID
+        self.epoch = INITIAL_FETCH_EPOCH
+        self.partitions = {}
+        self.pending = None
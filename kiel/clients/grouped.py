@@ -6,6 +6,8 @@ import six
 from tornado import gen
 
 from kiel import constants, exc
+from kiel.connection import DEFAULT_DECODE_THRESHOLD
+from kiel.pool import LEAST_LOADED
 from kiel.protocol import coordinator, offset_fetch, offset_commit, errors
 from kiel.zookeeper.allocator import PartitionAllocator
 
@@ -38,9 +40,23 @@ class GroupedConsumer(BaseConsumer):
             max_wait_time=1000,  # in milliseconds
             min_bytes=1,
             max_bytes=(1024 * 1024),
+            zero_copy=False,
+            decode_executor=None,
+            decode_threshold=DEFAULT_DECODE_THRESHOLD,
+            dictionaries=None,
+            pool_size=1,
+            pool_policy=LEAST_LOADED,
+            control_connections=False,
+            lazy_connections=False,
+            idle_timeout=None,
+            connection_options=None,
+            cluster_options=None,
     ):
         super(GroupedConsumer, self).__init__(
-            brokers, deserializer, max_wait_time, min_bytes, max_bytes
+            brokers, deserializer, max_wait_time, min_bytes, max_bytes,
+            zero_copy, decode_executor, decode_threshold, dictionaries,
+            pool_size, pool_policy, control_connections, lazy_connections,
+            idle_timeout, connection_options, cluster_options
         )
 
         self.group_name = group
@@ -107,12 +123,12 @@ class GroupedConsumer(BaseConsumer):
         request = coordinator.GroupCoordinatorRequest(group=self.group_name)
         determined = False
         while not determined:
-            broker_ids = list(self.cluster)
+            broker_ids = list(self.cluster.brokers)
             if not broker_ids:
                 raise exc.NoBrokersError
             for broker_id in broker_ids:
                 results = yield self.send({broker_id: request})
-                determined = results[broker_id]
+                determined = results.get(broker_id)
                 if determined:
                     break
 
@@ -4,17 +4,36 @@ import json
 import random
 
 import six
-from tornado import gen
+from tornado import gen, concurrent
 
-from kiel.protocol import produce as produce_api, messages, errors
-from kiel.constants import SUPPORTED_COMPRESSION, ERROR_CODES
+from kiel.protocol import produce as produce_api, messages, records, errors
+from kiel.constants import SUPPORTED_COMPRESSION, ERROR_CODES, GZIP, ZSTD
 from kiel.iterables import drain
+from kiel.pool import LEAST_LOADED
+from kiel.protocol.buffers import WriteBuffer
 
 from .client import Client
 
 
 log = logging.getLogger(__name__)
 
+#: The message format (magic byte value) sent with each produce api version
+PRODUCE_MAGIC = {
+    0: 0,
+    1: 0,
+    2: 1,
+    3: messages.BATCH_MAGIC,
+    7: messages.BATCH_MAGIC,
+}
+#: The lowest produce api version brokers accept zstd compression with
+ZSTD_PRODUCE_VERSION = 7
+#: The highest produce api version used without the ``crc32c`` module
+SLOW_CRC_PRODUCE_VERSION = 2
+#: Weight given to each new batch in the running compression ratios
+RATIO_WEIGHT = 0.2
+#: Batches are compressed anyway this often to re-check a poor codec's ratio
+PROBE_INTERVAL = 20
+
 
 class Producer(Client):
     """
@@ -23,6 +42,40 @@ class Producer(Client):
     Allows for customizing the ``serializer``, ``key_maker`` and
     ``partitioner`` functions.  By default a JSON serializer is used, along
     with a no-op key maker and a partitioner that chooses at random.
+
+    The ``compression_level`` is specific to the chosen ``compression``
+    codec, the default of ``None`` uses the codec's own default.
+
+    If an ``executor`` (e.g. a ``concurrent.futures`` thread or process pool)
+    is given, messages are serialized, encoded and compressed in it when
+    flushed rather than on the IOLoop, see `encode_message_set()`.  The
+    ``serializer`` must be picklable to use a process pool.
+
+    Compression can be made adaptive: batches smaller than
+    ``compression_threshold`` bytes are sent uncompressed, as are batches
+    for topics where the codec's running compression ratio (compressed size
+    over uncompressed size) is above ``max_compression_ratio``.
+
+    Given a ``DictionaryStore`` as ``dictionaries``, each serialized value is
+    compressed on its own with a zstd dictionary trained for its topic, see
+    `kiel.compression.dictionary`.  This can't be combined with an
+    ``executor``.
+
+    Record batches (produce version 3 and up) are checksummed with CRC32C,
+    which without the ``crc32c`` module is far too slow to be done for every
+    batch on the IOLoop.  Produce requests are kept at version 2 (and the
+    older message format) in that case, see `produce_version()`.
+
+    The ``pool_size`` and ``pool_policy`` options set up a pool of
+    connections to each broker, see ``ConnectionPool``.  Metadata requests
+    get connections of their own with ``control_connections``, see
+    ``Cluster``.  With ``lazy_connections`` brokers are only connected to
+    once they're needed, and connections idle for ``idle_timeout``
+    milliseconds are closed.
+
+    Options for each broker ``Connection`` (e.g. ``max_in_flight`` or
+    ``request_timeout``) go in the ``connection_options`` dictionary, other
+    ``Cluster`` options in ``cluster_options``.
     """
     def __init__(
             self,
@@ -32,10 +85,28 @@ class Producer(Client):
             partitioner=None,
             batch_size=1,
             compression=None,
+            compression_level=None,
+            compression_threshold=0,
+            max_compression_ratio=None,
             required_acks=-1,
             ack_timeout=500,  # milliseconds
+            executor=None,
+            dictionaries=None,
+            pool_size=1,
+            pool_policy=LEAST_LOADED,
+            control_connections=False,
+            lazy_connections=False,
+            idle_timeout=None,
+            connection_options=None,
+            cluster_options=None,
     ):
-        super(Producer, self).__init__(brokers)
+        super(Producer, self).__init__(
+            brokers, connection_options=connection_options,
+            pool_size=pool_size, pool_policy=pool_policy,
+            control_connections=control_connections,
+            lazy_connections=lazy_connections, idle_timeout=idle_timeout,
+            cluster_options=cluster_options,
+        )
 
         if compression not in SUPPORTED_COMPRESSION:
             raise ValueError(
@@ -43,9 +114,9 @@ class Producer(Client):
                 compression, ", ".join(map(str, SUPPORTED_COMPRESSION))
             )
         self.compression = compression
-
-        def json_serializer(message):
-            return json.dumps(message, sort_keys=True)
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold
+        self.compression_ratios = CompressionRatios(max_compression_ratio)
 
         def null_key_maker(_):
             return None
@@ -61,19 +132,37 @@ class Producer(Client):
         self.required_acks = required_acks
         self.ack_timeout = ack_timeout
 
-        # dictionary of topic -> messages
-        self.unsent = collections.defaultdict(list)
+        if executor and dictionaries:
+            raise ValueError("Dictionaries can't be used with an executor")
+
+        self.executor = executor
+        self.dictionaries = dictionaries
+
+        if not records.crc32c_available:
+            log.warn(
+                "crc32c module not installed, record batches won't be used"
+            )
+
+        # dictionary of topic -> partition -> message set builder (or list of
+        # unserialized messages when using an executor)
+        self.unsent = collections.defaultdict(dict)
         # dictionary of correlation id -> topic -> partition -> messages
         self.sent = collections.defaultdict(
             lambda: collections.defaultdict(dict)
         )
+        # future resolved once the latest flush using the executor is sent
+        self.last_flush = None
 
     @property
     def unsent_count(self):
         """
         Property representing the sum total of pending messages to be sent.
         """
-        return sum([len(unsent) for unsent in self.unsent.values()])
+        return sum([
+            len(batch)
+            for partitions in self.unsent.values()
+            for batch in partitions.values()
+        ])
 
     @gen.coroutine
     def produce(self, topic, message):
@@ -86,6 +175,16 @@ class Producer(Client):
         If the topic given is *not* known, the ``heal()`` method on the cluster
         is called and the check is performed again.
 
+        The message's partition is chosen right away and the message is
+        encoded into that partition's ``MessageSetBuilder`` in the ``unsent``
+        structure, so that flushing doesn't have to encode the whole batch.
+        The partition's leader is connected to first if need be (e.g. with
+        ``lazy_connections``), as the builder's message format depends on
+        the produce version it supports.
+        With an ``executor`` the message is left unserialized until flushed.
+        With ``dictionaries`` the serialized value is compressed (or sampled)
+        with the topic's dictionary.
+
         Depending on the ``batch_size`` attribute this call may not actually
         send any requests and merely keeps the pending messages in the
         ``unsent`` structure.
@@ -102,26 +201,63 @@ class Producer(Client):
             log.error("Unknown topic %s and not auto-created", topic)
             return
 
-        self.unsent[topic].append(
-            messages.Message(
-                magic=0,
-                attributes=0,
-                key=self.key_maker(message),
-                value=self.serializer(message)
-            )
+        value = message
+        if not self.executor:
+            value = self.serializer(message)
+        if self.dictionaries:
+            value = self.dictionaries.compress(topic, value)
+
+        msg = messages.Message(
+            magic=0, attributes=0, key=self.key_maker(message), value=value
         )
+        partition_id = self.partitioner(msg.key, self.cluster.topics[topic])
+
+        if not self.executor and partition_id not in self.unsent[topic]:
+            yield self.cluster.ensure_connections([
+                self.cluster.get_leader(topic, partition_id)
+            ])
+
+        self.queue(topic, partition_id, [msg])
 
         if not self.batch_size or self.unsent_count >= self.batch_size:
             yield self.flush()
 
-    def queue_retries(self, topic, msgs):
+    def queue(self, topic, partition_id, msgs):
+        """
+        Encodes the given messages into the ``unsent`` structure.
+
+        A builder is created for the topic and partition if there are no
+        pending messages for it yet, in the message format of the produce api
+        version supported by the partition's current leader.
+
+        When using an ``executor`` the messages are merely kept in a list.
+        """
+        partitions = self.unsent[topic]
+        if self.executor:
+            partitions.setdefault(partition_id, []).extend(msgs)
+            return
+
+        if partition_id not in partitions:
+            version = 0
+            leader = self.cluster.get_leader(topic, partition_id)
+            if leader in self.cluster:
+                version = self.produce_version(leader)
+            partitions[partition_id] = message_set_builder(
+                PRODUCE_MAGIC[version]
+            )
+
+        partitions[partition_id].extend(msgs)
+
+    def queue_retries(self, topic, partition_id, msgs):
         """
         Re-inserts the given messages into the ``unsent`` structure.
 
-        This also sets the flag to denote that a cluster "heal" is necessary.
+        Retried messages stay on the partition they were originally routed
+        to.  This also sets the flag to denote that a cluster "heal" is
+        necessary.
         """
         log.debug("Queueing %d messages for retry", len(msgs))
-        self.unsent[topic].extend(msgs)
+        self.queue(topic, partition_id, msgs)
         self.heal_cluster = True
 
     @gen.coroutine
@@ -129,65 +265,196 @@ class Producer(Client):
         """
         Transforms the ``unsent`` structure to produce requests and sends them.
 
-        The first order of business is to order the pending messages in
-        ``unsent`` based on partition leader.  If a message's partition leader
-        is not a know broker, the message is queued up to be retried and the
-        flag denoting that a cluster ``heal()`` call is needed is set.
-
-        Once the legitimate messages are ordered, instances of ProduceRequest
-        are created for each broker and sent.
+        The first order of business is to make sure the partition leaders
+        are connected to and to order the pending message sets in
+        ``unsent`` based on partition leader.  If a partition's leader is not
+        a known broker, its messages are queued up to be retried and the flag
+        denoting that a cluster ``heal()`` call is needed is set.
+
+        Once the legitimate message sets are ordered, produce requests of
+        the highest version each broker supports are created and sent.  Since
+        messages are encoded as they're produced this merely gathers the
+        ready-made sets (compressing them if need be).  Sets are only encoded
+        again if the leader changed to a broker that needs a different message
+        format.
+
+        Since zstd compression is only accepted by brokers supporting produce
+        version 7 and up, message sets for older brokers are compressed with
+        gzip (at its default level) instead.  Compression is skipped for
+        batches below the ``compression_threshold`` size and for topics the
+        codec doesn't compress well, see `CompressionRatios`.
+
+        With an ``executor`` each partition's messages are serialized and
+        encoded there, the requests are sent once all of them are done.  New
+        messages can be produced (and flushed) in the meantime, though each
+        flush's requests are only sent after the previous flush's are so
+        that partitions keep their order.  If any of that fails none of the
+        requests are sent, the messages go back into ``unsent`` and the error
+        is raised.
         """
         if not self.unsent:
             return
 
-        # leader -> topic -> partition -> message list
+        yield self.cluster.ensure_connections(set([
+            self.cluster.get_leader(topic, partition_id)
+            for topic, partitions in six.iteritems(self.unsent)
+            for partition_id in partitions
+        ]))
+
+        # leader -> topic -> partition -> message set builder (or list)
         ordered = collections.defaultdict(
-            lambda: collections.defaultdict(
-                lambda: collections.defaultdict(list)
-            )
+            lambda: collections.defaultdict(dict)
         )
 
-        to_retry = collections.defaultdict(list)
+        to_retry = []
 
-        for topic, msgs in drain(self.unsent):
-            for msg in msgs:
-                partition = self.partitioner(
-                    msg.key, self.cluster.topics[topic]
-                )
-                leader = self.cluster.get_leader(topic, partition)
+        for topic, partitions in drain(self.unsent):
+            for partition_id, batch in six.iteritems(partitions):
+                leader = self.cluster.get_leader(topic, partition_id)
                 if leader not in self.cluster:
-                    to_retry[topic].append(msg)
+                    to_retry.append(
+                        (topic, partition_id, batch_messages(batch))
+                    )
                     continue
-                ordered[leader][topic][partition].append(msg)
+                ordered[leader][topic][partition_id] = batch
 
         requests = {}
+        # list of (<topic>, <partition request>, <future encoded message set>)
+        pending = []
+        # (<topic>, <compression>) -> whether compressing is worthwhile, the
+        # ratios are consulted once per flush however many leaders there are
+        worthwhile = {}
         for leader, topics in six.iteritems(ordered):
-            requests[leader] = produce_api.ProduceRequest(
-                required_acks=self.required_acks,
-                timeout=self.ack_timeout,
-                topics=[]
-            )
+            version = self.produce_version(leader)
+            requests[leader] = self.produce_request(version)
+            compression, level = self.compression, self.compression_level
+            if compression == ZSTD and version < ZSTD_PRODUCE_VERSION:
+                log.warn("Broker %s can't take zstd, using gzip", leader)
+                compression, level = GZIP, None
             for topic, partitions in six.iteritems(topics):
                 requests[leader].topics.append(
                     produce_api.TopicRequest(name=topic, partitions=[])
                 )
-                for partition_id, msgs in six.iteritems(partitions):
-                    requests[leader].topics[-1].partitions.append(
-                        produce_api.PartitionRequest(
-                            partition_id=partition_id,
-                            message_set=messages.MessageSet.compressed(
-                                self.compression, msgs
-                            )
-                        )
+                if (topic, compression) not in worthwhile:
+                    worthwhile[(topic, compression)] = (
+                        self.compression_ratios.worthwhile(topic, compression)
+                    )
+                topic_compression = compression
+                if not worthwhile[(topic, compression)]:
+                    topic_compression = None
+                for partition_id, batch in six.iteritems(partitions):
+                    partition = produce_api.PartitionRequest(
+                        partition_id=partition_id
                     )
+                    if self.executor:
+                        pending.append((topic, partition, self.executor.submit(
+                            encode_message_set,
+                            PRODUCE_MAGIC[version], batch,
+                            topic_compression, level, self.serializer,
+                            self.compression_threshold
+                        )))
+                    else:
+                        if batch.magic != PRODUCE_MAGIC[version]:
+                            msgs = batch.messages
+                            batch = message_set_builder(PRODUCE_MAGIC[version])
+                            batch.extend(msgs)
+                        partition.message_set = self.build_message_set(
+                            topic, batch, topic_compression, level
+                        )
+                    requests[leader].topics[-1].partitions.append(partition)
                     self.sent[
                         requests[leader].correlation_id
-                    ][topic][partition_id] = msgs
+                    ][topic][partition_id] = batch_messages(batch)
+
+        for topic, partition_id, msgs in to_retry:
+            self.queue_retries(topic, partition_id, msgs)
+
+        if not pending:
+            yield self.send(requests)
+            return
+
+        previous, self.last_flush = self.last_flush, concurrent.Future()
+        flushed = self.last_flush
+        try:
+            try:
+                encoded = yield [future for _, _, future in pending]
+            except Exception:
+                for request in requests.values():
+                    sent = self.sent.pop(request.correlation_id, {})
+                    for topic, partitions in six.iteritems(sent):
+                        for partition_id, msgs in six.iteritems(partitions):
+                            self.queue(topic, partition_id, msgs)
+                raise
+            for (topic, partition, _), result in zip(pending, encoded):
+                raw_set, compression, size = result
+                if compression:
+                    self.compression_ratios.record(
+                        topic, compression, size, len(raw_set)
+                    )
+                partition.message_set = messages.MessageSet(encoded=raw_set)
+
+            if previous is not None:
+                yield previous
+            yield self.send(requests)
+        finally:
+            flushed.set_result(None)
+
+    def produce_version(self, leader):
+        """
+        Returns the produce api version to use with the given leader broker.
+
+        That's the highest version both ends support, capped at
+        `SLOW_CRC_PRODUCE_VERSION` if the ``crc32c`` module isn't installed.
+        """
+        max_version = None
+        if not records.crc32c_available:
+            max_version = SLOW_CRC_PRODUCE_VERSION
+
+        return self.cluster[leader].api_version("produce", max_version)
+
+    def build_message_set(self, topic, batch, compression, level):
+        """
+        Builds the message set of a batch, compressed if it's large enough.
+
+        The size of the compressed set is recorded in the topic's running
+        compression ratio for the codec.
+        """
+        size = batch.out.size
+        if not compression or size < self.compression_threshold:
+            return batch.build()
+
+        message_set = batch.build(compression, level)
+        self.compression_ratios.record(
+            topic, compression, size, compressed_size(message_set)
+        )
+
+        return message_set
+
+    def produce_request(self, version):
+        """
+        Creates an empty produce request of the given api version.
+        """
+        if version >= 3:
+            request_class = produce_api.ProduceV3Request
+            if version >= 7:
+                request_class = produce_api.ProduceV7Request
+            return request_class(
+                transactional_id=None,
+                required_acks=self.required_acks,
+                timeout=self.ack_timeout,
+                topics=[]
+            )
 
-        for topic, msgs in six.iteritems(to_retry):
-            self.queue_retries(topic, msgs)
+        request_class = {
+            2: produce_api.ProduceV2Request,
+            1: produce_api.ProduceV1Request,
+        }.get(version, produce_api.ProduceRequest)
 
-        yield self.send(requests)
+        return request_class(
+            required_acks=self.required_acks,
+            timeout=self.ack_timeout,
+            topics=[]
+        )
 
     def handle_produce_response(self, response):
         """
@@ -213,7 +480,9 @@ class Producer(Client):
                     msgs = self.sent[response.correlation_id][topic.name].pop(
                         partition.partition_id
                     )
-                    self.queue_retries(topic.name, msgs)
+                    self.queue_retries(
+                        topic.name, partition.partition_id, msgs
+                    )
                 else:
                     log.error(
                         "Got error %s for topic %s partition %s",
@@ -222,9 +491,156 @@ class Producer(Client):
 
         self.sent.pop(response.correlation_id)
 
+    def handle_produce_timeout(self, request):
+        """
+        Handler for produce requests the broker didn't respond to in time.
+
+        There's no telling which of the messages were written, so all of them
+        are queued up to be retried, as with a retriable error code.
+        """
+        sent = self.sent.pop(request.correlation_id, {})
+        for topic, partitions in six.iteritems(sent):
+            for partition_id, msgs in six.iteritems(partitions):
+                self.queue_retries(topic, partition_id, msgs)
+
     @gen.coroutine
     def wind_down(self):
         """
         Flushes the unsent messages so that none are lost when closing down.
         """
         yield self.flush()
+
+
+class CompressionRatios(object):
+    """
+    Tracks the compression ratio each codec achieves on each topic.
+
+    Ratios are the compressed size of a batch over its uncompressed size,
+    kept as a moving average weighted towards recent batches.  A codec is
+    deemed not `worthwhile()` on a topic once its ratio is above
+    ``max_ratio``, though every so often a batch is compressed anyway so that
+    the ratio can recover if the topic's data changes.
+
+    With a ``max_ratio`` of ``None`` compression is always worthwhile.
+    """
+    def __init__(self, max_ratio=None):
+        self.max_ratio = max_ratio
+
+        # dictionary of (topic, compression) -> running ratio
+        self.ratios = {}
+        # count of batches sent uncompressed since the last probe
+        self.skipped = collections.Counter()
+
+    def worthwhile(self, topic, compression):
+        """
+        Returns ``True`` if the next batch for the topic should be compressed.
+        """
+        if not compression:
+            return False
+
+        key = (topic, compression)
+        ratio = self.ratios.get(key)
+        if self.max_ratio is None or ratio is None or ratio <= self.max_ratio:
+            return True
+
+        self.skipped[key] += 1
+        if self.skipped[key] >= PROBE_INTERVAL:
+            del self.skipped[key]
+            return True
+
+        return False
+
+    def record(self, topic, compression, size, compressed_size):
+        """
+        Updates a topic's ratio for the codec with a newly compressed batch.
+        """
+        if not size:
+            return
+
+        key = (topic, compression)
+        ratio = float(compressed_size) / size
+        if key in self.ratios:
+            ratio = (
+                RATIO_WEIGHT * ratio + (1 - RATIO_WEIGHT) * self.ratios[key]
+            )
+
+        self.ratios[key] = ratio
+
+
+def json_serializer(message):
+    """
+    Default serializer, JSON with sorted keys.
+    """
+    return json.dumps(message, sort_keys=True)
+
+
+def batch_messages(batch):
+    """
+    Returns the list of messages in an ``unsent`` builder (or list).
+    """
+    if isinstance(batch, list):
+        return batch
+
+    return batch.messages
+
+
+def compressed_size(message_set):
+    """
+    Returns the size of a built (compressed) message set's encoded data.
+
+    Record batches are encoded as a whole, whereas for older formats this is
+    the size of the wrapper message's compressed value.
+    """
+    if message_set.encoded is not None:
+        return len(message_set.encoded)
+
+    return sum([len(message.value) for _, message in message_set.messages])
+
+
+def encode_message_set(magic, msgs, compression=None, level=None,
+                       serializer=None, threshold=0):
+    """
+    Serializes and encodes messages into the bytes of a message set.
+
+    The values of the given messages are run through the ``serializer`` (if
+    any) into new messages, the originals are left as-is so they can be
+    retried.  The encoded set (minus the size prefix) in the given format is
+    compressed if it's at least ``threshold`` bytes long.
+
+    Returns a tuple of the encoded set, suitable as the ``encoded`` value of
+    a ``MessageSet``, the compression actually used and the uncompressed
+    size.
+
+    Meant to be run in an executor, and as such a module-level function.
+    """
+    builder = message_set_builder(magic)
+    for msg in msgs:
+        value = msg.value
+        if serializer:
+            value = serializer(value)
+        builder.append(
+            messages.Message(magic=0, attributes=0, key=msg.key, value=value)
+        )
+
+    size = builder.out.size
+    if size < threshold:
+        compression = None
+
+    message_set = builder.build(compression, level)
+    if message_set.encoded is not None:
+        return message_set.encoded.tobytes(), compression, size
+
+    out = WriteBuffer()
+    message_set.encode_messages(out)
+
+    return out.getvalue(), compression, size
+
+
+def message_set_builder(magic):
+    """
+    Returns an empty message set builder for the given message format.
+    """
+    if magic == messages.BATCH_MAGIC:
+        return messages.RecordBatchBuilder()
+
+    return messages.MessageSetBuilder(magic=magic)
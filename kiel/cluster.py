@@ -1,17 +1,44 @@
 import collections
+import datetime
 import logging
+import random
+import time
 
-from tornado import gen, iostream
+from tornado import gen, ioloop, iostream, locks
 
 from kiel.protocol import metadata, errors
 from kiel.constants import DEFAULT_KAFKA_PORT
 from kiel.exc import BrokerConnectionError, NoBrokersError
 
 from .connection import Connection
+from .pool import ConnectionPool, LEAST_LOADED
 
 
 log = logging.getLogger(__name__)
 
+#: Milliseconds a broker connection has to be established in
+DEFAULT_CONNECT_TIMEOUT = 5 * 1000
+#: Milliseconds between trying one bootstrap host and the next
+DEFAULT_BOOTSTRAP_STAGGER = 250
+#: Milliseconds to back off before the first metadata retry when healing
+DEFAULT_HEAL_BACKOFF = 100
+#: Upper bound on the milliseconds backed off between metadata retries
+DEFAULT_MAX_HEAL_BACKOFF = 10 * 1000
+
+#: Apis whose requests go over the control-plane connections, if enabled
+CONTROL_APIS = frozenset([
+    "metadata",
+    "offset_commit",
+    "offset_fetch",
+    "group_coordinator",
+    "join_group",
+    "sync_group",
+    "heartbeat",
+    "leave_group",
+    "describe_groups",
+    "list_groups",
+])
+
 
 class Cluster(object):
     """
@@ -22,11 +49,71 @@ class Cluster(object):
 
     Also keeps metadata information for topics, their partitions, and the
     partition leader brokers.
+
+    The optional ``connection_options`` dictionary is passed as keyword
+    arguments to each ``Connection`` created.
+
+    With a ``pool_size`` above 1 each broker gets a ``ConnectionPool`` of that
+    many connections instead, requests are spread over them according to the
+    ``pool_policy``.  The pool stands in for a single connection, so this is
+    transparent to clients.
+
+    If ``control_connections`` is set a second, separate connection is kept
+    for each broker in ``control_conns``.  The `connection()` method routes
+    requests of the `CONTROL_APIS` (metadata, offset commits, group
+    membership) to it, so that they don't queue up behind long-polling
+    fetches and large responses on the data connection.
+
+    Connections are set up concurrently and each gets ``connect_timeout``
+    milliseconds to be established (``None`` for no limit), so starting up
+    or healing takes about as long as the slowest single connection rather
+    than all of them put together.  Bootstrap hosts are raced as well, each
+    one getting a ``bootstrap_stagger`` millisecond head start on the next.
+
+    With ``lazy_connections`` set, `heal()` merely keeps track of the
+    brokers in ``brokers`` and connections are opened the first time a
+    broker is needed, see `ensure_connections()`.  Connections that have
+    had nothing in flight for ``idle_timeout`` milliseconds are closed, to
+    be reopened the next time they're needed.  Without ``lazy_connections``
+    the next `heal()` reopens them as well.
+
+    Only one `heal()` runs at a time, callers arriving while one is in
+    progress wait on it rather than starting their own.  Metadata retries
+    back off exponentially from ``heal_backoff`` milliseconds up to
+    ``max_heal_backoff``, with full jitter so that many clients don't retry
+    in lockstep.
     """
-    def __init__(self, bootstrap_hosts):
+    def __init__(
+            self, bootstrap_hosts, connection_options=None,
+            pool_size=1, pool_policy=LEAST_LOADED, control_connections=False,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            bootstrap_stagger=DEFAULT_BOOTSTRAP_STAGGER,
+            lazy_connections=False,
+            idle_timeout=None,
+            heal_backoff=DEFAULT_HEAL_BACKOFF,
+            max_heal_backoff=DEFAULT_MAX_HEAL_BACKOFF,
+    ):
         self.bootstrap_hosts = bootstrap_hosts
-
+        self.connection_options = connection_options or {}
+        self.pool_size = pool_size
+        self.pool_policy = pool_policy
+        self.control_connections = control_connections
+        self.connect_timeout = connect_timeout
+        self.bootstrap_stagger = bootstrap_stagger
+        self.lazy_connections = lazy_connections
+        self.idle_timeout = idle_timeout
+        self.heal_backoff = heal_backoff
+        self.max_heal_backoff = max_heal_backoff
+
+        # broker id -> broker metadata, for every broker in the cluster
+        self.brokers = {}
         self.conns = {}
+        self.control_conns = {}
+        # broker id -> future of the latest attempt to connect to it
+        self.connecting = {}
+        self.reaper = None
+        # future of the heal in progress, if any
+        self.healing = None
         self.topics = collections.defaultdict(list)
         self.leaders = collections.defaultdict(dict)
 
@@ -62,11 +149,29 @@ class Cluster(object):
         """
         return iter(self.conns)
 
+    def connection(self, broker_id, api):
+        """
+        Returns the connection requests of the given api go to for a broker.
+
+        That's the broker's control-plane connection for the `CONTROL_APIS`
+        if there is one and it's not closing, otherwise its regular
+        connection.
+        """
+        control_conn = self.control_conns.get(broker_id)
+        if api in CONTROL_APIS and control_conn and not control_conn.closing:
+            return control_conn
+
+        return self.conns[broker_id]
+
     def get_leader(self, topic, partition_id):
         """
         Returns the leader broker ID for a given topic/partition combo.
+
+        Partitions without an available leader are left out of the metadata
+        by `process_topics()`, for those (and unknown topics) ``None`` is
+        returned, which is never a broker in the cluster.
         """
-        return self.leaders[topic][partition_id]
+        return self.leaders.get(topic, {}).get(partition_id)
 
     @gen.coroutine
     def start(self):
@@ -74,35 +179,27 @@ class Cluster(object):
         Establishes connections to the brokers in a cluster as well as
         gathers topic/partition metadata.
 
-        Cycles through each bootstrap host and attempts to send a metadata
-        request.  Once a metadata request is successful the `heal()` method
-        is called.
+        Attempts to send a metadata request via each bootstrap host, see
+        `bootstrap()`.  The attempts overlap: each host is tried once the
+        attempt on the host before it fails, or ``bootstrap_stagger``
+        milliseconds after that attempt started, whichever comes first.  The
+        first metadata response wins, after which the `heal()` method is
+        called.
         """
         response = None
+        found = locks.Event()
 
+        attempts = []
+        previous = None
         for host in self.bootstrap_hosts:
-            if ":" in host:
-                host, port = host.split(":")
-            else:
-                port = DEFAULT_KAFKA_PORT
+            previous = self.bootstrap(host, previous, found)
+            attempts.append(previous)
 
-            conn = Connection(host, int(port))
-
-            log.info("Using bootstrap host '%s'", host)
-
-            try:
-                yield conn.connect()
-            except (iostream.StreamClosedError, BrokerConnectionError):
-                log.warn("Could not connect to bootstrap %s:%s", host, port)
-                continue
-            except Exception:
-                log.exception("Error connecting to bootstrap host '%s'", host)
-                continue
-
-            response = yield conn.send(metadata.MetadataRequest(topics=[]))
-
-            conn.close()
-            break
+        attempts = gen.WaitIterator(*attempts)
+        while not attempts.done():
+            response = yield attempts.next()
+            if response:
+                break
 
         if not response:
             raise NoBrokersError
@@ -110,18 +207,87 @@ class Cluster(object):
         log.info("Metadata gathered, setting up connections.")
         yield self.heal(response)
 
+        if self.idle_timeout and not self.reaper:
+            self.reaper = ioloop.PeriodicCallback(
+                self.reap_idle_connections, self.idle_timeout / 2.0
+            )
+            self.reaper.start()
+
+    @gen.coroutine
+    def bootstrap(self, host, previous, found):
+        """
+        Fetches metadata via a bootstrap host, returning the response.
+
+        If given, the ``previous`` host's attempt gets a ``bootstrap_stagger``
+        millisecond head start.  The attempt is called off if the ``found``
+        event is set by then (or by the time the connection is established)
+        as another host already got a response, otherwise the event is set
+        once the response is in.  Failures are logged and ``None`` is
+        returned.
+        """
+        if ":" in host:
+            host, port = host.split(":")
+        else:
+            port = DEFAULT_KAFKA_PORT
+
+        if previous is not None:
+            try:
+                yield gen.with_timeout(
+                    datetime.timedelta(milliseconds=self.bootstrap_stagger),
+                    previous
+                )
+            except gen.TimeoutError:
+                pass
+            if found.is_set():
+                return
+
+        log.info("Using bootstrap host '%s'", host)
+
+        try:
+            conn = Connection(host, int(port), **self.connection_options)
+            yield self.connect(conn)
+            if found.is_set():
+                conn.close()
+                return
+            response = yield conn.send(metadata.MetadataRequest(topics=[]))
+        except (iostream.StreamClosedError, BrokerConnectionError):
+            log.warn("Could not connect to bootstrap %s:%s", host, port)
+            return
+        except Exception:
+            log.exception("Error connecting to bootstrap host '%s'", host)
+            return
+
+        conn.close()
+        found.set()
+        raise gen.Return(response)
+
     @gen.coroutine
     def heal(self, response=None):
         """
         Syncs the state of the cluster with metadata retrieved from a broker.
 
+        Calls made while a heal is already in progress share it, waiting on
+        the same future rather than sending metadata requests of their own,
+        see `refresh()`.
+        """
+        if not self.healing or self.healing.done():
+            self.healing = self.refresh(response)
+
+        yield self.healing
+
+    @gen.coroutine
+    def refresh(self, response=None):
+        """
+        Does the actual work of `heal()`.
+
         If not response argument is given, a call to `get_metatadata()` fetches
         fresh information.
 
         As a first step this will cull any closing/aborted connections from the
-        cluster.  This is followed by repeated calls to `process_brokers()` and
+        cluster, aborting any pools with connections still open.  This is
+        followed by repeated calls to `process_brokers()` and
         `process_topics()` until both signal that there are no missing brokers
-        or topics.
+        or topics, backing off between attempts, see `backoff()`.
         """
         if not response:
             response = yield self.get_metadata()
@@ -133,30 +299,63 @@ class Cluster(object):
                     "Removing %s:%s from cluster",
                     self.conns[broker_id].host, self.conns[broker_id].port
                 )
-                self.conns.pop(broker_id)
+                self.conns.pop(broker_id).abort()
+
+        for broker_id in list(self.control_conns.keys()):
+            if self.control_conns[broker_id].closing:
+                self.control_conns.pop(broker_id)
 
         missing_conns = yield self.process_brokers(response.brokers)
         missing_topics = self.process_topics(response.topics)
+        attempt = 0
         while missing_conns or missing_topics:
+            yield self.backoff(attempt)
+            attempt += 1
             response = yield self.get_metadata(topics=list(missing_topics))
             missing_conns = yield self.process_brokers(response.brokers)
             missing_topics = self.process_topics(response.topics)
 
+    def backoff(self, attempt):
+        """
+        Returns a future resolving after the backoff for the given attempt.
+
+        The delay is picked at random between zero and ``heal_backoff``
+        doubled once per attempt, capped at ``max_heal_backoff``.
+        """
+        ceiling = min(
+            self.max_heal_backoff, self.heal_backoff * (2 ** attempt)
+        )
+        delay = random.uniform(0, ceiling)
+        log.debug("Retrying metadata in %.0fms", delay)
+
+        return gen.sleep(delay / 1000.0)
+
     @gen.coroutine
     def get_metadata(self, topics=None):
         """
         Retrieves metadata from a broker in the cluster, optionally limited
         to a set of topics.
 
-        Each connection in the cluster is tried until one works.  If no
-        connection in the cluster responds, a ``NoBrokersError`` is raised.
+        Each connection in the cluster is tried until one works, followed by
+        any known brokers not connected to.  If no broker in the cluster
+        responds, a ``NoBrokersError`` is raised.
         """
         log.debug("Gathering metadata (topics=%s)", topics)
         if topics is None:
             topics = []
 
+        broker_ids = list(self.conns)
+        broker_ids.extend([
+            broker_id for broker_id in self.brokers
+            if broker_id not in self.conns
+        ])
+
         response = None
-        for conn in self.conns.values():
+        for broker_id in broker_ids:
+            yield self.ensure_connections([broker_id])
+            if broker_id not in self.conns:
+                continue
+            conn = self.connection(broker_id, "metadata")
             try:
                 response = yield conn.send(
                     metadata.MetadataRequest(topics=topics)
@@ -179,39 +378,173 @@ class Cluster(object):
 
         Known connections that are not present in the given metadata will have
         ``abort()`` called on them.
+
+        Brokers are connected to concurrently, see `open_broker()`.
+        Control-plane connections are set up along the way if enabled.  With
+        ``lazy_connections`` the brokers are merely kept track of instead, and
+        none of them count as missing.
         """
         to_drop = set(self.conns.keys()) - set([b.broker_id for b in brokers])
 
-        missing = set()
+        self.brokers = dict((broker.broker_id, broker) for broker in brokers)
 
-        for broker in brokers:
-            if broker.broker_id in self.conns:
-                continue
+        if self.lazy_connections:
+            brokers = []
 
-            try:
-                conn = Connection(broker.host, broker.port)
-                yield conn.connect()
-                self.conns[broker.broker_id] = conn
-            except iostream.StreamClosedError:
-                log.warn(
-                    "Could not add broker %s (%s:%s)",
-                    broker.broker_id, broker.host, broker.port,
-                )
-                missing.add(broker.broker_id)
-                continue
-            except Exception:
-                log.exception(
-                    "Error adding broker %s (%s:%s)",
-                    broker.broker_id, broker.host, broker.port,
-                )
-                missing.add(broker.broker_id)
-                continue
+        yield [self.open_broker(broker) for broker in brokers]
+
+        missing = set([
+            broker.broker_id for broker in brokers
+            if broker.broker_id not in self.conns
+        ])
 
         for broker_id in to_drop:
+            if broker_id in self.control_conns:
+                self.control_conns.pop(broker_id).abort()
             self.conns[broker_id].abort()
 
         raise gen.Return(missing)
 
+    @gen.coroutine
+    def ensure_connections(self, broker_ids):
+        """
+        Connects to any of the given known brokers not connected to yet.
+
+        Brokers are connected to concurrently, see `open_broker()`.
+        Failures are logged, the broker is left out of ``self.conns``.
+        """
+        yield [
+            self.open_broker(self.brokers[broker_id])
+            for broker_id in set(broker_ids)
+            if broker_id not in self.conns and broker_id in self.brokers
+        ]
+
+    def open_broker(self, broker):
+        """
+        Returns a future for setting up the connection(s) to a broker.
+
+        Callers asking for a broker that's already being connected to (be it
+        by a heal or to send a request) wait on the same attempt rather than
+        starting one of their own, see `connect_broker()`.
+        """
+        attempt = self.connecting.get(broker.broker_id)
+        if not attempt or attempt.done():
+            attempt = self.connect_broker(broker)
+            self.connecting[broker.broker_id] = attempt
+
+        return attempt
+
+    @gen.coroutine
+    def connect_broker(self, broker):
+        """
+        Sets up the connection(s) to a broker needed for sending requests.
+        """
+        connecting = [self.add_connection(broker)]
+        if self.control_connections:
+            connecting.append(self.add_control_connection(broker))
+
+        yield connecting
+
+    def reap_idle_connections(self):
+        """
+        Closes connections that have been idle for ``idle_timeout`` or more.
+
+        Connections with requests in flight or queued up are never idle.
+        """
+        cutoff = time.time() - self.idle_timeout / 1000.0
+
+        for conns in (self.conns, self.control_conns):
+            for broker_id, conn in list(conns.items()):
+                if conn.in_flight or conn.queued or conn.last_used > cutoff:
+                    continue
+                log.info(
+                    "Closing idle connection to %s:%s", conn.host, conn.port
+                )
+                conns.pop(broker_id).close()
+
+    @gen.coroutine
+    def add_connection(self, broker):
+        """
+        Sets up the connection to a broker, if not done yet.
+
+        Failures are logged, the broker is left out of ``self.conns``.
+        """
+        if broker.broker_id in self.conns:
+            return
+
+        try:
+            conn = self.broker_connection(broker.host, broker.port)
+            yield self.connect(conn)
+            self.conns[broker.broker_id] = conn
+        except (iostream.StreamClosedError, BrokerConnectionError):
+            log.warn(
+                "Could not add broker %s (%s:%s)",
+                broker.broker_id, broker.host, broker.port,
+            )
+        except Exception:
+            log.exception(
+                "Error adding broker %s (%s:%s)",
+                broker.broker_id, broker.host, broker.port,
+            )
+
+    @gen.coroutine
+    def add_control_connection(self, broker):
+        """
+        Sets up the control-plane connection to a broker, if not done yet.
+
+        Failing to connect is merely logged, the broker's regular connection
+        is used for everything in the meantime.
+        """
+        if broker.broker_id in self.control_conns:
+            return
+
+        try:
+            conn = Connection(
+                broker.host, broker.port, **self.connection_options
+            )
+            yield self.connect(conn)
+            self.control_conns[broker.broker_id] = conn
+        except Exception:
+            log.warn(
+                "Could not add control connection to broker %s (%s:%s)",
+                broker.broker_id, broker.host, broker.port,
+            )
+
+    @gen.coroutine
+    def connect(self, conn):
+        """
+        Connects a connection (or pool), within the ``connect_timeout``.
+
+        A connection that takes too long is aborted and a
+        ``BrokerConnectionError`` is raised.
+        """
+        if self.connect_timeout is None:
+            yield conn.connect()
+            return
+
+        try:
+            yield gen.with_timeout(
+                datetime.timedelta(milliseconds=self.connect_timeout),
+                conn.connect(),
+                quiet_exceptions=(iostream.StreamClosedError,),
+            )
+        except gen.TimeoutError:
+            log.warn("Timed out connecting to %s:%s", conn.host, conn.port)
+            conn.abort()
+            raise BrokerConnectionError(conn.host, conn.port)
+
+    def broker_connection(self, host, port):
+        """
+        Returns a new connection (or pool of connections) to a broker host.
+        """
+        if self.pool_size > 1:
+            return ConnectionPool(
+                host, port, self.pool_size, self.pool_policy,
+                **self.connection_options
+            )
+
+        return Connection(host, port, **self.connection_options)
+
     def process_topics(self, response_topics):
         """
         Syncs the cluster's topic/partition metadata with a given response.
@@ -219,7 +552,8 @@ class Cluster(object):
         unknown leader IDs.
 
         Works by iterating over the topic metadatas and their partitions,
-        checking for error codes and a connection matching the leader ID.
+        checking for error codes and a connection matching the leader ID (or
+        merely a known broker with ``lazy_connections``).
 
         Once complete the ``self.topics`` and ``self.leaders`` dictonaries are
         set with the newly validated information.
@@ -229,6 +563,10 @@ class Cluster(object):
 
         missing = set()
 
+        available = self.conns
+        if self.lazy_connections:
+            available = self.brokers
+
         for topic in response_topics:
             if topic.error_code == errors.unknown_topic_or_partition:
                 log.error("Unknown topic %s", topic.name)
@@ -245,7 +583,7 @@ class Cluster(object):
                     )
                     missing.add(topic.name)
                     continue
-                if partition.leader not in self.conns:
+                if partition.leader not in available:
                     log.warn(
                         "Leader for %s|%s not in current connections.",
                         topic.name, partition.partition_id
@@ -264,6 +602,14 @@ class Cluster(object):
     def stop(self):
         """
         Simple method that calls ``close()`` on each connection.
+
+        Also stops closing idle connections, if it was doing so.
         """
+        if self.reaper:
+            self.reaper.stop()
+            self.reaper = None
+
         for conn in self.conns.values():
             conn.close()
+        for conn in self.control_conns.values():
+            conn.close()
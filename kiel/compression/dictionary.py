@@ -0,0 +1,337 @@
+from __future__ import absolute_import
+
+import collections
+import errno
+import logging
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+
+try:
+    import zstandard
+    zstd_available = True
+except ImportError:  # pragma: no cover
+    zstd_available = False
+
+import six
+
+from kiel.protocol.buffers import readable
+
+from .zstd import DEFAULT_LEVEL
+
+
+log = logging.getLogger(__name__)
+
+#: Size of trained dictionaries, in bytes
+DEFAULT_DICT_SIZE = 16 * 1024
+#: Number of messages sampled per topic before training a dictionary
+DEFAULT_SAMPLE_COUNT = 1000
+#: Milliseconds between rescans of the directory for unknown dictionaries
+DEFAULT_RESCAN_INTERVAL = 1000
+
+# every zstd frame starts with this magic number
+FRAME_MAGIC = b"\x28\xb5\x2f\xfd"
+# trained dictionaries start with this magic number, followed by their ID
+DICT_MAGIC = b"\x37\xa4\x30\xec"
+dict_header_struct = struct.Struct("<4sI")
+
+# dictionary ids below 32768 and from 2^31 up are reserved by zstd
+MIN_DICT_ID = 2 ** 15
+MAX_DICT_ID = 2 ** 31 - 1
+
+# dictionary files are named "<topic>.<version>.zdict"
+dictionary_file_re = re.compile(r"^(?P<topic>.+)\.(?P<version>\d+)\.zdict$")
+
+
+class DictionaryStore(object):
+    """
+    Directory of zstd dictionaries trained on (and used for) topic messages.
+
+    Small, repetitive messages (e.g. JSON) barely compress on their own but
+    compress well with a dictionary trained on similar messages.  Until a
+    topic has a dictionary `compress()` passes values through as-is and
+    keeps a sample of them, once ``sample_count`` values are sampled a
+    dictionary of ``dict_size`` bytes is trained and saved to ``directory``.
+
+    Dictionaries are versioned per topic, the highest version is the one
+    used for compressing while every version is kept for decompressing.
+    Compressed values are zstd frames carrying the ID of their dictionary,
+    so `decompress()` works for any version producers and consumers share
+    via the directory (e.g. a network mount).
+
+    Training takes a while, given an ``executor`` (e.g. a
+    ``concurrent.futures`` thread pool) it's done there rather than on the
+    IOLoop.  Values are passed through as-is until it's done.  Values
+    compressed with dictionaries that aren't known prompt a rescan of the
+    directory, at most once every ``rescan_interval`` milliseconds.
+
+    If ``zstandard`` is not installed a ``RuntimeError`` is raised.
+    """
+    def __init__(
+            self,
+            directory,
+            dict_size=DEFAULT_DICT_SIZE,
+            sample_count=DEFAULT_SAMPLE_COUNT,
+            level=DEFAULT_LEVEL,
+            executor=None,
+            rescan_interval=DEFAULT_RESCAN_INTERVAL,
+    ):
+        if not zstd_available:
+            raise RuntimeError("Zstd compression unavailable.")
+
+        self.directory = directory
+        self.dict_size = dict_size
+        self.sample_count = sample_count
+        self.level = level
+        self.executor = executor
+        self.rescan_interval = rescan_interval
+
+        # topic -> latest dictionary version
+        self.versions = {}
+        # topic -> compressor using the topic's latest dictionary
+        self.compressors = {}
+        # dictionary id -> decompressor
+        self.decompressors = {}
+        # topic -> list of sampled values
+        self.samples = collections.defaultdict(list)
+        # topic -> future of the dictionary data being trained in the executor
+        self.training = {}
+        # time of the latest rescan prompted by an unknown dictionary
+        self.rescanned = None
+        # names of the dictionary files loaded so far
+        self.loaded = set()
+
+        self.load()
+
+    def load(self):
+        """
+        Loads any dictionaries in the ``directory`` not already loaded.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        for filename in os.listdir(self.directory):
+            match = dictionary_file_re.match(filename)
+            if not match or filename in self.loaded:
+                continue
+
+            with open(os.path.join(self.directory, filename), "rb") as f:
+                self.add(
+                    match.group("topic"), int(match.group("version")), f.read()
+                )
+            self.loaded.add(filename)
+
+    def add(self, topic, version, data):
+        """
+        Registers the raw bytes of a version of a topic's dictionary.
+
+        The dictionary is used for compressing if it's the topic's latest.
+        """
+        dictionary = zstandard.ZstdCompressionDict(data)
+
+        self.decompressors[dictionary.dict_id()] = zstandard.ZstdDecompressor(
+            dict_data=dictionary
+        )
+        if version > self.versions.get(topic, 0):
+            self.versions[topic] = version
+            self.compressors[topic] = zstandard.ZstdCompressor(
+                level=self.level, dict_data=dictionary
+            )
+
+    def compress(self, topic, value):
+        """
+        Compresses a serialized value with the topic's latest dictionary.
+
+        If the topic has no dictionary yet the value is sampled and returned
+        as-is, a dictionary is trained once enough values are sampled.
+        """
+        data = value
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+
+        if topic in self.training and self.training[topic].done():
+            self.publish(topic, self.training.pop(topic).result())
+
+        if topic in self.compressors:
+            return self.compressors[topic].compress(data)
+        if topic in self.training:
+            return value
+
+        self.samples[topic].append(data)
+        if len(self.samples[topic]) >= self.sample_count:
+            self.train(topic)
+
+        return value
+
+    def train(self, topic):
+        """
+        Trains a new version of the topic's dictionary from sampled values.
+
+        With an ``executor`` the training is merely started, the dictionary
+        is published by the first `compress()` call after it's done.  If
+        there isn't enough sampled data to train on the samples are discarded
+        and sampling starts over.
+        """
+        samples = self.samples.pop(topic, [])
+        if self.executor:
+            self.training[topic] = self.executor.submit(
+                train_dictionary, topic, self.dict_size, samples
+            )
+            return
+
+        self.publish(topic, train_dictionary(topic, self.dict_size, samples))
+
+    def publish(self, topic, data):
+        """
+        Saves the bytes of a newly trained dictionary as the next version.
+
+        Trained dictionaries derive their IDs from the samples, similar sets
+        of samples can end up with the same ID.  Since frames are matched to
+        dictionaries by ID, each version's ID is derived from its file name
+        instead, see `dictionary_id()` and `set_dictionary_id()`.
+
+        The dictionary is written to a temporary file and hard-linked into
+        place so that other processes sharing the directory never see a
+        partial file.  Linking fails if the file already exists, so should
+        another process have published the same version first (under the
+        same ID) the newly trained dictionary is discarded and theirs loaded
+        instead.  Training failures (a ``data`` of ``None``) are ignored.
+        """
+        if data is None:
+            return
+
+        version = self.versions.get(topic, 0) + 1
+        filename = "%s.%d.zdict" % (topic, version)
+
+        data = set_dictionary_id(data, dictionary_id(filename))
+
+        path = os.path.join(self.directory, filename)
+        fd, temp_path = tempfile.mkstemp(
+            prefix=filename + ".", suffix=".tmp", dir=self.directory
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.link(temp_path, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            log.info(
+                "Dictionary version %d for %s already exists, loading it",
+                version, topic
+            )
+            self.load()
+            return
+        finally:
+            os.remove(temp_path)
+        self.loaded.add(filename)
+
+        log.info("Trained dictionary version %d for %s", version, topic)
+        self.add(topic, version, data)
+
+    def retrain(self, topic):
+        """
+        Starts sampling the topic's values for a new dictionary version.
+
+        Values are passed through uncompressed until the new version is
+        trained, the older versions are kept around for decompressing.
+        """
+        self.compressors.pop(topic, None)
+        self.samples.pop(topic, None)
+
+    def rescan(self):
+        """
+        Loads new dictionaries, unless the directory was rescanned recently.
+
+        Rescans happen at most once every ``rescan_interval`` milliseconds,
+        so that a stream of values compressed with a dictionary that's
+        nowhere to be found doesn't list the directory for each one.
+        """
+        now = time.time()
+        if self.rescanned is not None and (
+                now - self.rescanned < self.rescan_interval / 1000.0
+        ):
+            return
+
+        self.rescanned = now
+        self.load()
+
+    def decompress(self, value):
+        """
+        Decompresses a value compressed with one of the stored dictionaries.
+
+        Values that aren't zstd frames compressed with a dictionary are
+        returned as-is.  If the dictionary isn't known the directory is
+        re-scanned for new versions (see `rescan()`), failing that a
+        ``ValueError`` is raised.
+
+        Decompressed values are decoded as UTF-8 where possible, same as
+        uncompressed values are when fetched.
+        """
+        if value is None or isinstance(value, six.text_type):
+            return value
+
+        data = readable(value)
+        if bytes(data[:len(FRAME_MAGIC)]) != FRAME_MAGIC:
+            return value
+
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        if not dict_id:
+            return value
+
+        if dict_id not in self.decompressors:
+            self.rescan()
+        if dict_id not in self.decompressors:
+            raise ValueError("Unknown zstd dictionary %d" % dict_id)
+
+        value = self.decompressors[dict_id].decompressobj().decompress(data)
+
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            return value
+
+
+def train_dictionary(topic, dict_size, samples):
+    """
+    Trains a zstd dictionary for a topic, returning its bytes.
+
+    ``None`` is returned if there isn't enough sampled data to train on.
+
+    Meant to be run in an executor, and as such a module-level function.
+    """
+    try:
+        dictionary = zstandard.train_dictionary(dict_size, samples)
+    except zstandard.ZstdError:
+        log.warn("Unable to train a dictionary for topic %s", topic)
+        return None
+
+    return dictionary.as_bytes()
+
+
+def dictionary_id(filename):
+    """
+    Returns the zstd dictionary ID for a dictionary file name.
+
+    The ID is a hash of the name, mapped into the non-reserved range.
+    """
+    checksum = zlib.crc32(filename.encode("utf-8")) & 0xffffffff
+
+    return MIN_DICT_ID + checksum % (MAX_DICT_ID - MIN_DICT_ID)
+
+
+def set_dictionary_id(data, dict_id):
+    """
+    Returns the bytes of a trained dictionary with its ID replaced.
+
+    The ID follows the magic number at the start of the dictionary.  Older
+    versions of ``zstandard`` (the last ones to support python 2) can't be
+    told what ID to train a dictionary with, so it's patched in afterwards.
+    """
+    data = bytearray(data)
+    dict_header_struct.pack_into(data, 0, DICT_MAGIC, dict_id)
+
+    return bytes(data)
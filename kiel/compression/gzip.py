@@ -1,42 +1,57 @@
 from __future__ import absolute_import
 
-import gzip
+import zlib
 
-from six import BytesIO
+from kiel.protocol.buffers import readable
 
 
-def compress(data):
+#: Compression level used by default, same as zlib's (and the Java client's)
+DEFAULT_LEVEL = 6
+
+# window bits value telling zlib to write and expect gzip headers/trailers
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compress(data, level=None):
     """
-    Compresses a given bit of data via the ``gzip`` stdlib module.
+    Compresses a given bit of data into a gzip member via ``zlib``.
+
+    The data can be any bytes-like object, a ``memoryview`` of a producer's
+    buffer is fed to the compressor as-is with no intermediate copies (save
+    for on python 2, see `readable()`).  The ``level`` defaults to
+    `DEFAULT_LEVEL`.
 
     .. note::
 
       This assumes the given data is a byte string, already decoded.
     """
-    buff = BytesIO()
-
-    with gzip.GzipFile(fileobj=buff, mode='w') as fd:
-        fd.write(data)
+    if level is None:
+        level = DEFAULT_LEVEL
 
-    buff.seek(0)
-    result = buff.read()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
 
-    buff.close()
-
-    return result
+    return compressor.compress(readable(data)) + compressor.flush()
 
 
 def decompress(data):
     """
-    Decompresses given data via the ``gzip`` module.
+    Decompresses given gzip data via ``zlib``.
+
+    Multiple concatenated gzip members are decompressed one after the other,
+    same as with the ``gzip`` module.  The data can be a ``memoryview``
+    slice of a zero-copy fetch response, see `readable()`.
 
     Decoding is left as an exercise for the client code.
     """
-    buff = BytesIO(data)
-
-    with gzip.GzipFile(fileobj=buff, mode='r') as fd:
-        result = fd.read()
-
-    buff.close()
-
-    return result
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    result = decompressor.decompress(readable(data))
+    if not decompressor.unused_data:
+        return result
+
+    chunks = [result]
+    while decompressor.unused_data:
+        remaining = decompressor.unused_data
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        chunks.append(decompressor.decompress(remaining))
+
+    return b"".join(chunks)
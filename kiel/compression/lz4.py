@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+
+import struct
+
+try:
+    import lz4.frame as lz4_frame
+    lz4_available = True
+except ImportError:  # pragma: no cover
+    lz4_available = False
+
+
+# flags in the frame descriptor's first byte denoting optional fields
+CONTENT_SIZE_FLAG = 0b00001000
+DICT_ID_FLAG = 0b00000001
+
+# frames start with a 4 byte magic number, then the descriptor
+DESCRIPTOR_START = 4
+# magic number, flags, block size, content size, dictionary id and checksum
+MAX_HEADER_SIZE = DESCRIPTOR_START + 2 + 8 + 4 + 1
+
+PRIME_1 = 2654435761
+PRIME_2 = 2246822519
+PRIME_3 = 3266489917
+PRIME_4 = 668265263
+PRIME_5 = 374761393
+
+MASK_32 = 0xffffffff
+
+lanes_struct = struct.Struct("<4I")
+word_struct = struct.Struct("<I")
+
+
+def compress(data, legacy=False, level=None):
+    """
+    Compresses the given data into an LZ4 frame the way Kafka expects.
+
+    Kafka only handles frames of independent 64kb blocks with no content
+    size or checksum.  The ``level`` defaults to the ``lz4`` module's own
+    default (fast mode).  Setting ``legacy`` gives the frame the incorrect
+    header checksum expected by brokers for the v0 message format.
+
+    If ``lz4`` is not installed a ``RuntimeError`` is raised.
+    """
+    if not lz4_available:
+        raise RuntimeError("LZ4 compression unavailable.")
+
+    if level is None:
+        level = lz4_frame.COMPRESSIONLEVEL_MIN
+
+    result = lz4_frame.compress(
+        data,
+        compression_level=level,
+        block_size=lz4_frame.BLOCKSIZE_MAX64KB,
+        block_linked=False,
+        content_checksum=False,
+        store_size=False,
+    )
+    if not legacy:
+        return result
+
+    result = bytearray(result)
+    position = header_checksum_position(result)
+    result[position] = header_checksum(result[:position])
+
+    return bytes(result)
+
+
+def decompress(data):
+    """
+    Decompresses the given LZ4 frame.
+
+    Frames with the incorrect "legacy" header checksum (which covers the
+    frame's magic number as well) are accepted too.
+
+    If ``lz4`` is not installed a ``RuntimeError`` is raised.
+    """
+    if not lz4_available:
+        raise RuntimeError("LZ4 compression unavailable.")
+
+    header = bytearray(data[:MAX_HEADER_SIZE])
+    position = header_checksum_position(header)
+    expected = header_checksum(header[DESCRIPTOR_START:position])
+    if header[position] != expected:
+        data = bytearray(data)
+        data[position] = expected
+
+    return lz4_frame.decompress(data)
+
+
+def header_checksum_position(header):
+    """
+    Returns the position of the header checksum byte of an LZ4 frame.
+
+    The checksum follows the flags and block size bytes of the descriptor
+    along with whichever of the optional fields the flags denote.  The frame
+    header must be given as a ``bytearray``, so that indexing it gives ints
+    on python 2 as well.
+    """
+    flags = header[DESCRIPTOR_START]
+
+    position = DESCRIPTOR_START + 2
+    if flags & CONTENT_SIZE_FLAG:
+        position += 8
+    if flags & DICT_ID_FLAG:
+        position += 4
+
+    return position
+
+
+def header_checksum(header):
+    """
+    Returns the LZ4 frame header checksum byte for the given header bytes.
+    """
+    return (xxh32(header) >> 8) & 0xff
+
+
+def xxh32(data, seed=0):
+    """
+    Pure python xxHash32 of the given bytes, only used on frame headers.
+    """
+    data = bytearray(data)
+    length = len(data)
+    position = 0
+
+    if length >= 16:
+        lanes = [
+            (seed + PRIME_1 + PRIME_2) & MASK_32,
+            (seed + PRIME_2) & MASK_32,
+            seed,
+            (seed - PRIME_1) & MASK_32,
+        ]
+        while position + 16 <= length:
+            values = lanes_struct.unpack_from(data, position)
+            lanes = [
+                (rotate_left((lane + value * PRIME_2) & MASK_32, 13) *
+                 PRIME_1) & MASK_32
+                for lane, value in zip(lanes, values)
+            ]
+            position += 16
+        result = (
+            rotate_left(lanes[0], 1) + rotate_left(lanes[1], 7) +
+            rotate_left(lanes[2], 12) + rotate_left(lanes[3], 18)
+        )
+    else:
+        result = seed + PRIME_5
+
+    result = (result + length) & MASK_32
+
+    while position + 4 <= length:
+        value = word_struct.unpack_from(data, position)[0]
+        result = (result + value * PRIME_3) & MASK_32
+        result = (rotate_left(result, 17) * PRIME_4) & MASK_32
+        position += 4
+
+    while position < length:
+        result = (result + data[position] * PRIME_5) & MASK_32
+        result = (rotate_left(result, 11) * PRIME_1) & MASK_32
+        position += 1
+
+    result ^= result >> 15
+    result = (result * PRIME_2) & MASK_32
+    result ^= result >> 13
+    result = (result * PRIME_3) & MASK_32
+    result ^= result >> 16
+
+    return result
+
+
+def rotate_left(value, count):
+    """
+    Rotates a 32-bit unsigned integer left by ``count`` bits.
+    """
+    return ((value << count) | (value >> (32 - count))) & MASK_32
@@ -8,7 +8,13 @@ try:
 except ImportError:  # pragma: no cover
     snappy_available = False
 
-from six import BytesIO
+try:
+    # newer python-snappy versions are built on cramjam, which can compress
+    # and decompress straight into a given buffer
+    from cramjam import snappy as cramjam_snappy
+    cramjam_available = True
+except ImportError:  # pragma: no cover
+    cramjam_available = False
 
 
 DEFAULT_VERSION = 1
@@ -22,6 +28,10 @@ MAGIC_HEADER = (
 BLOCK_SIZE = 32 * 1024  # 32kb, in bytes
 
 raw_header = struct.pack("!bccccccbii", *MAGIC_HEADER)
+# the magic bytes that mark a payload as xerial framed, before the versions
+xerial_magic = raw_header[:8]
+
+block_size_struct = struct.Struct("!i")
 
 
 def compress(data):
@@ -31,55 +41,107 @@ def compress(data):
     The result is preceded with a header containing the string 'SNAPPY' and the
     default and min-compat versions (both ``1``).
 
-    The block size for the compression is hard-coded at 32kb.
+    The block size for the compression is hard-coded at 32kb.  Blocks are
+    ``memoryview`` slices of the data rather than copies, and with
+    ``cramjam`` available they are compressed straight into a single output
+    buffer sized for the worst case and trimmed afterwards.
 
     If ``python-snappy`` is not installed a ``RuntimeError`` is raised.
     """
     if not snappy_available:
         raise RuntimeError("Snappy compression unavailable.")
 
-    buff = BytesIO()
-    buff.write(raw_header)
-
-    for block_num in range(0, len(data), BLOCK_SIZE):
-        block = data[block_num:block_num + BLOCK_SIZE]
-        compressed = snappy.compress(block)
-
-        buff.write(struct.pack("!i", len(compressed)))
-        buff.write(compressed)
-
-    result = buff.getvalue()
-
-    buff.close()
-
-    return result
+    view = memoryview(data)
+    blocks = [
+        view[start:start + BLOCK_SIZE]
+        for start in range(0, len(view), BLOCK_SIZE)
+    ]
+
+    if not cramjam_available:
+        chunks = [raw_header]
+        for block in blocks:
+            compressed = snappy.compress(block)
+            chunks.append(block_size_struct.pack(len(compressed)))
+            chunks.append(compressed)
+        return b"".join(chunks)
+
+    output = bytearray(len(raw_header) + sum([
+        block_size_struct.size + cramjam_snappy.compress_raw_max_len(block)
+        for block in blocks
+    ]))
+    output[:len(raw_header)] = raw_header
+
+    output_view = memoryview(output)
+    position = len(raw_header)
+    for block in blocks:
+        size = cramjam_snappy.compress_raw_into(
+            block, output_view[position + block_size_struct.size:]
+        )
+        block_size_struct.pack_into(output, position, size)
+        position += block_size_struct.size + size
+
+    del output_view
+    del output[position:]
+
+    return output
 
 
 def decompress(data):
     """
     Decompresses the given data via the snappy algorithm.
 
+    Both xerial framed payloads (as written by `compress()` and the Java
+    client) and plain snappy payloads are handled.  The data is sliced into
+    blocks via ``memoryview`` and the total decompressed size is read from
+    the blocks up front, so the result is written into a single preallocated
+    ``bytearray``, without intermediate copies if ``cramjam`` is available.
+
     If ``python-snappy`` is not installed a ``RuntimeError`` is raised.
     """
     if not snappy_available:
         raise RuntimeError("Snappy compression unavailable.")
 
-    buff_offset = len(raw_header)  # skip the header
-    length = len(data) - len(raw_header)
-
-    output = BytesIO()
-
-    while buff_offset <= length:
-        block_size = struct.unpack_from("!i", data, buff_offset)[0]
-        buff_offset += struct.calcsize("!i")
-
-        block = struct.unpack_from("!%ds" % block_size, data, buff_offset)[0]
-        buff_offset += block_size
-
-        output.write(snappy.uncompress(block))
-
-    result = output.getvalue()
+    view = memoryview(data)
+    if view[:len(xerial_magic)].tobytes() != xerial_magic:
+        blocks = [view]
+    else:
+        blocks = []
+        offset = len(raw_header)  # skip the header
+        while offset < len(view):
+            size = block_size_struct.unpack_from(view, offset)[0]
+            offset += block_size_struct.size
+            blocks.append(view[offset:offset + size])
+            offset += size
+
+    sizes = [uncompressed_length(block) for block in blocks]
+
+    output = bytearray(sum(sizes))
+    output_view = memoryview(output)
+    position = 0
+    for block, size in zip(blocks, sizes):
+        if cramjam_available:
+            cramjam_snappy.decompress_raw_into(
+                block, output_view[position:position + size]
+            )
+        else:
+            output_view[position:position + size] = snappy.uncompress(block)
+        position += size
+
+    return output
+
+
+def uncompressed_length(block):
+    """
+    Returns the decompressed size of a raw snappy block.
 
-    output.close()
+    Snappy blocks start with their decompressed size as an unsigned varint.
+    """
+    result = 0
+    shift = 0
+    for byte in bytearray(block[:5]):
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
 
     return result
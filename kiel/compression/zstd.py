@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+
+try:
+    import zstandard
+    zstd_available = True
+except ImportError:  # pragma: no cover
+    zstd_available = False
+
+
+#: Compression level used by default, same as the zstd command line tool
+DEFAULT_LEVEL = 3
+
+
+def compress(data, level=None):
+    """
+    Compresses the given data into a single zstd frame.
+
+    The ``level`` defaults to `DEFAULT_LEVEL`.
+
+    If ``zstandard`` is not installed a ``RuntimeError`` is raised.
+    """
+    if not zstd_available:
+        raise RuntimeError("Zstd compression unavailable.")
+
+    if level is None:
+        level = DEFAULT_LEVEL
+
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress(data):
+    """
+    Decompresses the given zstd frame.
+
+    Frames written in streaming mode (as the Java client does) don't include
+    the decompressed size, so a streaming decompressor is used.
+
+    If ``zstandard`` is not installed a ``RuntimeError`` is raised.
+    """
+    if not zstd_available:
+        raise RuntimeError("Zstd compression unavailable.")
+
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
@@ -1,17 +1,30 @@
+import collections
 import contextlib
 import logging
 import socket
 import struct
 import sys
+import time
 
 from tornado import ioloop, iostream, gen, concurrent
 
-from kiel.exc import BrokerConnectionError
+from kiel.constants import API_KEYS
+from kiel.exc import BrokerConnectionError, RequestTimeoutError
 from kiel.protocol import (
-    metadata, coordinator,
+    api_versions, metadata, coordinator,
     produce, fetch,
     offset, offset_commit, offset_fetch
 )
+from kiel.protocol.buffers import WriteBuffer
+
+try:
+    from tornado.concurrent import future_set_exc_info
+except ImportError:  # pragma: no cover
+    def future_set_exc_info(future, exc_info):
+        """
+        Stand-in for the tornado 5 helper, tornado 4 futures have a method.
+        """
+        future.set_exc_info(exc_info)
 
 
 log = logging.getLogger(__name__)
@@ -20,17 +33,67 @@ log = logging.getLogger(__name__)
 size_struct = struct.Struct("!i")
 # all responses start with a 4-byte correlation ID to match with the request
 correlation_struct = struct.Struct("!i")
+# the size and correlation ID are read off the stream together
+header_struct = struct.Struct("!ii")
+
+#: Number of spare write buffers a connection holds on to for reuse
+MAX_SPARE_BUFFERS = 4
+#: Buffers that grew past this many bytes are dropped rather than reused
+MAX_SPARE_BUFFER_CAPACITY = 1024 * 1024
+#: Fetch responses this many bytes or larger are decoded in the executor
+DEFAULT_DECODE_THRESHOLD = 256 * 1024
+#: Coalesced requests are written right away once they add up to this size
+DEFAULT_COALESCE_THRESHOLD = 64 * 1024
+#: Milliseconds a broker has to respond, on top of what the request allows
+DEFAULT_REQUEST_TIMEOUT = 30 * 1000
+
+# fields of requests that tell the broker how long it may hold on to them
+request_wait_fields = {
+    "fetch": "max_wait_time",
+    "produce": "timeout",
+    "join_group": "session_timeout",
+}
 
+#: Mapping of api name to the response class for each supported api version
 response_classes = {
-    "metadata": metadata.MetadataResponse,
-    "produce": produce.ProduceResponse,
-    "fetch": fetch.FetchResponse,
-    "offset": offset.OffsetResponse,
-    "offset_commit": offset_commit.OffsetCommitResponse,
-    "offset_fetch": offset_fetch.OffsetFetchResponse,
-    "group_coordinator": coordinator.GroupCoordinatorResponse
+    "api_versions": {
+        0: api_versions.ApiVersionsResponse,
+    },
+    "metadata": {
+        0: metadata.MetadataResponse,
+    },
+    "produce": {
+        0: produce.ProduceResponse,
+        1: produce.ProduceV1Response,
+        2: produce.ProduceV2Response,
+        3: produce.ProduceV2Response,
+        7: produce.ProduceV5Response,
+    },
+    "fetch": {
+        0: fetch.FetchResponse,
+        3: fetch.FetchV3Response,
+        4: fetch.FetchV4Response,
+        7: fetch.FetchV7Response,
+        10: fetch.FetchV7Response,
+    },
+    "offset": {
+        0: offset.OffsetResponse,
+    },
+    "offset_commit": {
+        0: offset_commit.OffsetCommitResponse,
+        1: offset_commit.OffsetCommitResponse,
+        2: offset_commit.OffsetCommitResponse,
+    },
+    "offset_fetch": {
+        0: offset_fetch.OffsetFetchResponse,
+    },
+    "group_coordinator": {
+        0: coordinator.GroupCoordinatorResponse,
+    },
 }
 
+api_names = dict((key, name) for name, key in API_KEYS.items())
+
 
 class Connection(object):
     """
@@ -42,37 +105,206 @@ class Connection(object):
     The main use of this class is the `send()` method, used to send protocol
     request classes over the wire.
 
+    If the ``zero_copy`` flag is set, fetch responses are decoded straight
+    out of the received payload: the ``key`` and ``value`` of each message are
+    ``memoryview`` slices of the payload rather than (possibly UTF-8 decoded)
+    copies.
+
+    If a ``decode_executor`` (e.g. a ``concurrent.futures`` thread or process
+    pool) is given, fetch responses of at least ``decode_threshold`` bytes
+    are deserialized and fully decoded (decompression included) in it via
+    `decode_fetch_response()`, keeping the IOLoop free in the meantime.
+    Zero-copy values can't be pickled, so ``zero_copy`` only works with
+    thread pools.
+
+    Unless ``negotiate_versions`` is turned off, an ``ApiVersions`` request
+    is sent when connecting and the range of versions the broker supports
+    for each api is kept in ``api_versions``.  Clients use `api_version()`
+    to pick the request version to send.  Brokers that predate the api
+    (Kafka 0.10) drop the connection instead, in which case it is
+    re-established and every api sticks to version 0.
+
+    Requests are serialized straight into a ``WriteBuffer`` (size prefix
+    included) that is handed to the stream without further copying.  Once
+    the write completes the buffer is kept in ``spare_buffers`` for reuse by
+    later requests.
+
+    Requests sent within the same IOLoop iteration are coalesced: they're
+    serialized one after the other into the same buffer, which is written
+    to the stream in one go on the next iteration via `flush_writes()`, or
+    right away once it holds ``coalesce_threshold`` bytes.  A threshold of
+    zero writes every request as soon as it's sent.
+
+    If ``max_in_flight`` is set, at most that many requests are awaiting a
+    response at any time.  Requests sent beyond that are held (unserialized)
+    in the ``waiting`` queue until responses free up slots, so a slow broker
+    causes backpressure rather than unbounded buffering.  The current depths
+    are available as `in_flight` and `queued`.
+
+    Requests time out if no response arrives within ``request_timeout``
+    milliseconds of being sent, plus however long the request allows the
+    broker to wait (e.g. a fetch's ``max_wait_time``).  The request's
+    future fails with a ``RequestTimeoutError`` and a late response is
+    discarded.  If ``recycle_on_timeout`` is set the whole connection is
+    aborted as well, for the cluster to replace.  A ``request_timeout`` of
+    ``None`` disables timeouts.
+
+    The time of the latest request (or of connecting) is kept in
+    ``last_used``, so that idle connections can be told apart.
+
+    Responses are read with two reads per frame: the size and correlation ID
+    together, then the rest of the frame straight into a buffer via
+    ``IOStream.read_into()``.  The ``receive_buffer`` is reused for every
+    response other than fetch responses.  Those get a buffer of their own as
+    their message sets are decoded lazily from it (and zero-copy values point
+    into it).
+
     .. note::
       This is the only class where the ``correlation_id`` should be used.
       These IDs are used to correlate requests and responses over a single
       connection and are meaningless outside said connection.
     """
-    def __init__(self, host, port):
+    def __init__(
+            self, host, port,
+            zero_copy=False,
+            negotiate_versions=True,
+            decode_executor=None,
+            decode_threshold=DEFAULT_DECODE_THRESHOLD,
+            coalesce_threshold=DEFAULT_COALESCE_THRESHOLD,
+            max_in_flight=None,
+            request_timeout=DEFAULT_REQUEST_TIMEOUT,
+            recycle_on_timeout=False,
+    ):
         self.host = host
         self.port = int(port)
 
+        self.zero_copy = zero_copy
+        self.decode_executor = decode_executor
+        self.decode_threshold = decode_threshold
+        self.negotiate_versions = negotiate_versions
+        self.coalesce_threshold = coalesce_threshold
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.recycle_on_timeout = recycle_on_timeout
+
+        # dictionary of api name -> (<min version>, <max version>)
+        self.api_versions = {}
+
         self.stream = None
         self.closing = False
+        self.last_used = time.time()
 
         self.api_correlation = {}
         self.pending = {}
+        # queue of (<request>, <future>) waiting for an in-flight slot
+        self.waiting = collections.deque()
+        # dictionary of correlation id -> IOLoop timeout handle
+        self.timeouts = {}
+
+        self.spare_buffers = []
+        # buffer of requests to be written on the next flush_writes()
+        self.write_buffer = None
+        self.receive_buffer = bytearray()
 
     @gen.coroutine
     def connect(self):
         """
-        Connects to the broker host and fires the ``read_loop`` callback.
+        Connects to the broker host and negotiates api versions.
+
+        If the broker drops the connection in response to the ``ApiVersions``
+        request it's assumed to be too old to support it, so the connection
+        is re-established and no versions are recorded.  Any other failure,
+        such as the request timing out, aborts the connection and is raised.
+        """
+        yield self.open_stream()
+
+        if not self.negotiate_versions:
+            return
+
+        try:
+            response = yield self.send(api_versions.ApiVersionsRequest())
+        except iostream.StreamClosedError:
+            log.info(
+                "Broker %s:%d doesn't support api versions, using version 0",
+                self.host, self.port
+            )
+            self.stream.close()
+            yield self.open_stream()
+            return
+        except BrokerConnectionError:
+            self.abort()
+            raise
+
+        if response.error_code:
+            log.warn(
+                "Error getting api versions from %s:%d, using version 0",
+                self.host, self.port
+            )
+            return
+
+        for version_range in response.api_versions:
+            if version_range.api_key not in api_names:
+                continue
+            self.api_versions[api_names[version_range.api_key]] = (
+                version_range.min_version, version_range.max_version
+            )
+
+    @gen.coroutine
+    def open_stream(self):
+        """
+        Opens the socket to the broker host and fires the ``read_loop``
+        callback.
 
         The socket is wrapped in a tornado ``iostream.IOStream`` to take
         advantage of its handy async methods.
         """
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         self.stream = iostream.IOStream(sock)
+        self.closing = False
+        self.last_used = time.time()
 
         log.info("Connecting to broker %s:%d", self.host, self.port)
         yield self.stream.connect((self.host, self.port))
 
         ioloop.IOLoop.current().add_callback(self.read_loop)
 
+    def api_version(self, api, max_version=None):
+        """
+        Returns the highest version of an api supported on both ends.
+
+        Versions above the given ``max_version`` are passed over.  Falls back
+        to version 0 if the broker's supported versions are not known (or
+        none of them are supported here).
+        """
+        if api not in self.api_versions:
+            return 0
+
+        min_version, broker_max_version = self.api_versions[api]
+        if max_version is None or max_version > broker_max_version:
+            max_version = broker_max_version
+        versions = [
+            version for version in response_classes[api]
+            if min_version <= version <= max_version
+        ]
+        if not versions:
+            return 0
+
+        return max(versions)
+
+    @property
+    def in_flight(self):
+        """
+        Property representing the number of requests awaiting a response.
+        """
+        return len(self.pending)
+
+    @property
+    def queued(self):
+        """
+        Property representing the number of requests waiting for a slot.
+        """
+        return len(self.waiting)
+
     def close(self):
         """
         Sets the ``closing`` attribute to ``True`` and calls ``close()`` on the
@@ -86,13 +318,14 @@ class Connection(object):
         """
         helper contextmanager for handling errors during IOStream operations.
 
-        Handles the StreamClosedError case by setting the ``closing`` flag,
-        logs any unexpected exceptions with a failure message.
+        Handles the StreamClosedError case by aborting the connection (which
+        sets the ``closing`` flag and fails any pending futures) without any
+        logging, logs any unexpected exceptions with a failure message.
         """
         try:
             yield
         except iostream.StreamClosedError:
-            self.closing = True
+            self.abort()
         except Exception:
             if not self.closing:
                 log.exception(failure_message)
@@ -102,8 +335,9 @@ class Connection(object):
         """
         Sends a serialized request to the broker and returns a pending future.
 
-        If any error occurs when writing immediately or asynchronously, the
-        `abort()` method is called.
+        If ``max_in_flight`` requests are already awaiting a response, the
+        request is queued up in ``waiting`` instead and only sent once a slot
+        frees up.  Otherwise it's handed to `write_request()` right away.
 
         The retured ``Future`` is stored in the ``self.pending`` dictionary
         keyed on correlation id, so that clients can say
@@ -119,20 +353,167 @@ class Connection(object):
             f.set_exception(BrokerConnectionError(self.host, self.port))
             return f
 
-        payload = message.serialize()
-        payload = size_struct.pack(len(payload)) + payload
+        self.last_used = time.time()
+
+        if self.max_in_flight and (
+                self.waiting or len(self.pending) >= self.max_in_flight
+        ):
+            self.waiting.append((message, f))
+            return f
+
+        self.write_request(message, f)
 
-        self.api_correlation[message.correlation_id] = message.api
+        return f
+
+    def write_request(self, message, f):
+        """
+        Serializes a request for writing and registers its pending future.
+
+        The request is serialized onto the end of the ``write_buffer``, a new
+        one is started (and a `flush_writes()` call scheduled) if need be.
+        If any error occurs when writing immediately or asynchronously, the
+        `abort()` method is called.
+        """
+        out = self.write_buffer
+        if out is None:
+            if self.spare_buffers:
+                out = self.spare_buffers.pop()
+            else:
+                out = WriteBuffer()
+            self.write_buffer = out
+            if self.coalesce_threshold:
+                ioloop.IOLoop.current().add_callback(self.flush_writes)
+
+        position = out.reserve(size_struct.size)
+        try:
+            message.write(out)
+        except Exception:
+            # leave the requests coalesced so far intact
+            out.size = position
+            raise
+        size_struct.pack_into(
+            out.data, position, out.size - position - size_struct.size
+        )
+
+        self.api_correlation[message.correlation_id] = (
+            message.api, message.api_version
+        )
         self.pending[message.correlation_id] = f
 
+        if self.request_timeout is not None:
+            self.start_timeout(message)
+
+        if out.size >= self.coalesce_threshold:
+            self.flush_writes()
+
+    def start_timeout(self, message):
+        """
+        Schedules the `time_out()` call for a request that was just sent.
+        """
+        timeout = self.request_timeout
+        if message.api in request_wait_fields:
+            timeout += getattr(message, request_wait_fields[message.api]) or 0
+
+        self.timeouts[message.correlation_id] = (
+            ioloop.IOLoop.current().call_later(
+                timeout / 1000.0, self.time_out, message.correlation_id
+            )
+        )
+
+    def time_out(self, correlation_id):
+        """
+        Fails the pending future of a request the broker didn't respond to.
+
+        The request is forgotten about entirely, so that a late response is
+        discarded by `read_message()`, and its in-flight slot is freed up.
+        The connection is aborted if ``recycle_on_timeout`` is set.
+        """
+        self.timeouts.pop(correlation_id, None)
+        f = self.pending.pop(correlation_id, None)
+        if f is None:
+            return
+
+        api, _ = self.api_correlation.pop(correlation_id)
+        log.warn(
+            "Timed out waiting on %s response from %s:%s",
+            api, self.host, self.port
+        )
+        f.set_exception(RequestTimeoutError(self.host, self.port, api))
+
+        if self.recycle_on_timeout:
+            self.abort()
+        elif self.waiting:
+            self.send_waiting()
+
+    def send_waiting(self):
+        """
+        Sends requests from the ``waiting`` queue while there are free slots.
+
+        Errors serializing a waiting request are set on its future.
+        """
+        while self.waiting and len(self.pending) < self.max_in_flight:
+            message, f = self.waiting.popleft()
+            try:
+                self.write_request(message, f)
+            except Exception:
+                future_set_exc_info(f, sys.exc_info())
+
+    def flush_writes(self):
+        """
+        Writes the requests coalesced in the ``write_buffer`` to the stream.
+
+        The buffer is handed to the stream as-is and returned to the spare
+        buffers once written.
+        """
+        out = self.write_buffer
+        if out is None:
+            return
+
+        self.write_buffer = None
+        if self.closing or not out.size:
+            self.release_buffer(out)
+            return
+
         def handle_write(write_future):
+            self.release_buffer(out)
             with self.socket_error_handling("Error writing to socket."):
                 write_future.result()
 
         with self.socket_error_handling("Error writing to socket."):
-            self.stream.write(payload).add_done_callback(handle_write)
+            self.stream.write(out.view()).add_done_callback(handle_write)
 
-        return f
+    def release_buffer(self, out):
+        """
+        Returns a write buffer to ``spare_buffers`` once its write is done.
+
+        Only a handful of buffers are kept, and overly large ones (e.g. from
+        a single huge produce request) are left for garbage collection.
+        """
+        if len(self.spare_buffers) >= MAX_SPARE_BUFFERS:
+            return
+        if len(out.data) > MAX_SPARE_BUFFER_CAPACITY:
+            return
+
+        out.clear()
+        self.spare_buffers.append(out)
+
+    def receive_payload_buffer(self, size):
+        """
+        Returns the reusable ``receive_buffer``, grown to at least ``size``.
+
+        The buffer can be longer than the payload read into it, responses are
+        parsed from the start and ignore whatever follows.  Payloads larger
+        than ``MAX_SPARE_BUFFER_CAPACITY`` get a one-off buffer instead.
+        """
+        if size > MAX_SPARE_BUFFER_CAPACITY:
+            return bytearray(size)
+
+        if len(self.receive_buffer) < size:
+            self.receive_buffer = bytearray(
+                max(size, 2 * len(self.receive_buffer))
+            )
+
+        return self.receive_buffer
 
     @gen.coroutine
     def read_loop(self):
@@ -140,20 +521,41 @@ class Connection(object):
         Infinite loop that reads messages off of the socket while not closed.
 
         When a message is received its corresponding pending Future is set
-        to have the message as its result.
+        to have the message as its result, freeing up a slot for any request
+        waiting on one.  Responses to requests that timed out (even while
+        the response was being read) are skipped.
 
         This is never used directly and is fired as a separate callback on the
-        I/O loop via the `connect()` method.
+        I/O loop via the `open_stream()` method.  The loop stops if the
+        stream is replaced, e.g. when reconnecting.
         """
-        while not self.closing:
+        stream = self.stream
+        while not self.closing and self.stream is stream:
             with self.socket_error_handling("Error reading from socket."):
                 message = yield self.read_message()
-                self.pending.pop(message.correlation_id).set_result(message)
+                if message is None:
+                    continue
+                self.api_correlation.pop(message.correlation_id, None)
+                timeout = self.timeouts.pop(message.correlation_id, None)
+                if timeout:
+                    ioloop.IOLoop.current().remove_timeout(timeout)
+                f = self.pending.pop(message.correlation_id, None)
+                if f is None:
+                    log.debug(
+                        "Discarding late response %s from %s:%s",
+                        message.correlation_id, self.host, self.port
+                    )
+                    continue
+                f.set_result(message)
+                if self.waiting:
+                    self.send_waiting()
 
     def abort(self):
         """
         Aborts a connection and puts all pending futures into an error state.
 
+        Requests still waiting for an in-flight slot fail as well.
+
         If ``sys.exc_info()`` is set (i.e. this is being called in an exception
         handler) then pending futures will have that exc info set.  Otherwise
         a ``BrokerConnectionError`` is used.
@@ -165,11 +567,17 @@ class Connection(object):
 
         self.close()
         self.api_correlation.clear()
-        while self.pending:
-            _, pending = self.pending.popitem()
+        while self.timeouts:
+            _, timeout = self.timeouts.popitem()
+            ioloop.IOLoop.current().remove_timeout(timeout)
+        failed = list(self.pending.values())
+        failed.extend([f for _request, f in self.waiting])
+        self.pending.clear()
+        self.waiting.clear()
+        for pending in failed:
             exc_info = sys.exc_info()
             if any(exc_info):
-                pending.set_exc_info(sys.exc_info())
+                future_set_exc_info(pending, exc_info)
             else:
                 pending.set_exception(
                     BrokerConnectionError(self.host, self.port)
@@ -180,27 +588,91 @@ class Connection(object):
         """
         Constructs a response class instance from bytes on the stream.
 
-        Works by leveraging the ``IOStream.read_bytes()`` method.  Steps:
+        Steps:
 
-        1) first the size of the entire payload is pulled
-        2) then the correlation id so that we can match this response to the
-           corresponding pending Future
-        3) the api of the resonse is looked up via the correlation id
+        1) first the size of the entire payload and the correlation id (so
+           that we can match this response to the corresponding pending
+           Future) are read together
+        2) the api and version of the resonse is looked up via the
+           correlation id
+        3) the rest of the payload is read into a buffer, the reusable
+           ``receive_buffer`` for anything but fetch responses (see
+           `receive_payload_buffer()`)
         4) the corresponding response class's deserialize() method is used to
-           decipher the raw payload
-        """
-        raw_size = yield self.stream.read_bytes(size_struct.size)
-        size = size_struct.unpack(raw_size)[0]
+           decipher the raw payload, wrapped in a ``memoryview`` for fetch
+           responses if ``zero_copy`` is set
+
+        Large enough fetch responses are handed off to the ``decode_executor``
+        instead, if there is one.
+
+        Responses to requests that timed out are read and discarded, giving
+        ``None``.
 
-        raw_correlation = yield self.stream.read_bytes(correlation_struct.size)
-        correlation_id = correlation_struct.unpack_from(raw_correlation)[0]
+        Tornado versions before 5.0 have no ``read_into()``, in which case the
+        payload is read with ``read_bytes()`` instead.
+        """
+        raw_header = yield self.stream.read_bytes(header_struct.size)
+        size, correlation_id = header_struct.unpack(raw_header)
 
         size -= correlation_struct.size
 
-        raw_payload = yield self.stream.read_bytes(size)
-        api = self.api_correlation.pop(correlation_id)
+        if correlation_id not in self.api_correlation:
+            log.debug(
+                "Discarding late response %s from %s:%s",
+                correlation_id, self.host, self.port
+            )
+            yield self.stream.read_bytes(size)
+            raise gen.Return(None)
+
+        api, version = self.api_correlation[correlation_id]
+        response_class = response_classes[api][version]
+
+        if hasattr(self.stream, "read_into"):
+            if api == "fetch":
+                raw_payload = bytearray(size)
+            else:
+                raw_payload = self.receive_payload_buffer(size)
+            yield self.stream.read_into(memoryview(raw_payload)[:size])
+        else:
+            raw_payload = yield self.stream.read_bytes(size)
+
+        if api != "fetch":
+            response = response_class.deserialize(raw_payload)
+        elif self.decode_executor and size >= self.decode_threshold:
+            response = yield self.decode_executor.submit(
+                decode_fetch_response,
+                response_class, raw_payload, self.zero_copy
+            )
+        else:
+            if self.zero_copy:
+                raw_payload = memoryview(raw_payload)
+            response = response_class.deserialize(raw_payload)
 
-        response = response_classes[api].deserialize(raw_payload)
         response.correlation_id = correlation_id
 
         raise gen.Return(response)
+
+
+def decode_fetch_response(response_class, raw_payload, zero_copy=False):
+    """
+    Deserializes a fetch response and fully decodes its message sets.
+
+    Message sets are normally lazy, here every one of them is parsed (and
+    decompressed) up front so that no decoding is left for the IOLoop.  The
+    raw buffers are dropped afterwards so that process pools don't pickle
+    the payload back along with the decoded messages.
+
+    Meant to be run in an executor, and as such a module-level function.
+    """
+    if zero_copy:
+        raw_payload = memoryview(raw_payload)
+
+    response = response_class.deserialize(raw_payload)
+
+    for topic in response.topics:
+        for partition in topic.partitions:
+            message_set = partition.message_set
+            message_set.parsed = list(message_set.iterate())
+            message_set.raw = None
+
+    return response
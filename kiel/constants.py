@@ -4,12 +4,18 @@ DEFAULT_KAFKA_PORT = 9092
 GZIP = 1
 #: Compression flag value denoting ``snappy`` was used
 SNAPPY = 2
+#: Compression flag value denoting ``lz4`` was used
+LZ4 = 3
+#: Compression flag value denoting ``zstd`` was used, only valid for v2
+#: record batches
+ZSTD = 4
 #: This set denotes the compression schemes currently supported by Kiel
-SUPPORTED_COMPRESSION = (None, GZIP, SNAPPY)
+SUPPORTED_COMPRESSION = (None, GZIP, SNAPPY, LZ4, ZSTD)
 
 CLIENT_ID = "kiel"
 
-#: The "api version" value sent over the wire.  Currently always 0
+#: The default "api version" value sent over the wire, request classes for
+#: newer versions of an api override it.
 API_VERSION = 0
 #: Mapping of response api codes and their names
 API_KEYS = {
@@ -26,6 +32,7 @@ API_KEYS = {
     "sync_group": 14,
     "describe_groups": 15,
     "list_groups": 16,
+    "api_versions": 18,
 }
 
 
@@ -33,6 +40,16 @@ API_KEYS = {
 #: used by Kafka itself.
 CONSUMER_REPLICA_ID = -1
 
+#: Fetch isolation level that includes records from aborted or ongoing
+#: transactions, the only behavior of fetch versions before 4
+READ_UNCOMMITTED = 0
+
+#: Fetch session id used when asking for a new session, brokers also send it
+#: back when they decline to create one
+NEW_FETCH_SESSION_ID = 0
+#: Fetch session epoch denoting a full fetch request creating a new session
+INITIAL_FETCH_EPOCH = 0
+
 #: A mapping of known error codes to their string values
 ERROR_CODES = {
     0: "no_error",
@@ -67,6 +84,9 @@ ERROR_CODES = {
     29: "topic_authorization_failed",
     30: "group_authorization_failed",
     31: "cluster_authorization_failed",
+    70: "fetch_session_id_not_found",
+    71: "invalid_fetch_session_epoch",
+    76: "unsupported_compression_type",
 }
 #: Set of error codes marked "retryable" by the Kafka docs.
 RETRIABLE_CODES = set([
@@ -32,6 +32,20 @@ class BrokerConnectionError(KielError):
         return "Error connecting to %s:%s" % (self.host, self.port)
 
 
+class RequestTimeoutError(BrokerConnectionError):
+    """
+    Error raised when a broker doesn't respond to a request in time.
+    """
+    def __init__(self, host, port, api):
+        super(RequestTimeoutError, self).__init__(host, port)
+        self.api = api
+
+    def __str__(self):
+        return "Timed out waiting on %s response from %s:%s" % (
+            self.api, self.host, self.port
+        )
+
+
 class UnhandledResponseError(KielError):
     """
     Error raised when a client recieves a response but has no handler method.
@@ -0,0 +1,163 @@
+import itertools
+import logging
+
+from tornado import gen, concurrent
+
+from kiel.exc import BrokerConnectionError
+
+from .connection import Connection
+
+
+log = logging.getLogger(__name__)
+
+#: Policy that hands requests to each connection in turn
+ROUND_ROBIN = "round_robin"
+#: Policy that hands requests to the connection with the fewest outstanding
+LEAST_LOADED = "least_loaded"
+
+POLICIES = (ROUND_ROBIN, LEAST_LOADED)
+
+
+class ConnectionPool(object):
+    """
+    A fixed-size set of ``Connection`` objects to a single broker host.
+
+    Stands in for a single connection: `send()` hands each request to one of
+    the ``size`` connections, picked according to the ``policy``.  With
+    `LEAST_LOADED` (the default) that's the connection with the fewest
+    requests in flight or queued, with `ROUND_ROBIN` each connection takes a
+    turn.  Requests on different connections don't wait on one another, so
+    e.g. a large fetch response doesn't hold up a produce response.
+
+    Every connection is created with the given ``connection_options``.
+
+    The pool counts as ``closing`` as soon as any of its connections is, so
+    that the cluster replaces it as a whole.
+    """
+    def __init__(self, host, port, size, policy=LEAST_LOADED,
+                 **connection_options):
+        if policy not in POLICIES:
+            raise ValueError(
+                "Invalid pool policy %s, must be one of %s" % (
+                    policy, ", ".join(POLICIES)
+                )
+            )
+
+        self.host = host
+        self.port = int(port)
+        self.policy = policy
+
+        self.connections = [
+            Connection(host, port, **connection_options)
+            for _ in range(size)
+        ]
+        self.turns = itertools.cycle(self.connections)
+
+    @property
+    def closing(self):
+        """
+        Property denoting whether any of the connections is closing.
+        """
+        return any([conn.closing for conn in self.connections])
+
+    @property
+    def api_versions(self):
+        """
+        Property proxying the api versions negotiated by the connections.
+
+        Every connection is to the same broker, so the first one's will do.
+        """
+        return self.connections[0].api_versions
+
+    @property
+    def last_used(self):
+        """
+        Property representing the time any of the connections was last used.
+        """
+        return max([conn.last_used for conn in self.connections])
+
+    @property
+    def in_flight(self):
+        """
+        Property representing the requests awaiting a response, in total.
+        """
+        return sum([conn.in_flight for conn in self.connections])
+
+    @property
+    def queued(self):
+        """
+        Property representing the requests waiting for a slot, in total.
+        """
+        return sum([conn.queued for conn in self.connections])
+
+    @gen.coroutine
+    def connect(self):
+        """
+        Connects each connection in the pool, all at the same time.
+
+        If any of them fails the whole pool is aborted, so that the ones that
+        did connect aren't left open, and the error is raised.
+        """
+        try:
+            yield [conn.connect() for conn in self.connections]
+        except Exception:
+            self.abort()
+            raise
+
+    def api_version(self, api, max_version=None):
+        """
+        Returns the highest version of an api supported on both ends.
+        """
+        return self.connections[0].api_version(api, max_version)
+
+    def choose(self):
+        """
+        Returns the connection the next request should go to.
+
+        Closing connections are passed over, as their lack of outstanding
+        requests would otherwise draw every request to them.  Raises a
+        ``BrokerConnectionError`` if every connection is closing.
+        """
+        if self.policy == ROUND_ROBIN:
+            for _ in range(len(self.connections)):
+                turn = next(self.turns)
+                if not turn.closing:
+                    return turn
+            raise BrokerConnectionError(self.host, self.port)
+
+        usable = [conn for conn in self.connections if not conn.closing]
+        if not usable:
+            raise BrokerConnectionError(self.host, self.port)
+
+        return min(usable, key=lambda conn: conn.in_flight + conn.queued)
+
+    def send(self, message):
+        """
+        Sends a request over one of the connections, returning its future.
+
+        As with a single connection, the future fails with a
+        ``BrokerConnectionError`` if there's no connection to send it over.
+        """
+        try:
+            conn = self.choose()
+        except BrokerConnectionError as e:
+            f = concurrent.Future()
+            f.set_exception(e)
+            return f
+
+        return conn.send(message)
+
+    def close(self):
+        """
+        Closes every connection in the pool.
+        """
+        for conn in self.connections:
+            conn.close()
+
+    def abort(self):
+        """
+        Aborts every connection in the pool, failing all pending requests.
+        """
+        log.warn("Aborting connection pool to %s:%s", self.host, self.port)
+        for conn in self.connections:
+            conn.abort()
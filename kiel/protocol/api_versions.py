@@ -0,0 +1,56 @@
+from .part import Part
+from .request import Request
+from .response import Response
+from .primitives import Array, Int16
+
+
+api_name = "api_versions"
+
+__all__ = [
+    "ApiVersionsRequest",
+    "ApiVersionsResponse",
+    "ApiVersionRange",
+]
+
+
+class ApiVersionsRequest(Request):
+    """
+    ::
+
+      ApiVersionsRequest =>
+    """
+    api = "api_versions"
+
+    parts = ()
+
+
+class ApiVersionRange(Part):
+    """
+    ::
+
+      ApiVersionRange =>
+        api_key => Int16
+        min_version => Int16
+        max_version => Int16
+    """
+    parts = (
+        ("api_key", Int16),
+        ("min_version", Int16),
+        ("max_version", Int16),
+    )
+
+
+class ApiVersionsResponse(Response):
+    """
+    ::
+
+      ApiVersionsResponse =>
+        error_code => Int16
+        api_versions => [ApiVersionRange]
+    """
+    api = "api_versions"
+
+    parts = (
+        ("error_code", Int16),
+        ("api_versions", Array.of(ApiVersionRange)),
+    )
@@ -0,0 +1,106 @@
+import six
+
+
+#: Initial capacity of new write buffers, in bytes.
+DEFAULT_CAPACITY = 4 * 1024
+
+
+class WriteBuffer(object):
+    """
+    Growable ``bytearray`` that protocol parts are encoded straight into.
+
+    Encoders call `reserve()` to claim space at the end of the buffer and
+    then ``pack_into()`` the ``data`` attribute at the returned position.
+    Since the space is claimed up front, size prefixes can be reserved
+    first and back-filled once the length of what follows is known.
+
+    Only the first ``size`` bytes of ``data`` are meaningful, the rest is
+    spare capacity.  A buffer can be reused after calling `clear()`.
+    """
+    __slots__ = ("data", "size")
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.data = bytearray(capacity)
+        self.size = 0
+
+    def reserve(self, count):
+        """
+        Claims ``count`` bytes at the end of the buffer, returning the offset.
+
+        The underlying ``bytearray`` is replaced with a larger copy (at least
+        doubling in size) as needed, rather than resized in place, since a
+        ``bytearray`` can't be resized while a `view()` of it is alive.
+        """
+        position = self.size
+        self.size = end = position + count
+
+        if end > len(self.data):
+            data = bytearray(max(end, 2 * len(self.data)))
+            data[:position] = self.data[:position]
+            self.data = data
+
+        return position
+
+    def write(self, raw):
+        """
+        Appends raw bytes (or any bytes-like object) to the buffer.
+        """
+        position = self.reserve(len(raw))
+        self.data[position:self.size] = raw
+
+    def view(self):
+        """
+        Returns a ``memoryview`` of the used portion of the buffer, no copy.
+
+        The view shares memory with the buffer, so the buffer shouldn't be
+        cleared and reused until whoever was handed the view is done with it.
+        """
+        return memoryview(self.data)[:self.size]
+
+    def region(self, start, end=None):
+        """
+        Returns a no-copy view of the used portion from ``start`` to ``end``.
+
+        Unlike `view()` the result can be handed to C modules such as
+        ``zlib`` on either python version: a ``memoryview`` on python 3, an
+        old-style ``buffer`` on python 2 (where ``zlib`` rejects memoryviews).
+        """
+        if end is None:
+            end = self.size
+
+        if six.PY3:
+            return memoryview(self.data)[start:end]
+
+        return buffer(self.data, start, end - start)  # noqa: F821
+
+    def getvalue(self):
+        """
+        Returns a copy of the used portion of the buffer as a byte string.
+        """
+        return bytes(self.data[:self.size])
+
+    def clear(self):
+        """
+        Empties the buffer for reuse, keeping its capacity.
+        """
+        self.size = 0
+
+
+def readable(data):
+    """
+    Returns bytes-like ``data`` in a form that ``zlib`` and the like accept.
+
+    Python 3 takes anything supporting the buffer protocol, so ``data`` is
+    returned as-is.  Python 2's C modules only take byte strings and old-style
+    buffers though: a ``bytearray`` is wrapped in a ``buffer`` with no copy,
+    a ``memoryview`` (which can't be) is copied via ``tobytes()``.
+    """
+    if six.PY3:
+        return data
+
+    if isinstance(data, bytearray):
+        return buffer(data)  # noqa: F821
+    if isinstance(data, memoryview):
+        return data.tobytes()
+
+    return data
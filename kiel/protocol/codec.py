@@ -0,0 +1,344 @@
+import itertools
+import struct
+
+from .primitives import (
+    Primitive, VariablePrimitive, Array, Int32, Bytes,
+    compiled_struct, to_bytes,
+)
+
+
+def is_fixed(part_class):
+    """
+    Returns ``True`` if the given part class is a fixed-width primitive.
+    """
+    return (
+        issubclass(part_class, Primitive) and
+        not issubclass(part_class, (VariablePrimitive, Array))
+    )
+
+
+def fixed_runs(parts):
+    """
+    Splits a ``parts`` tuple into runs of fixed-width and other parts.
+
+    Yields (<is fixed>, <list of (name, part class) tuples>) tuples, where
+    each fixed run can be packed or unpacked with a single struct format.
+    """
+    for fixed, run in itertools.groupby(parts, lambda p: is_fixed(p[1])):
+        yield fixed, list(run)
+
+
+def compile_encoder(parts):
+    """
+    Generates a function that writes the encoding of an object to a buffer.
+
+    The generated function takes the object to encode and an ``out``
+    `WriteBuffer`, the values of the object's attributes named in ``parts``
+    are encoded in order.  Missing attributes are treated as ``None``.
+
+    Each run of fixed-width parts becomes a single ``pack_into()`` call on a
+    precompiled struct, every other part is handed to a `field_encoder()`.
+    """
+    namespace = {}
+    lines = ["def encode(value, out):"]
+
+    for i, (fixed, run) in enumerate(fixed_runs(parts)):
+        if fixed:
+            namespace["struct_%d" % i] = run_struct(run)
+            lines.append("    position = out.reserve(%d)" % (
+                namespace["struct_%d" % i].size
+            ))
+            lines.append("    struct_%d.pack_into(out.data, position, %s)" % (
+                i, ", ".join([attribute(name) for name, _ in run])
+            ))
+            continue
+        for j, (name, part_class) in enumerate(run):
+            field = "field_%d_%d" % (i, j)
+            namespace[field] = field_encoder(part_class)
+            lines.append("    %s(%s, out)" % (field, attribute(name)))
+
+    if len(lines) == 1:
+        lines.append("    pass")
+
+    return generate("encode", lines, namespace)
+
+
+def compile_decoder(parts):
+    """
+    Generates a function that decodes ``parts`` from a buffer at an offset.
+
+    The generated function takes a buffer and an offset and returns a list of
+    decoded values (ordered the same as ``parts``) along with the new offset.
+
+    Each run of fixed-width parts becomes a single ``unpack_from()`` call on a
+    precompiled struct, every other part is handed to a `field_decoder()`.
+    """
+    namespace = {}
+    lines = ["def decode(buff, offset):"]
+    values = []
+
+    for i, (fixed, run) in enumerate(fixed_runs(parts)):
+        names = ["value_%d" % (len(values) + j) for j in range(len(run))]
+        values.extend(names)
+        if fixed:
+            namespace["struct_%d" % i] = run_struct(run)
+            lines.append("    (%s,) = struct_%d.unpack_from(buff, offset)" % (
+                ", ".join(names), i
+            ))
+            lines.append("    offset += %d" % namespace["struct_%d" % i].size)
+            continue
+        for j, (name, part_class) in enumerate(run):
+            field = "field_%d_%d" % (i, j)
+            namespace[field] = field_decoder(part_class)
+            lines.append("    %s, offset = %s(buff, offset)" % (
+                names[j], field
+            ))
+
+    lines.append("    return [%s], offset" % ", ".join(values))
+
+    return generate("decode", lines, namespace)
+
+
+def compile_constructor(part_class):
+    """
+    Generates a function that creates a ``part_class`` instance positionally.
+
+    The generated function takes a value for each of the class's parts in
+    order and sets them directly on a new instance, without going through
+    ``__init__()`` or any name validation.
+    """
+    args = ["value_%d" % i for i in range(len(part_class.part_names))]
+
+    lines = ["def construct(%s):" % ", ".join(args)]
+    lines.append("    instance = new(part_class)")
+    for name, arg in zip(part_class.part_names, args):
+        lines.append("    instance.%s = %s" % (name, arg))
+    lines.append("    return instance")
+
+    return generate(
+        "construct", lines, {"new": object.__new__, "part_class": part_class}
+    )
+
+
+def run_struct(run):
+    """
+    Returns the precompiled struct covering a run of fixed-width parts.
+    """
+    return compiled_struct("".join([part_class.fmt for _, part_class in run]))
+
+
+def attribute(name):
+    """
+    Returns the source for fetching an attribute of ``value``, or ``None``.
+    """
+    return "getattr(value, %r, None)" % name
+
+
+def generate(function_name, lines, namespace):
+    """
+    Compiles the given source lines and returns the function they define.
+
+    The ``namespace`` dictionary provides the globals (precompiled structs,
+    field functions) the generated source refers to.
+    """
+    exec("\n".join(lines), namespace)
+
+    return namespace[function_name]
+
+
+def field_encoder(part_class):
+    """
+    Returns a function that writes the encoding of a single value to a buffer.
+    """
+    if issubclass(part_class, VariablePrimitive):
+        return variable_encoder(part_class)
+    if issubclass(part_class, Array):
+        return array_encoder(part_class)
+    if issubclass(part_class, Primitive):
+        packer = compiled_struct(part_class.fmt)
+        size = packer.size
+
+        def encode_primitive(value, out):
+            packer.pack_into(out.data, out.reserve(size), value)
+
+        return encode_primitive
+
+    def encode_part(value, out):
+        value.encode(out)
+
+    return encode_part
+
+
+def field_decoder(part_class):
+    """
+    Returns a function that decodes a single value from a buffer at an offset.
+    """
+    if issubclass(part_class, VariablePrimitive):
+        return variable_decoder(part_class)
+    if issubclass(part_class, Array):
+        return array_decoder(part_class)
+    if issubclass(part_class, Primitive):
+        unpacker = compiled_struct(part_class.fmt)
+        size = unpacker.size
+
+        def decode_primitive(buff, offset):
+            return unpacker.unpack_from(buff, offset)[0], offset + size
+
+        return decode_primitive
+
+    return part_class.parse
+
+
+def variable_encoder(part_class):
+    """
+    Creates an encoder for size-prefixed strings or bytes.
+
+    ``None`` values are encoded as a size of -1 with no data.  Values that
+    are already bytes-like (including ``memoryview`` slices handed out by
+    zero-copy decoding) are copied into the buffer as-is.
+    """
+    size_packer = compiled_struct(part_class.size_primitive.fmt)
+    size_size = size_packer.size
+
+    def encode_variable(value, out):
+        if value is None:
+            size_packer.pack_into(out.data, out.reserve(size_size), -1)
+            return
+
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            value = to_bytes(value)
+
+        size = len(value)
+        position = out.reserve(size_size + size)
+        size_packer.pack_into(out.data, position, size)
+        position += size_size
+        out.data[position:position + size] = value
+
+    return encode_variable
+
+
+def variable_decoder(part_class):
+    """
+    Creates a decoder for size-prefixed strings or bytes.
+
+    Values are decoded as UTF-8 where possible, same as
+    ``VariablePrimitive.parse()``, otherwise they're returned as bytes.  A
+    ``struct.error`` is raised if the buffer is too short to hold the value.
+
+    If the buffer is a ``memoryview``, `Bytes` values are returned as
+    ``memoryview`` slices of it instead, with no copying or decoding.
+    """
+    size_unpacker = compiled_struct(part_class.size_primitive.fmt)
+    size_size = size_unpacker.size
+    views = issubclass(part_class, Bytes)
+
+    def decode_variable(buff, offset):
+        size = size_unpacker.unpack_from(buff, offset)[0]
+        offset += size_size
+        if size == -1:
+            return None, offset
+
+        end = offset + size
+        if end > len(buff):
+            raise struct.error("buffer too short for %d bytes" % size)
+
+        value = buff[offset:end]
+        if isinstance(value, memoryview):
+            if views:
+                return value, end
+            value = value.tobytes()
+
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            # decompressed buffers can be bytearrays, values are always bytes
+            if isinstance(value, bytearray):
+                value = bytes(value)
+
+        return value, end
+
+    return decode_variable
+
+
+def array_encoder(part_class):
+    """
+    Creates an encoder for count-prefixed arrays.
+
+    Arrays of fixed-width primitives are packed with a single struct call.
+    The struct depends on the array's length so it isn't cached, see
+    `compiled_struct()`.
+    """
+    count_packer = compiled_struct(Int32.fmt)
+    count_size = count_packer.size
+    item_class = part_class.item_class
+
+    if is_fixed(item_class):
+        item_fmt = item_class.fmt
+
+        def encode_fixed_array(value, out):
+            if value is None:
+                value = []
+            count = len(value)
+            array_struct = struct.Struct("!i%d%s" % (count, item_fmt))
+            array_struct.pack_into(
+                out.data, out.reserve(array_struct.size), count, *value
+            )
+
+        return encode_fixed_array
+
+    encode_item = field_encoder(item_class)
+
+    def encode_array(value, out):
+        if value is None:
+            value = []
+        count_packer.pack_into(out.data, out.reserve(count_size), len(value))
+        for item in value:
+            encode_item(item, out)
+
+    return encode_array
+
+
+def array_decoder(part_class):
+    """
+    Creates a decoder for count-prefixed arrays.
+
+    Arrays of fixed-width primitives are unpacked with a single struct call.
+    The count comes off the wire, so the struct isn't cached lest the cache
+    grow without bound.
+    """
+    count_unpacker = compiled_struct(Int32.fmt)
+    count_size = count_unpacker.size
+    item_class = part_class.item_class
+
+    if is_fixed(item_class):
+        item_fmt = item_class.fmt
+
+        def decode_fixed_array(buff, offset):
+            count = count_unpacker.unpack_from(buff, offset)[0]
+            offset += count_size
+            if count <= 0:
+                return [], offset
+
+            items_struct = struct.Struct("!%d%s" % (count, item_fmt))
+
+            return (
+                list(items_struct.unpack_from(buff, offset)),
+                offset + items_struct.size
+            )
+
+        return decode_fixed_array
+
+    decode_item = field_decoder(item_class)
+
+    def decode_array(buff, offset):
+        count = count_unpacker.unpack_from(buff, offset)[0]
+        offset += count_size
+
+        values = []
+        for _ in range(count):
+            value, offset = decode_item(buff, offset)
+            values.append(value)
+
+        return values, offset
+
+    return decode_array
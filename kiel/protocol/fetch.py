@@ -2,19 +2,36 @@ from .part import Part
 from .request import Request
 from .response import Response
 from .messages import MessageSet
-from .primitives import Array, String, Int16, Int32, Int64
+from .primitives import Array, String, Int8, Int16, Int32, Int64
 
 
 api_name = "fetch"
 
 
 __all__ = [
+    "FetchV10Request",
+    "FetchV7Request",
+    "FetchV4Request",
+    "FetchV3Request",
     "FetchRequest",
+    "TopicV9Request",
+    "TopicV7Request",
     "TopicRequest",
+    "PartitionV9Request",
+    "PartitionV7Request",
     "PartitionRequest",
+    "ForgottenTopic",
+    "FetchV7Response",
+    "FetchV4Response",
+    "FetchV3Response",
     "FetchResponse",
+    "TopicV7Response",
+    "TopicV4Response",
     "TopicResponse",
+    "PartitionV7Response",
+    "PartitionV4Response",
     "PartitionResponse",
+    "AbortedTransaction",
 ]
 
 
@@ -68,6 +85,215 @@ class FetchRequest(Request):
     )
 
 
+class FetchV3Request(Request):
+    """
+    ::
+
+      FetchV3Request =>
+        replica_id => Int32
+        max_wait_time => Int32
+        min_bytes => Int32
+        max_bytes => Int32
+        topics => [TopicRequest]
+
+    The ``max_bytes`` limit applies to the response as a whole, on top of
+    the per-partition limits.
+    """
+    api = "fetch"
+    version = 3
+
+    parts = (
+        ("replica_id", Int32),
+        ("max_wait_time", Int32),
+        ("min_bytes", Int32),
+        ("max_bytes", Int32),
+        ("topics", Array.of(TopicRequest)),
+    )
+
+
+class FetchV4Request(Request):
+    """
+    ::
+
+      FetchV4Request =>
+        replica_id => Int32
+        max_wait_time => Int32
+        min_bytes => Int32
+        max_bytes => Int32
+        isolation_level => Int8
+        topics => [TopicRequest]
+
+    Brokers answer this version with v2 record batches where possible.
+    """
+    api = "fetch"
+    version = 4
+
+    parts = (
+        ("replica_id", Int32),
+        ("max_wait_time", Int32),
+        ("min_bytes", Int32),
+        ("max_bytes", Int32),
+        ("isolation_level", Int8),
+        ("topics", Array.of(TopicRequest)),
+    )
+
+
+class PartitionV7Request(Part):
+    """
+    ::
+
+      PartitionV7Request =>
+        partition_id => Int32
+        offset => Int64
+        log_start_offset => Int64
+        max_bytes => Int32
+
+    The ``log_start_offset`` is only used by followers, consumers send -1.
+    """
+    parts = (
+        ("partition_id", Int32),
+        ("offset", Int64),
+        ("log_start_offset", Int64),
+        ("max_bytes", Int32),
+    )
+
+
+class TopicV7Request(Part):
+    """
+    ::
+
+      TopicV7Request =>
+        name => String
+        partitions => [PartitionV7Request]
+    """
+    parts = (
+        ("name", String),
+        ("partitions", Array.of(PartitionV7Request)),
+    )
+
+
+class ForgottenTopic(Part):
+    """
+    ::
+
+      ForgottenTopic =>
+        name => String
+        partitions => [Int32]
+    """
+    parts = (
+        ("name", String),
+        ("partitions", Array.of(Int32)),
+    )
+
+
+class FetchV7Request(Request):
+    """
+    ::
+
+      FetchV7Request =>
+        replica_id => Int32
+        max_wait_time => Int32
+        min_bytes => Int32
+        max_bytes => Int32
+        isolation_level => Int8
+        session_id => Int32
+        session_epoch => Int32
+        topics => [TopicV7Request]
+        forgotten_topics => [ForgottenTopic]
+
+    A request with a ``session_epoch`` of zero lists every partition and asks
+    the broker to create a new fetch session.  Requests made as part of an
+    existing session only list the partitions that were added or changed
+    since the last one, and the ``forgotten_topics`` that were dropped.
+    """
+    api = "fetch"
+    version = 7
+
+    parts = (
+        ("replica_id", Int32),
+        ("max_wait_time", Int32),
+        ("min_bytes", Int32),
+        ("max_bytes", Int32),
+        ("isolation_level", Int8),
+        ("session_id", Int32),
+        ("session_epoch", Int32),
+        ("topics", Array.of(TopicV7Request)),
+        ("forgotten_topics", Array.of(ForgottenTopic)),
+    )
+
+
+class PartitionV9Request(Part):
+    """
+    ::
+
+      PartitionV9Request =>
+        partition_id => Int32
+        current_leader_epoch => Int32
+        offset => Int64
+        log_start_offset => Int64
+        max_bytes => Int32
+
+    Consumers not tracking leader epochs send -1 as ``current_leader_epoch``,
+    which skips the broker's epoch check.
+    """
+    parts = (
+        ("partition_id", Int32),
+        ("current_leader_epoch", Int32),
+        ("offset", Int64),
+        ("log_start_offset", Int64),
+        ("max_bytes", Int32),
+    )
+
+
+class TopicV9Request(Part):
+    """
+    ::
+
+      TopicV9Request =>
+        name => String
+        partitions => [PartitionV9Request]
+    """
+    parts = (
+        ("name", String),
+        ("partitions", Array.of(PartitionV9Request)),
+    )
+
+
+class FetchV10Request(Request):
+    """
+    ::
+
+      FetchV10Request =>
+        replica_id => Int32
+        max_wait_time => Int32
+        min_bytes => Int32
+        max_bytes => Int32
+        isolation_level => Int8
+        session_id => Int32
+        session_epoch => Int32
+        topics => [TopicV9Request]
+        forgotten_topics => [ForgottenTopic]
+
+    Same as `FetchV7Request` save for the partitions' leader epoch (added in
+    version 9), but brokers can answer with record batches compressed with
+    zstd.
+    """
+    api = "fetch"
+    version = 10
+
+    parts = (
+        ("replica_id", Int32),
+        ("max_wait_time", Int32),
+        ("min_bytes", Int32),
+        ("max_bytes", Int32),
+        ("isolation_level", Int8),
+        ("session_id", Int32),
+        ("session_epoch", Int32),
+        ("topics", Array.of(TopicV9Request)),
+        ("forgotten_topics", Array.of(ForgottenTopic)),
+    )
+
+
 class PartitionResponse(Part):
     """
     ::
@@ -112,3 +338,146 @@ class FetchResponse(Response):
     parts = (
         ("topics", Array.of(TopicResponse)),
     )
+
+
+class FetchV3Response(Response):
+    """
+    ::
+
+      FetchV3Response =>
+        throttle_time => Int32
+        topics => [TopicResponse]
+    """
+    api = "fetch"
+
+    parts = (
+        ("throttle_time", Int32),
+        ("topics", Array.of(TopicResponse)),
+    )
+
+
+class AbortedTransaction(Part):
+    """
+    ::
+
+      AbortedTransaction =>
+        producer_id => Int64
+        first_offset => Int64
+    """
+    parts = (
+        ("producer_id", Int64),
+        ("first_offset", Int64),
+    )
+
+
+class PartitionV4Response(Part):
+    """
+    ::
+
+      PartitionV4Response =>
+        partition_id => Int32
+        error_code => Int16
+        highwater_mark_offset => Int64
+        last_stable_offset => Int64
+        aborted_transactions => [AbortedTransaction]
+        message_set => MessageSet
+    """
+    parts = (
+        ("partition_id", Int32),
+        ("error_code", Int16),
+        ("highwater_mark_offset", Int64),
+        ("last_stable_offset", Int64),
+        ("aborted_transactions", Array.of(AbortedTransaction)),
+        ("message_set", MessageSet),
+    )
+
+
+class TopicV4Response(Part):
+    """
+    ::
+
+      TopicV4Response =>
+        name => String
+        partitions => [PartitionV4Response]
+    """
+    parts = (
+        ("name", String),
+        ("partitions", Array.of(PartitionV4Response)),
+    )
+
+
+class FetchV4Response(Response):
+    """
+    ::
+
+      FetchV4Response =>
+        throttle_time => Int32
+        topics => [TopicV4Response]
+    """
+    api = "fetch"
+
+    parts = (
+        ("throttle_time", Int32),
+        ("topics", Array.of(TopicV4Response)),
+    )
+
+
+class PartitionV7Response(Part):
+    """
+    ::
+
+      PartitionV7Response =>
+        partition_id => Int32
+        error_code => Int16
+        highwater_mark_offset => Int64
+        last_stable_offset => Int64
+        log_start_offset => Int64
+        aborted_transactions => [AbortedTransaction]
+        message_set => MessageSet
+    """
+    parts = (
+        ("partition_id", Int32),
+        ("error_code", Int16),
+        ("highwater_mark_offset", Int64),
+        ("last_stable_offset", Int64),
+        ("log_start_offset", Int64),
+        ("aborted_transactions", Array.of(AbortedTransaction)),
+        ("message_set", MessageSet),
+    )
+
+
+class TopicV7Response(Part):
+    """
+    ::
+
+      TopicV7Response =>
+        name => String
+        partitions => [PartitionV7Response]
+    """
+    parts = (
+        ("name", String),
+        ("partitions", Array.of(PartitionV7Response)),
+    )
+
+
+class FetchV7Response(Response):
+    """
+    ::
+
+      FetchV7Response =>
+        throttle_time => Int32
+        error_code => Int16
+        session_id => Int32
+        topics => [TopicV7Response]
+
+    Responses within an incremental fetch session only include partitions
+    that have data (or errors), so ``topics`` may well be empty.
+    """
+    api = "fetch"
+
+    parts = (
+        ("throttle_time", Int32),
+        ("error_code", Int16),
+        ("session_id", Int32),
+        ("topics", Array.of(TopicV7Response)),
+    )
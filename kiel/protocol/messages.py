@@ -2,15 +2,32 @@ import logging
 import struct
 import zlib
 
-from kiel.constants import GZIP, SNAPPY
-from kiel.compression import gzip, snappy
+import six
 
 from .part import Part
-from .primitives import Int8, Int32, Int64, Bytes
+from .buffers import WriteBuffer
+from .codec import compile_encoder
+from .primitives import Int8, Int32, Int64, Bytes, compiled_struct
+from .records import (
+    BATCH_MAGIC, BATCH_HEADER_SIZE, CRC_START, COMPRESSION_MASK,
+    batch_header_struct, batch_crc_struct, batch_fields_struct,
+    crc32c, compress, decompress, encode_record, iterate_batch,
+    timestamp_millis,
+)
 
 
 log = logging.getLogger(__name__)
 
+# message sets are prefixed with a 4-byte signed integer of their size
+size_struct = compiled_struct(Int32.fmt)
+# messages start with a signed CRC32 of the rest of the message
+crc_struct = compiled_struct(Int32.fmt)
+# each message in a set is preceded by its offset and size
+header_struct = compiled_struct(Int64.fmt + Int32.fmt)
+# the magic byte comes after the CRC, in the same spot for every format
+magic_struct = compiled_struct(Int8.fmt)
+MAGIC_OFFSET = header_struct.size + crc_struct.size
+
 
 class MessageSet(object):
     """
@@ -19,9 +36,59 @@ class MessageSet(object):
     Kafka's compression scheme works by taking a set of messages, compressing
     them with the chosen compression scheme, and then wrapping the result as
     the value of an envelope message, called the "message set".
+
+    Sets created via `parse()` are lazy: they hold on to the raw buffer
+    (as a ``(buffer, start, end)`` tuple in the ``raw`` attribute) and
+    messages are only parsed and decompressed as they're iterated over.
+
+    Sets created by a `MessageSetBuilder` carry their already-encoded
+    entries in the ``encoded`` attribute, which `encode()` copies out as-is.
     """
-    def __init__(self, messages):
-        self.messages = messages
+    __slots__ = ("parsed", "raw", "encoded")
+
+    def __init__(self, messages=None, raw=None, encoded=None):
+        self.parsed = messages
+        self.raw = raw
+        self.encoded = encoded
+
+    @property
+    def messages(self):
+        """
+        The list of (<offset>, <message>) tuples in the set.
+
+        For lazy sets this parses the entire raw buffer on first access, when
+        only some messages are needed use `iterate()` instead.
+        """
+        if self.parsed is None:
+            self.parsed = list(self.iterate())
+
+        return self.parsed
+
+    def __iter__(self):
+        """
+        Iterates over each (<offset>, <message>) tuple in the set.
+        """
+        return self.iterate()
+
+    def iterate(self, min_offset=None):
+        """
+        Yields the (<offset>, <message>) tuples in the set in order.
+
+        If ``min_offset`` is given, messages with a lower offset are skipped.
+        For lazy sets such messages are never decoded: their size is used to
+        jump past them, and compressed wrappers are only decompressed if their
+        offset (that of the last nested message) is at or past ``min_offset``.
+        """
+        if self.parsed is not None or self.raw is None:
+            for message_offset, message in self.parsed or []:
+                if min_offset is None or message_offset >= min_offset:
+                    yield message_offset, message
+            return
+
+        buff, start, end = self.raw
+
+        for entry in iterate_raw(buff, start, end, min_offset):
+            yield entry
 
     @classmethod
     def compressed(cls, compression, msgs):
@@ -39,25 +106,39 @@ class MessageSet(object):
         if not compression:
             return cls([(-1, msg) for msg in msgs])
 
-        set_format, set_data = cls([(-1, msg) for msg in msgs]).render()
-
         # compressed message sets are nested and don't include the size
-        set_format = set_format[1:]
-        set_data.pop(0)
+        out = WriteBuffer()
+        cls([(-1, msg) for msg in msgs]).encode_messages(out)
 
-        raw_set = struct.pack("!" + set_format, *set_data)
+        return cls.wrapped(compression, out.view())
 
-        if compression == GZIP:
-            compressed_set = gzip.compress(raw_set)
-        elif compression == SNAPPY:
-            compressed_set = snappy.compress(raw_set)
+    @classmethod
+    def wrapped(cls, compression, raw_set, magic=0, level=None):
+        """
+        Returns a `MessageSet` wrapping the compressed bytes of a nested set.
 
-        container_msg = Message(
-            magic=0,
-            attributes=compression,
-            key=None,
-            value=compressed_set
-        )
+        The ``raw_set`` is the encoded set *without* the leading size (any
+        bytes-like object), it is compressed with the optional codec-specific
+        ``level`` and becomes the value of the set's single message.  With a
+        ``magic`` of 1 the wrapper is a timestamped `MessageV1`.
+        """
+        compressed_set = compress(compression, raw_set, magic, level)
+
+        if magic == 1:
+            container_msg = MessageV1(
+                magic=1,
+                attributes=compression,
+                timestamp=timestamp_millis(),
+                key=None,
+                value=compressed_set
+            )
+        else:
+            container_msg = Message(
+                magic=0,
+                attributes=compression,
+                key=None,
+                value=compressed_set
+            )
 
         return cls([(-1, container_msg)])
 
@@ -94,6 +175,39 @@ class MessageSet(object):
 
         return "".join(fmt), data
 
+    def encode(self, out):
+        """
+        Writes the size-prefixed wire representation of the set to ``out``.
+
+        The size is reserved up front and filled in once the messages are
+        written, so the set is encoded in a single pass.
+        """
+        position = out.reserve(size_struct.size)
+
+        if self.encoded is not None:
+            out.write(self.encoded)
+        else:
+            self.encode_messages(out)
+
+        size_struct.pack_into(
+            out.data, position, out.size - position - size_struct.size
+        )
+
+    def encode_messages(self, out):
+        """
+        Writes the (<offset>, <message>) entries in the set to ``out``.
+
+        This is the set *without* the leading size, which is the form used
+        for the nested value of a compressed message.
+        """
+        for offset, message in self.messages:
+            position = out.reserve(header_struct.size)
+            message.encode(out)
+            header_struct.pack_into(
+                out.data, position,
+                offset, out.size - position - header_struct.size
+            )
+
     def __eq__(self, other):
         """
         Tests equivalence of message sets.
@@ -110,39 +224,189 @@ class MessageSet(object):
     @classmethod
     def parse(cls, buff, offset, size=None):
         """
-        Given a buffer and offset, returns the parsed `MessageSet` and offset.
+        Given a buffer and offset, returns the lazy `MessageSet` and offset.
 
-        Starts by determining the size of the raw payload to parse, and
-        continuously parses the ``Int64`` offset and ``Int32`` size of a
-        message then the `Message` itself.
-
-        If a parsed message's flags denote compression, `parse()` is called
-        recursively on the message's value in order to unpack the compressed
-        nested messages.
+        Only the size of the raw payload is determined here, the messages
+        themselves are parsed on demand when the set is iterated over (see
+        `iterate_raw()`).
         """
         if size is None:
-            size, offset = Int32.parse(buff, offset)
+            size = size_struct.unpack_from(buff, offset)[0]
+            offset += size_struct.size
 
         end = offset + size
 
-        messages = []
-        while not offset == end:
-            try:
-                message_offset, offset = Int64.parse(buff, offset)
-                _, offset = Int32.parse(buff, offset)  # message size
-                message, offset = Message.parse(buff, offset)
-            except struct.error:
-                # ending messages can sometimes be cut off
-                break
+        return cls(raw=(buff, offset, end)), end
+
+
+class MessageSetBuilder(object):
+    """
+    Accumulates messages into a set, encoding each one as it's appended.
+
+    The wire representation of every (<offset>, <message>) entry, CRC and
+    all, is written to a `WriteBuffer` up front, so producing the finished
+    `MessageSet` via `build()` doesn't encode anything (aside from the
+    wrapper message when compression is used).
+
+    With a ``magic`` of 1 the messages are encoded as timestamped
+    `MessageV1` entries with offsets relative to the start of the set.
+    """
+    __slots__ = ("magic", "messages", "out")
+
+    def __init__(self, magic=0):
+        self.magic = magic
+        self.messages = []
+        self.out = WriteBuffer()
 
-            if message.attributes:  # compression involved, set is nested
-                set_size = len(message.value)
-                nested_set, _ = cls.parse(message.value, 0, size=set_size)
-                messages.extend(nested_set.messages)
-            else:
-                messages.append((message_offset, message))
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message):
+        """
+        Encodes a `Message` onto the end of the set.
+        """
+        out = self.out
+
+        if self.magic == 1:
+            offset = len(self.messages)
+            entry = MessageV1(
+                magic=1,
+                attributes=0,
+                timestamp=timestamp_millis(),
+                key=message.key,
+                value=message.value
+            )
+        else:
+            offset = -1
+            entry = message
+
+        position = out.reserve(header_struct.size)
+        entry.encode(out)
+        header_struct.pack_into(
+            out.data, position,
+            offset, out.size - position - header_struct.size
+        )
+
+        self.messages.append(message)
+
+    def extend(self, msgs):
+        """
+        Encodes each of a list of messages onto the end of the set.
+        """
+        for message in msgs:
+            self.append(message)
+
+    def build(self, compression=None, level=None):
+        """
+        Returns the `MessageSet` of the appended messages.
+
+        Without compression the set is the already-encoded entries as-is,
+        otherwise they're compressed as a whole (straight from the buffer)
+        and wrapped in a single message, same as `MessageSet.compressed()`.
+        """
+        if compression:
+            return MessageSet.wrapped(
+                compression, self.out.view(), magic=self.magic, level=level
+            )
+
+        return MessageSet(
+            [(-1, message) for message in self.messages],
+            encoded=self.out.view()
+        )
+
+
+class RecordBatchBuilder(object):
+    """
+    Accumulates messages into a v2 record batch, encoding them as appended.
+
+    Records are varint-encoded with offsets and timestamps relative to the
+    first record, and the batch as a whole carries a single CRC32C and is
+    compressed as a whole, making for much less per-message overhead than
+    the older formats.
+
+    Space for the batch header is reserved up front and filled in by
+    `build()`, so without compression no bytes are copied when building.
+    """
+    __slots__ = ("messages", "out", "first_timestamp", "max_timestamp")
 
-        return cls(messages), offset
+    magic = BATCH_MAGIC
+
+    def __init__(self):
+        self.messages = []
+        self.out = WriteBuffer()
+        self.out.reserve(BATCH_HEADER_SIZE)
+
+        self.first_timestamp = -1
+        self.max_timestamp = -1
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message):
+        """
+        Encodes a `Message`'s key and value as a record in the batch.
+        """
+        timestamp = timestamp_millis()
+        if not self.messages:
+            self.first_timestamp = timestamp
+        self.max_timestamp = max(self.max_timestamp, timestamp)
+
+        encode_record(
+            self.out, len(self.messages), timestamp - self.first_timestamp,
+            message.key, message.value
+        )
+
+        self.messages.append(message)
+
+    def extend(self, msgs):
+        """
+        Encodes each of a list of messages onto the end of the batch.
+        """
+        for message in msgs:
+            self.append(message)
+
+    def build(self, compression=None, level=None):
+        """
+        Returns a `MessageSet` with the finished batch as its encoded value.
+
+        With compression the records are fed to the codec straight from the
+        buffer (with the optional codec-specific ``level``) and the result
+        goes into a new buffer behind the header, otherwise the header is
+        filled in in place.
+        """
+        out = self.out
+        if compression:
+            records = memoryview(out.data)[BATCH_HEADER_SIZE:out.size]
+            records = compress(compression, records, level=level)
+            out = WriteBuffer(BATCH_HEADER_SIZE + len(records))
+            out.reserve(BATCH_HEADER_SIZE)
+            out.write(records)
+
+        batch_header_struct.pack_into(
+            out.data, 0,
+            0,  # base offset, assigned by the broker
+            out.size - header_struct.size,
+            -1,  # partition leader epoch
+            BATCH_MAGIC,
+        )
+        batch_fields_struct.pack_into(
+            out.data, CRC_START,
+            compression or 0,
+            len(self.messages) - 1,
+            self.first_timestamp,
+            self.max_timestamp,
+            -1, -1, -1,  # producer id, epoch and sequence (no idempotence)
+            len(self.messages),
+        )
+        batch_crc_struct.pack_into(
+            out.data, batch_header_struct.size,
+            crc32c(memoryview(out.data)[CRC_START:out.size])
+        )
+
+        return MessageSet(
+            [(-1, message) for message in self.messages],
+            encoded=out.view()
+        )
 
 
 class Message(Part):
@@ -173,13 +437,23 @@ class Message(Part):
 
         payload = struct.pack("!" + fmt, *data)
 
-        crc = zlib.crc32(payload)
-        if crc > (2**31):
-            crc -= 2**32
-
         fmt = "i%ds" % len(payload)
 
-        return fmt, [crc, payload]
+        return fmt, [signed_crc(payload), payload]
+
+    def encode(self, out):
+        """
+        Encodes just like the base ``Part`` class, but with CRC32 verification.
+
+        The payload is written first and the CRC back-filled in front of it,
+        computed over a view of the buffer rather than a copy of the payload.
+        """
+        position = out.reserve(crc_struct.size)
+        self.payload_encoder(self, out)
+
+        payload = out.region(position + crc_struct.size)
+
+        crc_struct.pack_into(out.data, position, signed_crc(payload))
 
     @classmethod
     def parse(cls, buff, offset):
@@ -191,19 +465,27 @@ class Message(Part):
 
         If a parsed message's attributes denote that compression has been used,
         the value is run through the corresponding ``decompress()`` method.
+        When parsing a ``memoryview`` buffer the decompressed value is wrapped
+        in a ``memoryview`` as well, so that nested messages are sliced out of
+        it rather than copied.
         """
         message, offset = super(Message, cls).parse(buff, offset)
 
-        # the compression scheme is stored in the lowest 2 bits of 'attributes'
-        compression = message.attributes & 0b00000011
+        # the compression scheme is stored in the lowest 3 bits of 'attributes'
+        compression = message.attributes & COMPRESSION_MASK
 
         if not compression:
             return message, offset
 
-        if compression == GZIP:
-            message.value = gzip.decompress(message.value)
-        elif compression == SNAPPY:
-            message.value = snappy.decompress(message.value)
+        value = message.value
+        # compressed values that happen to be valid UTF-8 get decoded
+        if isinstance(value, six.text_type):
+            value = value.encode("utf-8")
+
+        message.value = decompress(compression, value)
+
+        if isinstance(buff, memoryview):
+            message.value = memoryview(message.value)
 
         return message, offset
 
@@ -216,3 +498,126 @@ class Message(Part):
 
     def __repr__(self):
         return "%s => %s" % (self.key, self.value)
+
+
+class MessageV1(Message):
+    """
+    A Kafka message in the magic 1 format, which adds a timestamp.
+    ::
+
+      MessageV1 =>
+        crc => Int32
+        magic => Int8
+        attributes => Int8
+        timestamp => Int64
+        key => Bytes
+        value => Bytes
+
+    When compressed, the offsets of the messages nested in the value are
+    relative to the first of them rather than absolute.
+    """
+    parts = (
+        ("crc", Int32),
+        ("magic", Int8),
+        ("attributes", Int8),
+        ("timestamp", Int64),
+        ("key", Bytes),
+        ("value", Bytes),
+    )
+
+
+#: Encoders for everything in a message covered by the CRC
+Message.payload_encoder = staticmethod(compile_encoder(Message.parts[1:]))
+MessageV1.payload_encoder = staticmethod(compile_encoder(MessageV1.parts[1:]))
+
+#: Mapping of magic byte values to the message classes for that format
+message_classes = {
+    0: Message,
+    1: MessageV1,
+}
+
+
+def iterate_raw(buff, offset, end, min_offset=None):
+    """
+    Yields (<offset>, <message>) tuples parsed from a raw message set buffer.
+
+    Continuously parses the ``Int64`` offset and ``Int32`` size of an entry
+    then the entry itself, stopping at ``end`` or at an entry cut off by the
+    end of the set (as the last one in a fetch response can be).
+
+    Entries are parsed according to their magic byte: v2 record batches are
+    handed to ``iterate_batch()``, older entries are parsed as `Message` or
+    `MessageV1` instances.
+
+    Messages with an offset below ``min_offset`` are skipped over without
+    being parsed.  If a parsed message's attributes denote compression, the
+    nested set in its decompressed value is iterated over recursively.
+    """
+    while offset < end:
+        start = offset
+        try:
+            message_offset, size = header_struct.unpack_from(buff, offset)
+            magic = magic_struct.unpack_from(buff, offset + MAGIC_OFFSET)[0]
+        except struct.error:
+            return
+
+        offset += header_struct.size
+        message_end = offset + size
+        if message_end > end:
+            return
+
+        if magic == BATCH_MAGIC:
+            for entry in iterate_batch(buff, start, message_end, min_offset):
+                yield entry
+            offset = message_end
+            continue
+
+        if min_offset is not None and message_offset < min_offset:
+            offset = message_end
+            continue
+
+        message_class = message_classes.get(magic)
+        if message_class is None:
+            log.warn("Skipping message with unknown magic byte %d", magic)
+            offset = message_end
+            continue
+
+        try:
+            message, _ = message_class.parse(buff, offset)
+        except struct.error:
+            return
+
+        offset = message_end
+
+        if not message.attributes & COMPRESSION_MASK:
+            yield message_offset, message
+            continue
+
+        # compression, set is nested
+        if magic == 0:
+            nested = iterate_raw(
+                message.value, 0, len(message.value), min_offset
+            )
+            for entry in nested:
+                yield entry
+            continue
+
+        # magic 1 nested offsets are relative, the wrapper has the last one
+        nested = list(iterate_raw(message.value, 0, len(message.value)))
+        if not nested:
+            continue
+        base_offset = message_offset - nested[-1][0]
+        for nested_offset, nested_message in nested:
+            if min_offset is None or base_offset + nested_offset >= min_offset:
+                yield base_offset + nested_offset, nested_message
+
+
+def signed_crc(payload):
+    """
+    Returns the CRC32 of a payload as a signed 32-bit integer.
+    """
+    crc = zlib.crc32(payload)
+    if crc > (2**31):
+        crc -= 2**32
+
+    return crc
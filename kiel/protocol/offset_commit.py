@@ -109,6 +109,7 @@ class OffsetCommitV1Request(Request):
         topics => [TopicV1Request]
     """
     api = "offset_commit"
+    version = 1
 
     parts = (
         ("group", String),
@@ -130,6 +131,7 @@ class OffsetCommitV2Request(Request):
         topics => [TopicRequest]
     """
     api = "offset_commit"
+    version = 2
 
     parts = (
         ("group", String),
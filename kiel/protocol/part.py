@@ -1,6 +1,50 @@
+import six
+
 from .primitives import Primitive
+from .codec import compile_encoder, compile_decoder, compile_constructor
+
+
+class PartMeta(type):
+    """
+    Metaclass that compiles a codec for each ``Part`` subclass's ``parts``.
+
+    Rather than walking the ``parts`` tuple and wrapping each field in a
+    ``Primitive`` instance on every call, the layout is compiled once when
+    the class is created: runs of fixed-width fields are collapsed into a
+    single precompiled ``struct.Struct`` and arrays and variable-length fields
+    get specialized functions.  The results are stored as the ``encoder`` and
+    ``decoder`` static methods of the class, along with a positional
+    ``construct`` function used when parsing.
+
+    The part names are also added to the class's ``__slots__`` so instances
+    are compact and have no ``__dict__``.  Any other instance attributes a
+    subclass needs must be listed in its own ``__slots__``.
+    """
+    def __new__(mcs, name, bases, attrs):
+        inherited = set()
+        for base in bases:
+            for klass in base.__mro__:
+                inherited.update(klass.__dict__.get("__slots__", ()))
+
+        slots = list(attrs.get("__slots__", ()))
+        for part_name, _ in attrs.get("parts", ()):
+            if part_name not in inherited and part_name not in slots:
+                slots.append(part_name)
+
+        attrs["__slots__"] = tuple(slots)
+
+        return super(PartMeta, mcs).__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        super(PartMeta, cls).__init__(name, bases, attrs)
 
+        cls.part_names = tuple([part_name for part_name, _ in cls.parts])
+        cls.encoder = staticmethod(compile_encoder(cls.parts))
+        cls.decoder = staticmethod(compile_decoder(cls.parts))
+        cls.construct = staticmethod(compile_constructor(cls))
 
+
+@six.add_metaclass(PartMeta)
 class Part(object):
     """
     Composable building block used to define Kafka protocol parts.
@@ -8,17 +52,17 @@ class Part(object):
     Behaves much like the `Primitive` class but has named "sub parts"
     stored in a ``parts`` class attribute, that can hold any `Part` or
     `Primitive` subclass.
+
+    Any sub parts not given when constructing an instance default to ``None``.
     """
     parts = ()
 
     def __init__(self, **kwargs):
-        part_names = [item[0] for item in self.parts]
-
-        for name, value in kwargs.items():
-            if name not in part_names:
-                raise ValueError("Unknown part name: '%s'" % name)
+        for name in self.part_names:
+            setattr(self, name, kwargs.pop(name, None))
 
-            setattr(self, name, value)
+        for name in kwargs:
+            raise ValueError("Unknown part name: '%s'" % name)
 
     def render(self, parts=None):
         """
@@ -49,23 +93,28 @@ class Part(object):
 
         return "".join(fmt), data
 
+    def encode(self, out):
+        """
+        Writes the wire representation of the instance to an ``out`` buffer.
+
+        Uses the ``encoder`` compiled for the class by `PartMeta`, the bytes
+        written to the `WriteBuffer` are the same that packing the output of
+        `render()` would give.
+        """
+        self.encoder(self, out)
+
     @classmethod
     def parse(cls, buff, offset):
         """
         Given a buffer and offset, returns the parsed value and new offset.
 
-        Calls `parse()` on the given buffer for each sub-part in order and
-        creates a new instance with the results.
+        Runs the ``decoder`` compiled for the class by `PartMeta` on the
+        given buffer and creates a new instance from the results via the
+        positional ``construct`` function, bypassing ``__init__()``.
         """
-        values = {}
-
-        for name, part in cls.parts:
-            value, new_offset = part.parse(buff, offset)
-
-            values[name] = value
-            offset = new_offset
+        values, offset = cls.decoder(buff, offset)
 
-        return cls(**values), offset
+        return cls.construct(*values), offset
 
     def __eq__(self, other):
         """
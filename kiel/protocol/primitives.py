@@ -3,6 +3,40 @@ import struct
 import six
 
 
+#: Cache of precompiled ``struct.Struct`` instances keyed on format.
+compiled_structs = {}
+
+
+def compiled_struct(fmt):
+    """
+    Returns a precompiled, network byte order ``struct.Struct`` for a format.
+
+    Instances are cached, so repeated lookups of the same format (e.g. the
+    format of a primitive's ``fmt`` attribute) only compile it once.
+    """
+    try:
+        return compiled_structs[fmt]
+    except KeyError:
+        compiled_structs[fmt] = struct.Struct("!" + fmt)
+        return compiled_structs[fmt]
+
+
+def to_bytes(value):
+    """
+    Coerces a variable primitive value into the bytes sent over the wire.
+
+    Byte strings are left as-is, anything else is ``str()``-ed if need be
+    and encoded as UTF-8.
+    """
+    if isinstance(value, six.binary_type):
+        return value
+
+    if not isinstance(value, six.string_types):
+        value = str(value)
+
+    return value.encode("utf-8")
+
+
 class Primitive(object):
     """
 The most basic structure of the protocol.  Subclassed, never used directly.
@@ -34,7 +68,7 @@ https://cwiki.apache.org/confluence/display/KAFKA/A+Guide+To+The+Kafka+Protocol
         Uses the ``fmt`` class attribute to unpack the data from the buffer
         and determine the used up number of bytes.
         """
-        primitive_struct = struct.Struct("!" + cls.fmt)
+        primitive_struct = compiled_struct(cls.fmt)
 
         value = primitive_struct.unpack_from(buff, offset)[0]
         offset += primitive_struct.size
@@ -74,13 +108,7 @@ class VariablePrimitive(Primitive):
         if self.value is None:
             return size_format, [-1]
 
-        value = self.value
-
-        if not isinstance(value, six.binary_type):
-            if not isinstance(value, six.string_types):
-                value = str(value)
-
-            value = value.encode("utf-8")
+        value = to_bytes(self.value)
 
         size = len(value)
 
@@ -173,13 +201,10 @@ class Array(Primitive):
         """
         Creates a new class with the ``item_class`` attribute properly set.
         """
-        copy = type(
+        return type(
             "ArrayOf%s" % part_class.__name__,
-            cls.__bases__, dict(cls.__dict__)
+            (cls,), {"item_class": part_class}
         )
-        copy.item_class = part_class
-
-        return copy
 
     def render(self):
         """
@@ -8,11 +8,22 @@ from .primitives import Int16, Int32, Int64, Array, String
 api_name = "produce"
 
 __all__ = [
+    "ProduceV7Request",
+    "ProduceV3Request",
+    "ProduceV2Request",
+    "ProduceV1Request",
     "ProduceRequest",
     "TopicRequest",
     "PartitionRequest",
+    "ProduceV5Response",
+    "ProduceV2Response",
+    "ProduceV1Response",
     "ProduceResponse",
+    "TopicV5Response",
+    "TopicV2Response",
     "TopicResponse",
+    "PartitionV5Response",
+    "PartitionV2Response",
     "PartitionResponse",
 ]
 
@@ -63,6 +74,52 @@ class ProduceRequest(Request):
     )
 
 
+class ProduceV1Request(ProduceRequest):
+    """
+    Same as `ProduceRequest`, the response adds a throttle time.
+    """
+    version = 1
+
+
+class ProduceV2Request(ProduceRequest):
+    """
+    Same as `ProduceRequest`, but the message sets can be in the magic 1
+    (timestamped) format.
+    """
+    version = 2
+
+
+class ProduceV3Request(Request):
+    """
+    ::
+
+      ProduceV3Request =>
+        transactional_id => String
+        required_acs => Int16
+        timeout => Int32
+        topics => [TopicRequest]
+
+    The message sets must be v2 record batches.
+    """
+    api = "produce"
+    version = 3
+
+    parts = (
+        ("transactional_id", String),
+        ("required_acks", Int16),
+        ("timeout", Int32),
+        ("topics", Array.of(TopicRequest)),
+    )
+
+
+class ProduceV7Request(ProduceV3Request):
+    """
+    Same as `ProduceV3Request`, but the record batches can be compressed
+    with zstd.
+    """
+    version = 7
+
+
 class PartitionResponse(Part):
     """
     ::
@@ -105,3 +162,117 @@ class ProduceResponse(Response):
     parts = (
         ("topics", Array.of(TopicResponse)),
     )
+
+
+class ProduceV1Response(Response):
+    """
+    ::
+
+      ProduceV1Response =>
+        topics => [TopicResponse]
+        throttle_time => Int32
+    """
+    api = "produce"
+
+    parts = (
+        ("topics", Array.of(TopicResponse)),
+        ("throttle_time", Int32),
+    )
+
+
+class PartitionV2Response(Part):
+    """
+    ::
+
+      PartitionV2Response =>
+        partition_id => Int32
+        error_code => Int16
+        offset => Int64
+        timestamp => Int64
+    """
+    parts = (
+        ("partition_id", Int32),
+        ("error_code", Int16),
+        ("offset", Int64),
+        ("timestamp", Int64),
+    )
+
+
+class TopicV2Response(Part):
+    """
+    ::
+
+      TopicV2Response =>
+        name => String
+        partitions => [PartitionV2Response]
+    """
+    parts = (
+        ("name", String),
+        ("partitions", Array.of(PartitionV2Response)),
+    )
+
+
+class ProduceV2Response(Response):
+    """
+    ::
+
+      ProduceV2Response =>
+        topics => [TopicV2Response]
+        throttle_time => Int32
+    """
+    api = "produce"
+
+    parts = (
+        ("topics", Array.of(TopicV2Response)),
+        ("throttle_time", Int32),
+    )
+
+
+class PartitionV5Response(Part):
+    """
+    ::
+
+      PartitionV5Response =>
+        partition_id => Int32
+        error_code => Int16
+        offset => Int64
+        timestamp => Int64
+        log_start_offset => Int64
+    """
+    parts = (
+        ("partition_id", Int32),
+        ("error_code", Int16),
+        ("offset", Int64),
+        ("timestamp", Int64),
+        ("log_start_offset", Int64),
+    )
+
+
+class TopicV5Response(Part):
+    """
+    ::
+
+      TopicV5Response =>
+        name => String
+        partitions => [PartitionV5Response]
+    """
+    parts = (
+        ("name", String),
+        ("partitions", Array.of(PartitionV5Response)),
+    )
+
+
+class ProduceV5Response(Response):
+    """
+    ::
+
+      ProduceV5Response =>
+        topics => [TopicV5Response]
+        throttle_time => Int32
+    """
+    api = "produce"
+
+    parts = (
+        ("topics", Array.of(TopicV5Response)),
+        ("throttle_time", Int32),
+    )
@@ -0,0 +1,331 @@
+import struct
+import time
+
+import six
+
+try:
+    import crc32c as crc32c_module
+    crc32c_available = True
+except ImportError:  # pragma: no cover
+    crc32c_available = False
+
+from kiel.constants import GZIP, SNAPPY, LZ4, ZSTD
+from kiel.compression import gzip, snappy, lz4, zstd
+
+from .primitives import compiled_struct
+
+
+#: Magic byte value of the v2 "record batch" format
+BATCH_MAGIC = 2
+
+# v2 batches start with the same offset and size as the older message sets,
+# followed by the leader epoch and the magic byte
+batch_header_struct = compiled_struct("qiib")
+# the CRC32C covers everything after itself, to the end of the batch
+batch_crc_struct = compiled_struct("I")
+# the rest of the batch header, ending with the count of records
+batch_fields_struct = compiled_struct("hiqqqhii")
+
+#: Size of the full batch header, records follow immediately after
+BATCH_HEADER_SIZE = (
+    batch_header_struct.size + batch_crc_struct.size + batch_fields_struct.size
+)
+#: Offset from the start of a batch of the part covered by the CRC
+CRC_START = batch_header_struct.size + batch_crc_struct.size
+
+# the lowest 3 bits of a batch's attributes denote compression
+COMPRESSION_MASK = 0b00000111
+# batches holding transaction markers rather than actual records
+CONTROL_FLAG = 0b00100000
+
+# precomputed encodings of varints small enough to fit in one byte
+single_byte_varints = dict(
+    (value, six.int2byte((value << 1) ^ (value >> 63)))
+    for value in range(-64, 64)
+)
+
+
+class Record(object):
+    """
+    A single record from a v2 record batch.
+
+    Exposes the same ``key`` and ``value`` attributes as ``Message`` so the
+    two can be used interchangeably by clients, along with the absolute
+    ``timestamp`` and list of (<key>, <value>) ``headers``.
+    """
+    __slots__ = ("attributes", "timestamp", "key", "value", "headers")
+
+    def __init__(
+            self, attributes=0, timestamp=None, key=None, value=None,
+            headers=None
+    ):
+        self.attributes = attributes
+        self.timestamp = timestamp
+        self.key = key
+        self.value = value
+        self.headers = headers or []
+
+    def __eq__(self, other):
+        """
+        Tests equivalency of two records by comparing the ``key`` and
+        ``value``, same as ``Message``.
+        """
+        return self.key == other.key and self.value == other.value
+
+    def __repr__(self):
+        return "%s => %s" % (self.key, self.value)
+
+
+def crc32c(data):
+    """
+    Returns the CRC32C (Castagnoli) checksum of the given bytes.
+
+    Uses the ``crc32c`` module if installed, otherwise falls back to a much
+    slower table-based pure python implementation.
+    """
+    if crc32c_available:
+        return crc32c_module.crc32c(data)
+
+    crc = 0xffffffff
+    for byte in bytearray(data):
+        crc = crc32c_table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+
+    return crc ^ 0xffffffff
+
+
+def make_crc32c_table():
+    """
+    Builds the lookup table for the pure python `crc32c()` fallback.
+    """
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x82f63b78
+            else:
+                crc >>= 1
+        table.append(crc)
+
+    return table
+
+
+crc32c_table = make_crc32c_table()
+
+
+def encode_varint(value):
+    """
+    Returns the zigzag varint encoding of an integer as a byte string.
+
+    This is the same variable-length encoding protocol buffers use, where
+    small absolute values (positive or negative) take up fewer bytes.
+    """
+    if -64 <= value < 64:
+        return single_byte_varints[value]
+
+    value = (value << 1) ^ (value >> 63)
+
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+    return bytes(out)
+
+
+def decode_varint(buff, offset):
+    """
+    Given a buffer and offset, returns the decoded zigzag varint and offset.
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = six.indexbytes(buff, offset)
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+
+    return (result >> 1) ^ -(result & 1), offset
+
+
+def decode_bytes(buff, offset):
+    """
+    Decodes a varint size-prefixed byte string, returning it and the offset.
+
+    Same as with ``Bytes`` parts, ``memoryview`` buffers give ``memoryview``
+    slices, otherwise the value is decoded as UTF-8 where possible.
+    """
+    size, offset = decode_varint(buff, offset)
+    if size == -1:
+        return None, offset
+
+    end = offset + size
+    if end > len(buff):
+        raise struct.error("buffer too short for %d bytes" % size)
+
+    value = buff[offset:end]
+    if isinstance(value, memoryview):
+        return value, end
+
+    try:
+        value = value.decode("utf-8")
+    except UnicodeDecodeError:
+        if isinstance(value, bytearray):
+            value = bytes(value)
+
+    return value, end
+
+
+def encoded_bytes(value):
+    """
+    Returns a list of chunks encoding a varint size-prefixed byte string.
+    """
+    if value is None:
+        return [single_byte_varints[-1]]
+
+    if not isinstance(value, (bytes, bytearray, memoryview)):
+        if not isinstance(value, six.string_types):
+            value = str(value)
+        value = value.encode("utf-8")
+
+    return [encode_varint(len(value)), value]
+
+
+def encode_record(out, offset_delta, timestamp_delta, key, value, headers=()):
+    """
+    Writes a single record (prefixed with its varint length) to ``out``.
+    """
+    chunks = [
+        b"\x00",  # attributes, unused
+        encode_varint(timestamp_delta),
+        encode_varint(offset_delta),
+    ]
+    chunks.extend(encoded_bytes(key))
+    chunks.extend(encoded_bytes(value))
+    chunks.append(encode_varint(len(headers)))
+    for header_key, header_value in headers:
+        chunks.extend(encoded_bytes(header_key))
+        chunks.extend(encoded_bytes(header_value))
+
+    out.write(encode_varint(sum([len(chunk) for chunk in chunks])))
+    for chunk in chunks:
+        out.write(chunk)
+
+
+def decode_record(buff, offset, base_offset, base_timestamp):
+    """
+    Decodes a single record, returning the absolute offset and `Record`.
+    """
+    _, offset = decode_varint(buff, offset)  # record length
+    attributes = six.indexbytes(buff, offset)
+    offset += 1
+    timestamp_delta, offset = decode_varint(buff, offset)
+    offset_delta, offset = decode_varint(buff, offset)
+    key, offset = decode_bytes(buff, offset)
+    value, offset = decode_bytes(buff, offset)
+
+    header_count, offset = decode_varint(buff, offset)
+    headers = []
+    for _ in range(header_count):
+        header_key, offset = decode_bytes(buff, offset)
+        header_value, offset = decode_bytes(buff, offset)
+        headers.append((header_key, header_value))
+
+    record = Record(
+        attributes=attributes,
+        timestamp=base_timestamp + timestamp_delta,
+        key=key,
+        value=value,
+        headers=headers,
+    )
+
+    return base_offset + offset_delta, record, offset
+
+
+def compress(compression, data, magic=BATCH_MAGIC, level=None):
+    """
+    Compresses the records portion of a batch with the given scheme.
+
+    The ``magic`` value is that of the message format the data is for, as
+    v0 messages get LZ4 frames with the legacy header checksum and zstd is
+    only allowed for v2 record batches.
+
+    The ``level`` is handed to the codec as-is (snappy has none), ``None``
+    means the codec's default.
+    """
+    if compression == GZIP:
+        return gzip.compress(data, level=level)
+    elif compression == SNAPPY:
+        return snappy.compress(data)
+    elif compression == LZ4:
+        return lz4.compress(data, legacy=(magic == 0), level=level)
+    elif compression == ZSTD:
+        if magic != BATCH_MAGIC:
+            raise ValueError("Zstd compression requires v2 record batches")
+        return zstd.compress(data, level=level)
+
+    raise ValueError("Unsupported compression value %s" % compression)
+
+
+def decompress(compression, data):
+    """
+    Decompresses the records portion of a batch with the given scheme.
+    """
+    if compression == GZIP:
+        return gzip.decompress(data)
+    elif compression == SNAPPY:
+        return snappy.decompress(data)
+    elif compression == LZ4:
+        return lz4.decompress(data)
+    elif compression == ZSTD:
+        return zstd.decompress(data)
+
+    raise ValueError("Unsupported compression value %s" % compression)
+
+
+def iterate_batch(buff, offset, end, min_offset=None):
+    """
+    Yields (<offset>, `Record`) tuples from the v2 batch at ``offset``.
+
+    The ``end`` is that of the batch itself.  If the last offset in the batch
+    is below ``min_offset`` its records aren't decoded (or decompressed) at
+    all, otherwise just the records with lower offsets are skipped.  Control
+    batches (transaction markers) are skipped entirely.
+
+    The CRC is not verified, same as with older message formats.
+    """
+    base_offset = batch_header_struct.unpack_from(buff, offset)[0]
+    (
+        attributes, last_offset_delta, base_timestamp, _, _, _, _, count
+    ) = batch_fields_struct.unpack_from(buff, offset + CRC_START)
+
+    if min_offset is not None and base_offset + last_offset_delta < min_offset:
+        return
+    if attributes & CONTROL_FLAG:
+        return
+
+    offset += BATCH_HEADER_SIZE
+
+    compression = attributes & COMPRESSION_MASK
+    if compression:
+        records = decompress(compression, buff[offset:end])
+        if isinstance(buff, memoryview):
+            records = memoryview(records)
+        buff, offset, end = records, 0, len(records)
+
+    for _ in range(count):
+        record_offset, record, offset = decode_record(
+            buff, offset, base_offset, base_timestamp
+        )
+        if min_offset is None or record_offset >= min_offset:
+            yield record_offset, record
+
+
+def timestamp_millis():
+    """
+    Returns the current time as milliseconds since the epoch.
+    """
+    return int(time.time() * 1000)
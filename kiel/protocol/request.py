@@ -2,13 +2,12 @@ import binascii
 import hashlib
 import os
 import socket
-import struct
-
-from six import BytesIO
 
 from kiel.constants import CLIENT_ID, API_VERSION, API_KEYS
 
 from .part import Part
+from .buffers import WriteBuffer
+from .codec import compile_encoder
 from .primitives import Int16, Int32, String
 
 
@@ -40,21 +39,40 @@ class Request(Part):
 
     A specialized subclass of ``Part`` with attributes for correlating
     responses and prefacing payloads with client/api metadata.
+
+    The ``version`` class attribute is the api version the request's parts
+    correspond to, subclasses for newer versions of an api override it.
     """
+    __slots__ = ("client_id", "api_key", "api_version", "correlation_id")
+
     api = None
+    version = API_VERSION
 
     def __init__(self, **kwargs):
         super(Request, self).__init__(**kwargs)
 
         self.client_id = CLIENT_ID
         self.api_key = API_KEYS[self.api]
-        self.api_version = API_VERSION
+        self.api_version = self.version
         self.correlation_id = generate_correlation_id()
 
     def serialize(self):
         """
         Returns a bytesring representation of the request instance.
 
+        A convenience wrapper around `write()` with a fresh buffer, for
+        sending use `write()` directly so the buffer can be reused.
+        """
+        out = WriteBuffer()
+
+        self.write(out)
+
+        return out.getvalue()
+
+    def write(self, out):
+        """
+        Writes the full request to the given ``out`` `WriteBuffer`.
+
         Prefaces the output with certain information::
 
           api_key => Int16
@@ -62,25 +80,16 @@ class Request(Part):
           correlation_id => Int32
           client_id => String
 
-        Since this is a ``Part`` subclass the rest is a matter of
-        appending the result of a ``render()`` call.
+        Since this is a ``Part`` subclass the rest is a matter of an
+        ``encode()`` call.
         """
-        buff = BytesIO()
-
-        preamble_parts = (
-            ("api_key", Int16),
-            ("api_version", Int16),
-            ("correlation_id", Int32),
-            ("client_id", String),
-        )
-
-        preamble_format, data = self.render(preamble_parts)
-
-        payload_format, payload_data = self.render()
-
-        fmt = "".join(["!", preamble_format, payload_format])
-        data.extend(payload_data)
+        encode_preamble(self, out)
+        self.encode(out)
 
-        buff.write(struct.pack(fmt, *data))
 
-        return buff.getvalue()
+encode_preamble = compile_encoder((
+    ("api_key", Int16),
+    ("api_version", Int16),
+    ("correlation_id", Int32),
+    ("client_id", String),
+))
@@ -6,8 +6,11 @@ class Response(Part):
     Base class for all api response classes.
 
     A simple class, has only an ``api`` attribute expected to be defined by
-    subclasses, and a `deserialize()` classmethod.
+    subclasses, and a `deserialize()` classmethod.  The ``correlation_id``
+    attribute is set by the connection that received the response.
     """
+    __slots__ = ("correlation_id",)
+
     api = None
 
     @classmethod
@@ -14,14 +14,23 @@ setup(
     keywords=["kafka", "tornado", "async"],
     packages=find_packages(exclude=["tests", "tests.*"]),
     install_requires=[
-        "tornado>=4.1",
+        "tornado>=4.5",
         "kazoo",
         "six",
     ],
     extras_require={
         "snappy": [
             "python-snappy"
-        ]
+        ],
+        "crc32c": [
+            "crc32c"
+        ],
+        "lz4": [
+            "lz4"
+        ],
+        "zstd": [
+            "zstandard"
+        ],
     },
     tests_require=[
         "nose",
@@ -2,7 +2,7 @@ import collections
 
 import six
 from tornado import gen
-from mock import patch, Mock
+from mock import patch, Mock, PropertyMock
 
 from .async import AsyncTestCase
 
@@ -25,6 +25,9 @@ class ClientTestCase(AsyncTestCase):
         cluster = MockCluster.return_value
         cluster.topics = collections.defaultdict(list)
         cluster.leaders = collections.defaultdict(dict)
+        type(cluster).brokers = PropertyMock(
+            side_effect=lambda: self.mock_brokers
+        )
 
         def check_known_broker(broker_id):
             return broker_id in self.mock_brokers
@@ -36,13 +39,24 @@ class ClientTestCase(AsyncTestCase):
 
         cluster.__getitem__.side_effect = get_mock_broker
 
+        def get_broker_connection(broker_id, api):
+            return self.mock_brokers[broker_id]
+
+        cluster.connection.side_effect = get_broker_connection
+
+        @gen.coroutine
+        def ensure_connections(broker_ids):
+            pass
+
+        cluster.ensure_connections.side_effect = ensure_connections
+
         def iterate_broker_ids():
             return iter(self.mock_brokers)
 
         cluster.__iter__.side_effect = iterate_broker_ids
 
         def get_leader(topic, partition):
-            return cluster.leaders[topic][partition]
+            return cluster.leaders[topic].get(partition)
 
         cluster.get_leader.side_effect = get_leader
 
@@ -59,8 +73,9 @@ class ClientTestCase(AsyncTestCase):
         cluster.heal.side_effect = refresh_metadata
         cluster.stop.return_value = self.future_value(None)
 
-    def add_broker(self, host, port, broker_id):
+    def add_broker(self, host, port, broker_id, api_versions=None):
         broker = Mock()
+        api_versions = api_versions or {}
 
         @gen.coroutine
         def mock_send(request):
@@ -73,6 +88,14 @@ class ClientTestCase(AsyncTestCase):
 
         broker.send.side_effect = mock_send
 
+        def get_api_version(api, max_version=None):
+            version = api_versions.get(api, 0)
+            if max_version is not None:
+                version = min(version, max_version)
+            return version
+
+        broker.api_version.side_effect = get_api_version
+
         self.mock_brokers[broker_id] = broker
 
     def add_topic(self, topic_name, leaders):
@@ -74,6 +74,41 @@ class ClientTests(cases.ClientTestCase):
 
         self.assertEqual(results, {})
 
+    @testing.gen_test
+    def test_send_request_timeout(self):
+        self.set_responses(
+            broker_id=1, api="metadata",
+            responses=[
+                exc.RequestTimeoutError("kafka01", 1234, "metadata")
+            ]
+        )
+
+        c = client.Client(["kafka01", "kafka02"])
+
+        results = yield c.send({1: Mock(api="metadata")})
+
+        c.cluster.heal.assert_called_once_with()
+
+        self.assertEqual(results, {})
+
+    @testing.gen_test
+    def test_send_request_timeout_handled(self):
+        self.set_responses(
+            broker_id=1, api="metadata",
+            responses=[
+                exc.RequestTimeoutError("kafka01", 1234, "metadata")
+            ]
+        )
+
+        c = client.Client(["kafka01", "kafka02"])
+        c.handle_metadata_timeout = Mock()
+
+        request = Mock(api="metadata")
+
+        yield c.send({1: request})
+
+        c.handle_metadata_timeout.assert_called_once_with(request)
+
     @testing.gen_test
     def test_send_stream_closed(self):
         self.set_responses(
@@ -176,6 +211,9 @@ class ClientTests(cases.ClientTestCase):
         self.assert_sent(1, request1)
         self.assert_sent(8, request2)
 
+        c.cluster.connection.assert_any_call(1, "fetch")
+        c.cluster.connection.assert_any_call(8, "group_coordinator")
+
         c.handle_group_coordinator_response.assert_called_once_with(
             metadata_response
         )
@@ -1,9 +1,55 @@
+import struct
+import unittest
+
 from tests import cases
 
+from mock import Mock
 from tornado import testing, gen
 
+from kiel import exc
 from kiel.protocol import fetch, messages, errors
-from kiel.clients import consumer
+from kiel.protocol.buffers import WriteBuffer
+from kiel.clients import client, consumer
+
+
+def record_batch(*values):
+    builder = messages.RecordBatchBuilder()
+    builder.extend([
+        messages.Message(key=None, value=value) for value in values
+    ])
+    out = WriteBuffer()
+    builder.build().encode(out)
+    # the broker assigns the base offset, after the set's size
+    struct.pack_into("!q", out.data, 4, 0)
+    message_set, _ = messages.MessageSet.parse(out.getvalue(), 0)
+
+    return message_set
+
+
+def session_response(session_id, error_code=0, partitions=()):
+    topics = []
+    if partitions:
+        topics.append(
+            fetch.TopicV7Response(name="test.topic", partitions=[
+                fetch.PartitionV7Response(
+                    partition_id=partition_id,
+                    error_code=errors.no_error,
+                    highwater_mark_offset=2,
+                    last_stable_offset=2,
+                    log_start_offset=0,
+                    aborted_transactions=[],
+                    message_set=message_set,
+                )
+                for partition_id, message_set in partitions
+            ])
+        )
+
+    return fetch.FetchV7Response(
+        throttle_time=0,
+        error_code=error_code,
+        session_id=session_id,
+        topics=topics,
+    )
 
 
 class FakeConsumer(consumer.BaseConsumer):
@@ -38,6 +84,18 @@ class ConsumerTests(cases.ClientTestCase):
         self.assertEqual(c.min_bytes, 1)
         self.assertEqual(c.max_bytes, (1024 * 1024))
 
+    def test_connection_and_cluster_options_passed_to_cluster(self):
+        consumer.BaseConsumer(
+            ["kafka01"], zero_copy=True,
+            connection_options={"coalesce_threshold": 0, "zero_copy": False},
+            cluster_options={"bootstrap_stagger": 100},
+        )
+
+        args, kwargs = client.Cluster.call_args
+        self.assertEqual(args[1]["coalesce_threshold"], 0)
+        self.assertEqual(args[1]["zero_copy"], True)
+        self.assertEqual(kwargs["bootstrap_stagger"], 100)
+
     def test_allocation_must_be_defined(self):
         c = consumer.BaseConsumer(["kafka01", "kafka02"])
 
@@ -342,6 +400,163 @@ class ConsumerTests(cases.ClientTestCase):
             )
         )
 
+    @testing.gen_test
+    def test_values_decompressed_with_dictionaries(self):
+        self.add_topic("test.topic", leaders=(3,))
+        self.set_responses(
+            broker_id=3, api="fetch",
+            responses=[
+                fetch.FetchResponse(
+                    topics=[
+                        fetch.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                fetch.PartitionResponse(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    highwater_mark_offset=1,
+                                    message_set=messages.MessageSet(
+                                        messages=[
+                                            (
+                                                0,
+                                                messages.Message(
+                                                    magic=0, attributes=0,
+                                                    key=None,
+                                                    value="compressed",
+                                                )
+                                            ),
+                                        ]
+                                    )
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        dictionaries = Mock()
+        dictionaries.decompress.return_value = '{"foo": "bar"}'
+
+        c = FakeConsumer(["kafka01"], dictionaries=dictionaries)
+
+        yield c.connect()
+
+        msgs = yield c.consume("test.topic")
+
+        self.assertEqual(msgs, [{"foo": "bar"}])
+        dictionaries.decompress.assert_called_once_with("compressed")
+
+    @testing.gen_test
+    def test_decoding_error_skips_partition(self):
+        self.add_topic("test.topic", leaders=(3, 3))
+
+        corrupt = Mock()
+        corrupt.iterate.side_effect = ValueError("Unsupported compression")
+
+        self.set_responses(
+            broker_id=3, api="fetch",
+            responses=[
+                fetch.FetchResponse(
+                    topics=[
+                        fetch.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                fetch.PartitionResponse(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    highwater_mark_offset=1,
+                                    message_set=corrupt,
+                                ),
+                                fetch.PartitionResponse(
+                                    partition_id=1,
+                                    error_code=errors.no_error,
+                                    highwater_mark_offset=1,
+                                    message_set=messages.MessageSet(
+                                        messages=[
+                                            (
+                                                0,
+                                                messages.Message(
+                                                    magic=0, attributes=0,
+                                                    key=None,
+                                                    value='{"foo": "bar"}',
+                                                )
+                                            ),
+                                        ]
+                                    )
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        c = FakeConsumer(["kafka01"])
+
+        yield c.connect()
+
+        msgs = yield c.consume("test.topic")
+
+        self.assertEqual(msgs, [{"foo": "bar"}])
+        self.assertEqual(c.offsets["test.topic"], {0: 0, 1: 1})
+
+    @testing.gen_test
+    def test_fetch_version_negotiated_with_broker(self):
+        self.add_broker("kafka02", 9002, broker_id=3, api_versions={
+            "fetch": 4,
+        })
+        self.add_topic("test.topic", leaders=(3,))
+
+        builder = messages.RecordBatchBuilder()
+        builder.extend([
+            messages.Message(key=None, value='{"cat": "dog"}'),
+            messages.Message(key=None, value='{"cat": "meow"}'),
+        ])
+        out = WriteBuffer()
+        builder.build().encode(out)
+        # the broker assigns the base offset, after the set's size
+        struct.pack_into("!q", out.data, 4, 0)
+        message_set, _ = messages.MessageSet.parse(out.getvalue(), 0)
+
+        self.set_responses(
+            broker_id=3, api="fetch",
+            responses=[
+                fetch.FetchV4Response(
+                    throttle_time=0,
+                    topics=[
+                        fetch.TopicV4Response(
+                            name="test.topic",
+                            partitions=[
+                                fetch.PartitionV4Response(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    highwater_mark_offset=2,
+                                    last_stable_offset=2,
+                                    aborted_transactions=[],
+                                    message_set=message_set,
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        c = FakeConsumer(["kafka01"], max_bytes=1000)
+
+        yield c.connect()
+
+        msgs = yield c.consume("test.topic")
+
+        self.assertEqual(msgs, [{"cat": "dog"}, {"cat": "meow"}])
+        self.assertEqual(c.offsets["test.topic"][0], 2)
+
+        request = self.requests_by_broker[3][0]
+        self.assertIsInstance(request, fetch.FetchV4Request)
+        self.assertEqual(request.api_version, 4)
+        self.assertEqual(request.max_bytes, 1000)
+
     @testing.gen_test
     def test_consuming_when_closed_is_noop(self):
         self.add_topic("test.topic", leaders=(3,))
@@ -712,3 +927,195 @@ class ConsumerTests(cases.ClientTestCase):
                 ]
             )
         )
+
+    @testing.gen_test
+    def test_fetch_sessions_send_only_changed_partitions(self):
+        self.add_broker("kafka02", 9002, broker_id=3, api_versions={
+            "fetch": 7,
+        })
+        self.add_topic("test.topic", leaders=(3, 3))
+
+        self.set_responses(
+            broker_id=3, api="fetch",
+            responses=[
+                session_response(99, partitions=[
+                    (0, record_batch('{"cat": "dog"}', '{"cat": "meow"}')),
+                    (1, messages.MessageSet([])),
+                ]),
+                session_response(99),
+                session_response(
+                    99, error_code=errors.invalid_fetch_session_epoch
+                ),
+                session_response(100),
+            ]
+        )
+
+        c = FakeConsumer(["kafka01"])
+
+        yield c.connect()
+
+        msgs = yield c.consume("test.topic")
+        self.assertEqual(msgs, [{"cat": "dog"}, {"cat": "meow"}])
+
+        msgs = yield c.consume("test.topic")
+        self.assertEqual(msgs, [])
+
+        msgs = yield c.consume("test.topic")
+        self.assertEqual(msgs, [])
+
+        msgs = yield c.consume("test.topic")
+        self.assertEqual(msgs, [])
+
+        full, incremental, stale, fresh = self.requests_by_broker[3]
+
+        self.assertIsInstance(full, fetch.FetchV7Request)
+        self.assertEqual(full.api_version, 7)
+        self.assertEqual((full.session_id, full.session_epoch), (0, 0))
+        self.assertEqual(
+            [(p.partition_id, p.offset) for p in full.topics[0].partitions],
+            [(0, 0), (1, 0)]
+        )
+
+        self.assertEqual(
+            (incremental.session_id, incremental.session_epoch), (99, 1)
+        )
+        self.assertEqual(
+            [
+                (p.partition_id, p.offset)
+                for p in incremental.topics[0].partitions
+            ],
+            [(0, 2)]
+        )
+
+        self.assertEqual((stale.session_id, stale.session_epoch), (99, 2))
+        self.assertEqual(stale.topics, [])
+
+        self.assertEqual((fresh.session_id, fresh.session_epoch), (0, 0))
+        self.assertEqual(len(fresh.topics[0].partitions), 2)
+
+        session = c.fetch_sessions[(3, "test.topic")]
+        self.assertEqual((session.session_id, session.epoch), (100, 1))
+        self.assertEqual(c.session_requests, {})
+
+    @testing.gen_test
+    def test_fetch_v10_partitions_carry_leader_epoch(self):
+        self.add_broker("kafka02", 9002, broker_id=3, api_versions={
+            "fetch": 10,
+        })
+        self.add_topic("test.topic", leaders=(3,))
+
+        self.set_responses(
+            broker_id=3, api="fetch",
+            responses=[
+                session_response(99, partitions=[
+                    (0, record_batch('{"cat": "dog"}')),
+                ]),
+            ]
+        )
+
+        c = FakeConsumer(["kafka01"])
+
+        yield c.connect()
+
+        msgs = yield c.consume("test.topic")
+        self.assertEqual(msgs, [{"cat": "dog"}])
+
+        request = self.requests_by_broker[3][0]
+
+        self.assertIsInstance(request, fetch.FetchV10Request)
+        self.assertIsInstance(request.topics[0], fetch.TopicV9Request)
+        self.assertEqual(
+            [
+                (p.partition_id, p.current_leader_epoch, p.offset)
+                for p in request.topics[0].partitions
+            ],
+            [(0, -1, 0)]
+        )
+
+    @testing.gen_test
+    def test_fetch_session_reset_on_connection_error(self):
+        self.add_broker("kafka02", 9002, broker_id=3, api_versions={
+            "fetch": 7,
+        })
+        self.add_topic("test.topic", leaders=(3,))
+
+        self.set_responses(
+            broker_id=3, api="fetch",
+            responses=[
+                session_response(99),
+                exc.BrokerConnectionError("kafka02", 9002),
+                session_response(99),
+            ]
+        )
+
+        c = FakeConsumer(["kafka01"])
+
+        yield c.connect()
+
+        yield c.consume("test.topic")
+        session = c.fetch_sessions[(3, "test.topic")]
+        self.assertEqual(session.epoch, 1)
+
+        yield c.consume("test.topic")
+        self.assertEqual((session.session_id, session.epoch), (0, 0))
+
+        yield c.consume("test.topic")
+        self.assertEqual(
+            self.requests_by_broker[3][2].session_epoch, 0
+        )
+
+
+class FetchSessionTests(unittest.TestCase):
+
+    def test_first_request_is_full(self):
+        session = consumer.FetchSession()
+
+        changed, forgotten = session.prepare({0: (10, 100), 1: (20, 100)})
+
+        self.assertEqual(changed, {0: (10, 100), 1: (20, 100)})
+        self.assertEqual(forgotten, [])
+
+    def test_incremental_request_sends_changes_and_forgotten(self):
+        session = consumer.FetchSession()
+        session.prepare({0: (10, 100), 1: (20, 100), 2: (30, 100)})
+        session.handle_response(session_response(5))
+
+        changed, forgotten = session.prepare({0: (10, 100), 1: (25, 100)})
+
+        self.assertEqual(changed, {1: (25, 100)})
+        self.assertEqual(forgotten, [2])
+
+    def test_declined_session_stays_full(self):
+        session = consumer.FetchSession()
+        session.prepare({0: (10, 100)})
+
+        self.assertEqual(session.handle_response(session_response(0)), True)
+
+        changed, _ = session.prepare({0: (10, 100)})
+
+        self.assertEqual(changed, {0: (10, 100)})
+        self.assertEqual(session.epoch, 0)
+
+    def test_session_error_resets(self):
+        session = consumer.FetchSession()
+        session.prepare({0: (10, 100)})
+        session.handle_response(session_response(5))
+        session.prepare({0: (10, 100)})
+
+        ok = session.handle_response(
+            session_response(5, error_code=errors.fetch_session_id_not_found)
+        )
+
+        self.assertEqual(ok, False)
+        self.assertEqual((session.session_id, session.epoch), (0, 0))
+        self.assertEqual(session.partitions, {})
+
+    def test_epoch_wraps_around(self):
+        session = consumer.FetchSession()
+        session.session_id = 5
+        session.epoch = consumer.MAX_FETCH_EPOCH
+        session.prepare({})
+
+        session.handle_response(session_response(5))
+
+        self.assertEqual(session.epoch, 1)
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
+import struct
+import unittest
 
 from tests import cases
 
-from mock import patch
-from tornado import testing
+from mock import patch, Mock
+from tornado import testing, concurrent, gen
 
-from kiel import constants
-from kiel.protocol import produce, messages, errors
-from kiel.clients import producer
+from kiel import constants, exc
+from kiel.compression import zstd
+from kiel.protocol import produce, messages, records, errors
+from kiel.protocol.buffers import WriteBuffer
+from kiel.clients import client, producer
 
 
 def attribute_key(msg):
@@ -35,6 +39,20 @@ class ProducerTests(cases.ClientTestCase):
         self.assertEqual(p.ack_timeout, 500)
         self.assertEqual(p.compression, None)
 
+    def test_connection_and_cluster_options_passed_to_cluster(self):
+        producer.Producer(
+            ["kafka01"],
+            connection_options={"max_in_flight": 5, "request_timeout": 100},
+            cluster_options={"connect_timeout": 200, "heal_backoff": 50},
+        )
+
+        args, kwargs = client.Cluster.call_args
+        self.assertEqual(
+            args[1], {"max_in_flight": 5, "request_timeout": 100}
+        )
+        self.assertEqual(kwargs["connect_timeout"], 200)
+        self.assertEqual(kwargs["heal_backoff"], 50)
+
     def test_unknown_compression(self):
         self.assertRaises(
             ValueError,
@@ -501,6 +519,134 @@ class ProducerTests(cases.ClientTestCase):
             )
         )
 
+    @testing.gen_test
+    def test_compression_level_handed_to_codec(self):
+        self.add_topic("test.topic", leaders=(1,))
+
+        self.set_responses(
+            broker_id=1, api="produce",
+            responses=[
+                produce.ProduceResponse(
+                    topics=[
+                        produce.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                produce.PartitionResponse(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    offset=8003,
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        p = producer.Producer(
+            ["kafka01"], compression=constants.GZIP, compression_level=1
+        )
+
+        with patch.object(records.gzip, "compress") as compress:
+            compress.return_value = b"compressed"
+            yield p.produce("test.topic", "foo")
+
+        _, kwargs = compress.call_args
+        self.assertEqual(kwargs, {"level": 1})
+
+    def produce_responses(self, count, broker_id=1):
+        self.set_responses(
+            broker_id=broker_id, api="produce",
+            responses=[
+                produce.ProduceResponse(
+                    topics=[
+                        produce.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                produce.PartitionResponse(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    offset=8003,
+                                ),
+                            ]
+                        ),
+                    ]
+                )
+                for _ in range(count)
+            ]
+        )
+
+    @testing.gen_test
+    def test_small_batches_sent_uncompressed(self):
+        self.add_topic("test.topic", leaders=(1,))
+        self.produce_responses(2)
+
+        p = producer.Producer(
+            ["kafka01"], compression=constants.GZIP, compression_threshold=100
+        )
+
+        yield p.produce("test.topic", "foo")
+        yield p.produce("test.topic", "foo" * 100)
+
+        small, large = [
+            request.topics[0].partitions[0].message_set
+            for request in self.requests_by_broker[1]
+        ]
+
+        self.assertEqual(small.messages[0][1].attributes, 0)
+        self.assertEqual(large.messages[0][1].attributes, constants.GZIP)
+
+    @testing.gen_test
+    def test_poorly_compressing_topics_sent_uncompressed(self):
+        self.add_topic("test.topic", leaders=(1,))
+        self.produce_responses(producer.PROBE_INTERVAL + 1)
+
+        p = producer.Producer(
+            ["kafka01"], compression=constants.GZIP, max_compression_ratio=0.9
+        )
+
+        # a lone short message doesn't compress at all
+        for _ in range(producer.PROBE_INTERVAL + 1):
+            yield p.produce("test.topic", "foo")
+
+        attributes = [
+            request.topics[0].partitions[0].message_set.messages[0][1]
+            .attributes
+            for request in self.requests_by_broker[1]
+        ]
+
+        self.assertGreater(
+            p.compression_ratios.ratios[("test.topic", constants.GZIP)], 0.9
+        )
+        self.assertEqual(
+            attributes,
+            [constants.GZIP] +
+            [0] * (producer.PROBE_INTERVAL - 1) +
+            [constants.GZIP]
+        )
+
+    @testing.gen_test
+    def test_compression_ratios_consulted_once_per_flush(self):
+        self.add_topic("test.topic", leaders=(1, 3))
+        self.produce_responses(1)
+        self.produce_responses(1, broker_id=3)
+
+        p = producer.Producer(
+            ["kafka01"], key_maker=attribute_key,
+            partitioner=key_partitioner, batch_size=2,
+            compression=constants.GZIP, max_compression_ratio=0.9
+        )
+        p.compression_ratios.ratios[("test.topic", constants.GZIP)] = 1.0
+
+        yield p.produce("test.topic", {"key": 0, "value": "foo"})
+        yield p.produce("test.topic", {"key": 1, "value": "bar"})
+
+        self.assertEqual(len(self.requests_by_broker[1]), 1)
+        self.assertEqual(len(self.requests_by_broker[3]), 1)
+        self.assertEqual(
+            p.compression_ratios.skipped[("test.topic", constants.GZIP)], 1
+        )
+
     @testing.gen_test
     def test_close_flushes_unsent_stuff(self):
         self.add_topic("test.topic", leaders=(1,))
@@ -567,6 +713,172 @@ class ProducerTests(cases.ClientTestCase):
             )
         )
 
+    @testing.gen_test
+    def test_messages_are_encoded_per_partition_when_produced(self):
+        self.add_topic("test.topic", leaders=(1, 3))
+
+        p = producer.Producer(
+            ["kafka01"], batch_size=3,
+            key_maker=attribute_key, partitioner=key_partitioner
+        )
+
+        yield p.produce("test.topic", {"key": 0, "msg": "foo"})
+        yield p.produce("test.topic", {"key": 1, "msg": "bar"})
+
+        self.assertEqual(p.unsent_count, 2)
+        self.assertEqual(
+            [
+                (partition_id, len(builder))
+                for partition_id, builder
+                in sorted(p.unsent["test.topic"].items())
+            ],
+            [(0, 1), (1, 1)]
+        )
+        self.assertEqual(self.requests_by_broker[1], [])
+
+    @testing.gen_test
+    def test_values_compressed_with_topic_dictionaries(self):
+        self.add_topic("test.topic", leaders=(1,))
+
+        dictionaries = Mock()
+        dictionaries.compress.return_value = b"compressed"
+
+        p = producer.Producer(
+            ["kafka01"], batch_size=2, dictionaries=dictionaries
+        )
+
+        yield p.produce("test.topic", {"foo": "bar"})
+
+        dictionaries.compress.assert_called_once_with(
+            "test.topic", '{"foo": "bar"}'
+        )
+        self.assertEqual(
+            [msg.value for msg in p.unsent["test.topic"][0].messages],
+            [b"compressed"]
+        )
+
+    def test_dictionaries_not_allowed_with_executor(self):
+        self.assertRaises(
+            ValueError,
+            producer.Producer,
+            ["kafka01"], executor=Mock(), dictionaries=Mock()
+        )
+
+    @testing.gen_test
+    def test_leader_connected_before_picking_message_format(self):
+        self.add_topic("test.topic", leaders=(1,))
+        del self.mock_brokers[1]
+
+        p = producer.Producer(["kafka01"], batch_size=10)
+        yield p.connect()
+
+        @gen.coroutine
+        def ensure_connections(broker_ids):
+            self.add_broker("kafka01", 9002, broker_id=1, api_versions={
+                "produce": 2,
+            })
+
+        p.cluster.ensure_connections.side_effect = ensure_connections
+
+        yield p.produce("test.topic", "foo")
+
+        p.cluster.ensure_connections.assert_called_once_with([1])
+        self.assertEqual(p.unsent["test.topic"][0].magic, 1)
+
+    @unittest.skipUnless(records.crc32c_available, "requires crc32c")
+    @testing.gen_test
+    def test_produce_version_negotiated_with_broker(self):
+        self.add_broker("kafka01", 9002, broker_id=1, api_versions={
+            "produce": 3,
+        })
+        self.add_broker("kafka02", 9002, broker_id=3, api_versions={
+            "produce": 2,
+        })
+        self.add_topic("test.topic", leaders=(1, 3))
+
+        for broker_id, partition_id in ((1, 0), (3, 1)):
+            self.set_responses(
+                broker_id=broker_id, api="produce",
+                responses=[
+                    produce.ProduceV2Response(
+                        topics=[
+                            produce.TopicV2Response(
+                                name="test.topic",
+                                partitions=[
+                                    produce.PartitionV2Response(
+                                        partition_id=partition_id,
+                                        error_code=errors.no_error,
+                                        offset=8000,
+                                        timestamp=-1,
+                                    ),
+                                ]
+                            ),
+                        ],
+                        throttle_time=0,
+                    ),
+                ]
+            )
+
+        p = producer.Producer(
+            ["kafka01"],
+            key_maker=attribute_key, partitioner=key_partitioner
+        )
+
+        yield p.produce("test.topic", {"key": 0, "msg": "foo"})
+        yield p.produce("test.topic", {"key": 1, "msg": "bar"})
+
+        request = self.requests_by_broker[1][0]
+        self.assertIsInstance(request, produce.ProduceV3Request)
+        message_set = request.topics[0].partitions[0].message_set
+        self.assertEqual(
+            bytearray(message_set.encoded)[16], messages.BATCH_MAGIC
+        )
+
+        request = self.requests_by_broker[3][0]
+        self.assertIsInstance(request, produce.ProduceV2Request)
+        message_set = request.topics[0].partitions[0].message_set
+        self.assertEqual(bytearray(message_set.encoded)[16], 1)
+
+        self.assertEqual(p.sent, {})
+
+    @patch.object(records, "crc32c_available", False)
+    @testing.gen_test
+    def test_record_batches_not_used_without_crc32c(self):
+        self.add_broker("kafka01", 9002, broker_id=1, api_versions={
+            "produce": 7,
+        })
+        self.add_topic("test.topic", leaders=(1,))
+        self.set_responses(
+            broker_id=1, api="produce",
+            responses=[
+                produce.ProduceV2Response(
+                    topics=[
+                        produce.TopicV2Response(
+                            name="test.topic",
+                            partitions=[
+                                produce.PartitionV2Response(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    offset=8000,
+                                    timestamp=-1,
+                                ),
+                            ]
+                        ),
+                    ],
+                    throttle_time=0,
+                ),
+            ]
+        )
+
+        p = producer.Producer(["kafka01"])
+
+        yield p.produce("test.topic", "foo")
+
+        request = self.requests_by_broker[1][0]
+        self.assertIsInstance(request, produce.ProduceV2Request)
+        message_set = request.topics[0].partitions[0].message_set
+        self.assertEqual(bytearray(message_set.encoded)[16], 1)
+
     @testing.gen_test
     def test_retriable_error_code(self):
         self.add_topic("test.topic", leaders=(1,))
@@ -645,6 +957,51 @@ class ProducerTests(cases.ClientTestCase):
             )
         )
 
+    @testing.gen_test
+    def test_timed_out_request_is_retried(self):
+        self.add_topic("test.topic", leaders=(1,))
+
+        self.set_responses(
+            broker_id=1, api="produce",
+            responses=[
+                exc.RequestTimeoutError("kafka01", 9002, "produce"),
+                produce.ProduceResponse(
+                    topics=[
+                        produce.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                produce.PartitionResponse(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    offset=8001,
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        p = producer.Producer(["kafka01"], batch_size=1)
+
+        yield p.produce("test.topic", "foo")
+
+        self.assertEqual(p.unsent_count, 1)
+        self.assertEqual(dict(p.sent), {})
+
+        yield p.produce("test.topic", "bar")
+
+        self.assertEqual(p.unsent_count, 0)
+        self.assertEqual(dict(p.sent), {})
+        self.assertEqual(
+            [
+                msg.value
+                for _, msg in self.requests_by_broker[1][1].topics[0]
+                .partitions[0].message_set.messages
+            ],
+            [p.serializer("foo"), p.serializer("bar")]
+        )
+
     @testing.gen_test
     def test_leader_not_present_at_first(self):
         self.add_topic("test.topic", leaders=(7,))
@@ -689,6 +1046,56 @@ class ProducerTests(cases.ClientTestCase):
             )
         )
 
+    @testing.gen_test
+    def test_partition_dropped_from_metadata_is_retried(self):
+        self.add_topic("test.topic", leaders=(1, 3))
+        self.set_responses(
+            broker_id=3, api="produce",
+            responses=[
+                produce.ProduceResponse(
+                    topics=[
+                        produce.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                produce.PartitionResponse(
+                                    partition_id=1,
+                                    error_code=errors.no_error,
+                                    offset=8000,
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        p = producer.Producer(
+            ["kafka01"], key_maker=attribute_key,
+            partitioner=key_partitioner, batch_size=2
+        )
+
+        yield p.connect()
+
+        yield p.produce("test.topic", {"key": 1, "value": "foo"})
+
+        # partition 1's leader is unavailable, so it's left out
+        self.add_topic("test.topic", leaders=(1,))
+        yield p.cluster.heal()
+
+        yield p.flush()
+
+        self.assertEqual(p.unsent_count, 1)
+        self.assertEqual(p.heal_cluster, False)
+        self.assertEqual(len(self.requests_by_broker[3]), 0)
+
+        self.add_topic("test.topic", leaders=(1, 3))
+        yield p.cluster.heal()
+
+        yield p.flush()
+
+        self.assertEqual(p.unsent_count, 0)
+        self.assertEqual(len(self.requests_by_broker[3]), 1)
+
     @testing.gen_test
     def test_producing_when_closed_never_sends(self):
         self.add_topic("test.topic", leaders=(1,))
@@ -784,3 +1191,337 @@ class ProducerTests(cases.ClientTestCase):
                 ]
             )
         )
+
+    @unittest.skipUnless(zstd.zstd_available, "requires zstandard")
+    @unittest.skipUnless(records.crc32c_available, "requires crc32c")
+    @testing.gen_test
+    def test_zstd_falls_back_to_gzip_for_older_brokers(self):
+        self.add_broker("kafka01", 9002, broker_id=1, api_versions={
+            "produce": 7,
+        })
+        self.add_broker("kafka02", 9002, broker_id=3, api_versions={
+            "produce": 3,
+        })
+        self.add_topic("test.topic", leaders=(1, 3))
+
+        for broker_id, partition_id in ((1, 0), (3, 1)):
+            self.set_responses(
+                broker_id=broker_id, api="produce",
+                responses=[
+                    produce.ProduceV2Response(
+                        topics=[
+                            produce.TopicV2Response(
+                                name="test.topic",
+                                partitions=[
+                                    produce.PartitionV2Response(
+                                        partition_id=partition_id,
+                                        error_code=errors.no_error,
+                                        offset=8000,
+                                        timestamp=-1,
+                                    ),
+                                ]
+                            ),
+                        ],
+                        throttle_time=0,
+                    ),
+                ]
+            )
+
+        p = producer.Producer(
+            ["kafka01"], compression=constants.ZSTD,
+            key_maker=attribute_key, partitioner=key_partitioner
+        )
+
+        yield p.produce("test.topic", {"key": 0, "msg": "foo"})
+        yield p.produce("test.topic", {"key": 1, "msg": "bar"})
+
+        def batch_attributes(request):
+            message_set = request.topics[0].partitions[0].message_set
+            # the attributes follow the batch's offset, length, epoch,
+            # magic and CRC
+            return struct.unpack_from("!h", message_set.encoded, 21)[0]
+
+        request = self.requests_by_broker[1][0]
+        self.assertIsInstance(request, produce.ProduceV7Request)
+        self.assertEqual(request.api_version, 7)
+        self.assertEqual(batch_attributes(request), constants.ZSTD)
+
+        request = self.requests_by_broker[3][0]
+        self.assertIsInstance(request, produce.ProduceV3Request)
+        self.assertEqual(batch_attributes(request), constants.GZIP)
+
+    def mock_executor(self):
+        executor = Mock()
+
+        def submit(fn, *args):
+            future = concurrent.Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        executor.submit.side_effect = submit
+
+        return executor
+
+    @testing.gen_test
+    def test_executor_serializes_and_encodes_when_flushing(self):
+        self.add_topic("test.topic", leaders=(1,))
+
+        self.set_responses(
+            broker_id=1, api="produce",
+            responses=[
+                produce.ProduceResponse(
+                    topics=[
+                        produce.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                produce.PartitionResponse(
+                                    partition_id=0,
+                                    error_code=errors.no_error,
+                                    offset=8003,
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        executor = self.mock_executor()
+        serializer = Mock(side_effect=producer.json_serializer)
+
+        p = producer.Producer(
+            ["kafka01"], batch_size=2, compression=constants.GZIP,
+            serializer=serializer, executor=executor
+        )
+
+        yield p.produce("test.topic", {"foo": "bar"})
+
+        self.assertEqual(serializer.call_count, 0)
+        self.assertEqual(p.unsent_count, 1)
+
+        yield p.produce("test.topic", {"bwee": "bwoo"})
+
+        self.assertEqual(serializer.call_count, 2)
+        self.assertEqual(executor.submit.call_count, 1)
+
+        request = self.requests_by_broker[1][0]
+        message_set = request.topics[0].partitions[0].message_set
+        out = WriteBuffer()
+        message_set.encode(out)
+        parsed, _ = messages.MessageSet.parse(out.getvalue(), 0)
+
+        self.assertEqual(
+            [msg.value for _offset, msg in parsed],
+            ['{"foo": "bar"}', '{"bwee": "bwoo"}']
+        )
+        self.assertEqual(p.sent, {})
+
+    @testing.gen_test
+    def test_executor_retries_unserialized_messages(self):
+        self.add_topic("test.topic", leaders=(1,))
+
+        self.set_responses(
+            broker_id=1, api="produce",
+            responses=[
+                produce.ProduceResponse(
+                    topics=[
+                        produce.TopicResponse(
+                            name="test.topic",
+                            partitions=[
+                                produce.PartitionResponse(
+                                    partition_id=0,
+                                    error_code=errors.request_timed_out,
+                                    offset=8001,
+                                ),
+                            ]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        p = producer.Producer(["kafka01"], executor=self.mock_executor())
+
+        yield p.produce("test.topic", {"foo": "bar"})
+
+        self.assertEqual(
+            [msg.value for msg in p.unsent["test.topic"][0]],
+            [{"foo": "bar"}]
+        )
+
+    @testing.gen_test
+    def test_executor_flushes_sent_in_order(self):
+        self.add_topic("test.topic", leaders=(1,))
+
+        response = produce.ProduceResponse(
+            topics=[
+                produce.TopicResponse(
+                    name="test.topic",
+                    partitions=[
+                        produce.PartitionResponse(
+                            partition_id=0,
+                            error_code=errors.no_error,
+                            offset=8001,
+                        ),
+                    ]
+                ),
+            ]
+        )
+        self.set_responses(
+            broker_id=1, api="produce", responses=[response, response]
+        )
+
+        encodings = []
+
+        def submit(fn, *args):
+            future = concurrent.Future()
+            encodings.append((future, fn(*args)))
+            return future
+
+        executor = Mock()
+        executor.submit.side_effect = submit
+
+        p = producer.Producer(["kafka01"], executor=executor)
+
+        first = p.produce("test.topic", "foo")
+        second = p.produce("test.topic", "bar")
+
+        # the second flush is encoded first, but has to wait for the first
+        future, result = encodings[1]
+        future.set_result(result)
+        yield gen.moment
+
+        self.assertEqual(self.requests_by_broker[1], [])
+
+        future, result = encodings[0]
+        future.set_result(result)
+
+        yield [first, second]
+
+        values = []
+        for request in self.requests_by_broker[1]:
+            out = WriteBuffer()
+            request.topics[0].partitions[0].message_set.encode(out)
+            parsed, _ = messages.MessageSet.parse(out.getvalue(), 0)
+            values.append([msg.value for _offset, msg in parsed])
+
+        self.assertEqual(values, [['"foo"'], ['"bar"']])
+
+    @testing.gen_test
+    def test_executor_failure_keeps_messages(self):
+        self.add_topic("test.topic", leaders=(1, 3))
+
+        serializer = Mock(side_effect=ValueError("can't serialize"))
+
+        p = producer.Producer(
+            ["kafka01"], key_maker=attribute_key,
+            partitioner=key_partitioner, batch_size=2,
+            serializer=serializer, executor=self.mock_executor()
+        )
+
+        yield p.produce("test.topic", {"key": 0, "value": "foo"})
+
+        with self.assertRaises(ValueError):
+            yield p.produce("test.topic", {"key": 1, "value": "bar"})
+
+        self.assertEqual(p.sent, {})
+        self.assertEqual(p.unsent_count, 2)
+        self.assertEqual(
+            [msg.value for msg in p.unsent["test.topic"][0]],
+            [{"key": 0, "value": "foo"}]
+        )
+        self.assertEqual(
+            [msg.value for msg in p.unsent["test.topic"][1]],
+            [{"key": 1, "value": "bar"}]
+        )
+        self.assertEqual(self.requests_by_broker[1], [])
+        self.assertEqual(self.requests_by_broker[3], [])
+
+    @testing.gen_test
+    def test_executor_records_compression_ratio(self):
+        self.add_topic("test.topic", leaders=(1,))
+        self.produce_responses(1)
+
+        p = producer.Producer(
+            ["kafka01"], compression=constants.GZIP,
+            executor=self.mock_executor()
+        )
+
+        yield p.produce("test.topic", "foo" * 100)
+
+        self.assertLess(
+            p.compression_ratios.ratios[("test.topic", constants.GZIP)], 0.5
+        )
+
+    def test_encode_message_set_matches_builder(self):
+        msgs = [
+            messages.Message(magic=0, attributes=0, key=None, value="foo"),
+            messages.Message(magic=0, attributes=0, key=None, value="bar"),
+        ]
+        builder = producer.message_set_builder(0)
+        builder.extend(msgs)
+
+        self.assertEqual(
+            producer.encode_message_set(0, msgs),
+            (builder.build().encoded.tobytes(), None, builder.out.size)
+        )
+
+    def test_encode_message_set_skips_compression_below_threshold(self):
+        msgs = [
+            messages.Message(magic=0, attributes=0, key=None, value="foo"),
+        ]
+
+        _, compression, size = producer.encode_message_set(
+            0, msgs, compression=constants.GZIP, threshold=1024
+        )
+
+        self.assertEqual(compression, None)
+
+        _, compression, _ = producer.encode_message_set(
+            0, msgs, compression=constants.GZIP, threshold=size
+        )
+
+        self.assertEqual(compression, constants.GZIP)
+
+
+class CompressionRatiosTests(unittest.TestCase):
+
+    def test_always_worthwhile_without_max_ratio(self):
+        ratios = producer.CompressionRatios()
+        ratios.record("test.topic", constants.GZIP, 100, 200)
+
+        self.assertTrue(ratios.worthwhile("test.topic", constants.GZIP))
+
+    def test_no_compression_never_worthwhile(self):
+        ratios = producer.CompressionRatios(max_ratio=0.9)
+
+        self.assertFalse(ratios.worthwhile("test.topic", None))
+
+    def test_ratios_tracked_per_topic_and_codec(self):
+        ratios = producer.CompressionRatios(max_ratio=0.9)
+        ratios.record("test.topic", constants.GZIP, 100, 95)
+        ratios.record("test.topic", constants.SNAPPY, 100, 50)
+        ratios.record("other.topic", constants.GZIP, 100, 50)
+
+        self.assertFalse(ratios.worthwhile("test.topic", constants.GZIP))
+        self.assertTrue(ratios.worthwhile("test.topic", constants.SNAPPY))
+        self.assertTrue(ratios.worthwhile("other.topic", constants.GZIP))
+
+    def test_ratio_is_a_weighted_average(self):
+        ratios = producer.CompressionRatios(max_ratio=0.9)
+        ratios.record("test.topic", constants.GZIP, 100, 100)
+        ratios.record("test.topic", constants.GZIP, 100, 50)
+
+        self.assertAlmostEqual(
+            ratios.ratios[("test.topic", constants.GZIP)],
+            1 - producer.RATIO_WEIGHT * 0.5
+        )
+
+    def test_empty_batches_ignored(self):
+        ratios = producer.CompressionRatios(max_ratio=0.9)
+        ratios.record("test.topic", constants.GZIP, 0, 20)
+
+        self.assertEqual(ratios.ratios, {})
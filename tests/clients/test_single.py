@@ -69,7 +69,7 @@ class SingleConsumerTests(cases.ClientTestCase):
                                     message_set=messages.MessageSet(
                                         messages=[
                                             (
-                                                0,
+                                                99,
                                                 messages.Message(
                                                     magic=0, attributes=0,
                                                     key=None,
@@ -77,7 +77,7 @@ class SingleConsumerTests(cases.ClientTestCase):
                                                 )
                                             ),
                                             (
-                                                1,
+                                                100,
                                                 messages.Message(
                                                     magic=0, attributes=0,
                                                     key=None,
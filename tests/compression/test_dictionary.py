@@ -0,0 +1,206 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, Mock
+from tornado import concurrent
+
+from kiel.compression import dictionary, zstd
+
+
+def sample_values(count):
+    return [
+        json.dumps(
+            {"user": i * 7919, "event": "page_view", "path": "/item/%d" % i},
+            sort_keys=True
+        )
+        for i in range(count)
+    ]
+
+
+@unittest.skipUnless(zstd.zstd_available, "requires zstandard")
+class DictionaryStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        super(DictionaryStoreTests, self).setUp()
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+        super(DictionaryStoreTests, self).tearDown()
+
+    def store(self, **kwargs):
+        kwargs.setdefault("sample_count", 200)
+        kwargs.setdefault("dict_size", 2048)
+
+        return dictionary.DictionaryStore(self.directory, **kwargs)
+
+    @patch.object(dictionary, "zstd_available", False)
+    def test_runtime_error_if_zstd_unavailable(self):
+        self.assertRaises(RuntimeError, self.store)
+
+    def test_values_sampled_until_dictionary_trained(self):
+        store = self.store()
+        values = sample_values(201)
+
+        sent = [store.compress("test.topic", value) for value in values]
+
+        self.assertEqual(sent[:200], values[:200])
+        self.assertEqual(os.listdir(self.directory), ["test.topic.1.zdict"])
+        self.assertTrue(sent[200].startswith(dictionary.FRAME_MAGIC))
+        self.assertLess(len(sent[200]), len(values[200]) / 2)
+
+    def test_dictionary_id_derived_from_file_name(self):
+        store = self.store()
+        for value in sample_values(200):
+            store.compress("test.topic", value)
+
+        path = os.path.join(self.directory, "test.topic.1.zdict")
+        with open(path, "rb") as f:
+            trained = dictionary.zstandard.ZstdCompressionDict(f.read())
+
+        self.assertEqual(
+            trained.dict_id(), dictionary.dictionary_id("test.topic.1.zdict")
+        )
+
+    def test_decompress_with_dictionary_from_directory(self):
+        values = sample_values(201)
+        producer_store = self.store()
+        sent = [producer_store.compress("test.topic", v) for v in values]
+
+        consumer_store = self.store()
+
+        self.assertEqual(consumer_store.decompress(sent[200]), values[200])
+        self.assertEqual(
+            consumer_store.decompress(memoryview(sent[200])), values[200]
+        )
+
+    def test_unknown_dictionaries_loaded_when_seen(self):
+        consumer_store = self.store()
+        producer_store = self.store()
+
+        values = sample_values(201)
+        sent = [producer_store.compress("test.topic", v) for v in values]
+
+        self.assertEqual(consumer_store.decompress(sent[200]), values[200])
+
+    def test_missing_dictionary(self):
+        store = self.store()
+        values = sample_values(201)
+        sent = [store.compress("test.topic", v) for v in values]
+
+        os.remove(os.path.join(self.directory, "test.topic.1.zdict"))
+
+        self.assertRaises(ValueError, self.store().decompress, sent[200])
+
+    def test_other_values_pass_through(self):
+        store = self.store()
+
+        self.assertEqual(store.decompress(None), None)
+        self.assertEqual(store.decompress(u"foo"), u"foo")
+        self.assertEqual(store.decompress(b"\xff\xfe"), b"\xff\xfe")
+
+        plain_frame = zstd.compress(b"foo")
+        self.assertEqual(store.decompress(plain_frame), plain_frame)
+
+    def test_retrain_adds_a_version(self):
+        store = self.store()
+        values = sample_values(201)
+        first = [store.compress("test.topic", v) for v in values][200]
+
+        store.retrain("test.topic")
+
+        self.assertEqual(store.compress("test.topic", values[0]), values[0])
+
+        second = [store.compress("test.topic", v) for v in values][200]
+
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ["test.topic.1.zdict", "test.topic.2.zdict"]
+        )
+
+        other_store = self.store()
+
+        self.assertEqual(other_store.versions, {"test.topic": 2})
+        self.assertEqual(other_store.decompress(first), values[200])
+        self.assertEqual(other_store.decompress(second), values[200])
+
+    def test_version_trained_elsewhere_first_is_used(self):
+        first_store = self.store()
+        second_store = self.store()
+
+        values = sample_values(201)
+        other_values = [v.replace("page_view", "click") for v in values]
+
+        first = [first_store.compress("test.topic", v) for v in values][200]
+        second = [
+            second_store.compress("test.topic", v) for v in other_values
+        ][200]
+
+        self.assertEqual(os.listdir(self.directory), ["test.topic.1.zdict"])
+        self.assertEqual(second_store.versions, {"test.topic": 1})
+
+        consumer_store = self.store()
+
+        self.assertEqual(consumer_store.decompress(first), values[200])
+        self.assertEqual(consumer_store.decompress(second), other_values[200])
+
+    def test_training_in_executor(self):
+        executor = Mock()
+        executor.submit.return_value = concurrent.Future()
+
+        store = self.store(executor=executor)
+        values = sample_values(202)
+
+        sent = [store.compress("test.topic", v) for v in values[:201]]
+
+        self.assertEqual(sent, values[:201])
+        self.assertEqual(store.samples["test.topic"], [])
+        self.assertEqual(os.listdir(self.directory), [])
+
+        function, topic, dict_size, samples = executor.submit.call_args[0]
+        executor.submit.return_value.set_result(
+            function(topic, dict_size, samples)
+        )
+
+        compressed = store.compress("test.topic", values[201])
+
+        self.assertEqual(os.listdir(self.directory), ["test.topic.1.zdict"])
+        self.assertEqual(self.store().decompress(compressed), values[201])
+
+    @patch.object(dictionary, "time")
+    def test_unknown_dictionary_rescans_rate_limited(self, mock_time):
+        mock_time.time.return_value = 1000.0
+
+        producer_store = self.store()
+        values = sample_values(201)
+        sent = [producer_store.compress("test.topic", v) for v in values]
+        os.remove(os.path.join(self.directory, "test.topic.1.zdict"))
+
+        store = self.store(rescan_interval=500)
+
+        with patch.object(store, "load") as load:
+            self.assertRaises(ValueError, store.decompress, sent[200])
+            self.assertRaises(ValueError, store.decompress, sent[200])
+
+            self.assertEqual(load.call_count, 1)
+
+            mock_time.time.return_value = 1000.5
+
+            self.assertRaises(ValueError, store.decompress, sent[200])
+
+            self.assertEqual(load.call_count, 2)
+
+    def test_training_failure_starts_sampling_over(self):
+        store = self.store(sample_count=2)
+
+        self.assertEqual(store.compress("test.topic", "a"), "a")
+        self.assertEqual(store.compress("test.topic", "b"), "b")
+
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(store.samples["test.topic"], [])
+        self.assertEqual(store.compress("test.topic", "c"), "c")
@@ -1,6 +1,9 @@
+import gzip as gzip_module
 import json
 import unittest
 
+from six import BytesIO
+
 from kiel.compression import gzip
 
 
@@ -19,3 +22,27 @@ class GZipCompressionTests(unittest.TestCase):
             json.loads(data.decode("utf-8")),
             {"foo": "bar", "blee": "bloo", "dog": "cat"}
         )
+
+    def test_compress_output_readable_by_gzip_module(self):
+        data = b"foo" * 100
+
+        compressed = gzip.compress(memoryview(bytearray(data)))
+
+        self.assertEqual(gzip_module.GzipFile(
+            fileobj=BytesIO(compressed)
+        ).read(), data)
+
+    def test_compression_level(self):
+        data = b"".join([str(i).encode("utf-8") for i in range(1000)])
+
+        fast = gzip.compress(data, level=1)
+        small = gzip.compress(data, level=9)
+
+        self.assertTrue(len(small) < len(fast))
+        self.assertEqual(gzip.decompress(fast), data)
+        self.assertEqual(gzip.decompress(small), data)
+
+    def test_decompress_concatenated_members(self):
+        data = gzip.compress(b"foo") + gzip.compress(b"bar")
+
+        self.assertEqual(gzip.decompress(data), b"foobar")
@@ -0,0 +1,64 @@
+import json
+import struct
+import unittest
+
+from mock import patch
+
+from kiel.compression import lz4
+
+
+@unittest.skipUnless(lz4.lz4_available, "requires lz4")
+class LZ4CompressionTests(unittest.TestCase):
+
+    @patch.object(lz4, "lz4_available", False)
+    def test_compress_runtime_error_if_lz4_unavailable(self):
+        self.assertRaises(
+            RuntimeError,
+            lz4.compress, b"foo"
+        )
+
+    @patch.object(lz4, "lz4_available", False)
+    def test_decompress_runtime_error_if_lz4_unavailable(self):
+        self.assertRaises(
+            RuntimeError,
+            lz4.decompress, b"foo"
+        )
+
+    def test_compression_is_stable(self):
+        data = json.dumps({"foo": "bar", "dog": "cat"}).encode("utf-8")
+
+        data = lz4.compress(data)
+        data = lz4.decompress(data)
+        data = lz4.compress(data)
+        data = lz4.decompress(data)
+
+        self.assertEqual(
+            json.loads(data.decode("utf-8")),
+            {"foo": "bar", "dog": "cat"}
+        )
+
+    def test_frame_uses_independent_64kb_blocks(self):
+        data = lz4.compress(b"foo" * 100)
+
+        magic, flags, block_descriptor = struct.unpack_from("<IBB", data)
+
+        self.assertEqual(magic, 0x184D2204)
+        # version 01, independent blocks, no checksums or content size
+        self.assertEqual(flags, 0b01100000)
+        self.assertEqual(block_descriptor, 0b01000000)
+
+    def test_legacy_header_checksum(self):
+        data = lz4.compress(b"foo" * 100, legacy=True)
+
+        self.assertEqual(
+            bytearray(data)[6], lz4.header_checksum(data[:6])
+        )
+        self.assertEqual(lz4.decompress(data), b"foo" * 100)
+
+    def test_xxh32(self):
+        self.assertEqual(lz4.xxh32(b""), 0x02CC5D05)
+        self.assertEqual(lz4.xxh32(b"a"), 0x550D7456)
+        self.assertEqual(
+            lz4.xxh32(b"Nobody inspects the spammish repetition"),
+            0xE2293B2F
+        )
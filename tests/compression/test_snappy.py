@@ -48,3 +48,41 @@ class SnappyCompressionTests(unittest.TestCase):
             header,
             (-126, b'S', b'N', b'A', b'P', b'P', b'Y', 0, 1, 1)
         )
+
+    def test_multiple_blocks(self):
+        data = b"".join([str(i).encode("utf-8") for i in range(20000)])
+
+        compressed = snappy.compress(data)
+
+        self.assertTrue(len(data) > snappy.BLOCK_SIZE)
+        self.assertEqual(snappy.decompress(compressed), data)
+        self.assertEqual(snappy.decompress(memoryview(compressed)), data)
+
+    @patch.object(snappy, "cramjam_available", False)
+    def test_multiple_blocks_without_cramjam(self):
+        data = b"".join([str(i).encode("utf-8") for i in range(20000)])
+
+        compressed = snappy.compress(data)
+
+        self.assertEqual(snappy.decompress(compressed), data)
+
+    def test_same_output_without_cramjam(self):
+        data = b"".join([str(i).encode("utf-8") for i in range(20000)])
+
+        compressed = snappy.compress(data)
+        with patch.object(snappy, "cramjam_available", False):
+            self.assertEqual(snappy.compress(data), compressed)
+
+    def test_raw_snappy_payloads(self):
+        data = json.dumps({"foo": "bar", "dog": "cat"}).encode("utf-8")
+
+        raw = snappy.snappy.compress(data)
+
+        self.assertEqual(snappy.decompress(raw), data)
+
+    def test_uncompressed_length(self):
+        data = b"x" * 300
+
+        raw = snappy.snappy.compress(data)
+
+        self.assertEqual(snappy.uncompressed_length(raw), 300)
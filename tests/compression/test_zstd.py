@@ -0,0 +1,43 @@
+import json
+import unittest
+
+from mock import patch
+
+from kiel.compression import zstd
+
+
+@unittest.skipUnless(zstd.zstd_available, "requires zstandard")
+class ZstdCompressionTests(unittest.TestCase):
+
+    @patch.object(zstd, "zstd_available", False)
+    def test_compress_runtime_error_if_zstd_unavailable(self):
+        self.assertRaises(
+            RuntimeError,
+            zstd.compress, b"foo"
+        )
+
+    @patch.object(zstd, "zstd_available", False)
+    def test_decompress_runtime_error_if_zstd_unavailable(self):
+        self.assertRaises(
+            RuntimeError,
+            zstd.decompress, b"foo"
+        )
+
+    def test_compression_is_stable(self):
+        data = json.dumps({"foo": "bar", "dog": "cat"}).encode("utf-8")
+
+        data = zstd.compress(data)
+        data = zstd.decompress(data)
+        data = zstd.compress(data, level=1)
+        data = zstd.decompress(data)
+
+        self.assertEqual(
+            json.loads(data.decode("utf-8")),
+            {"foo": "bar", "dog": "cat"}
+        )
+
+    def test_decompress_frame_without_content_size(self):
+        compressor = zstd.zstandard.ZstdCompressor(write_content_size=False)
+        data = compressor.compress(b"foo" * 100)
+
+        self.assertEqual(zstd.decompress(data), b"foo" * 100)
@@ -0,0 +1,74 @@
+import struct
+import unittest
+import zlib
+
+from kiel.protocol.buffers import WriteBuffer
+
+
+class WriteBufferTests(unittest.TestCase):
+
+    def test_reserve_returns_positions(self):
+        out = WriteBuffer()
+
+        self.assertEqual(out.reserve(4), 0)
+        self.assertEqual(out.reserve(2), 4)
+        self.assertEqual(out.size, 6)
+
+    def test_back_filled_size_prefix(self):
+        out = WriteBuffer()
+
+        position = out.reserve(4)
+        out.write(b"foobar")
+        struct.pack_into("!i", out.data, position, out.size - 4)
+
+        self.assertEqual(out.getvalue(), b"\x00\x00\x00\x06foobar")
+
+    def test_grows_past_capacity(self):
+        out = WriteBuffer(capacity=4)
+
+        out.write(b"abc")
+        out.write(b"defghijk")
+
+        self.assertEqual(out.getvalue(), b"abcdefghijk")
+        self.assertTrue(len(out.data) >= 11)
+
+    def test_grows_while_viewed(self):
+        out = WriteBuffer(capacity=4)
+        out.write(b"abc")
+
+        view = out.view()
+        out.write(b"defghijk")
+
+        self.assertEqual(view.tobytes(), b"abc")
+        self.assertEqual(out.getvalue(), b"abcdefghijk")
+
+    def test_view_is_not_a_copy(self):
+        out = WriteBuffer()
+        out.write(b"abc")
+
+        view = out.view()
+        out.data[0:1] = b"x"
+
+        self.assertEqual(view.tobytes(), b"xbc")
+
+    def test_region_is_not_a_copy(self):
+        out = WriteBuffer()
+        out.write(b"abcdef")
+
+        region = out.region(2, 5)
+        out.data[2:3] = b"x"
+
+        self.assertEqual(bytes(region), b"xde")
+        self.assertEqual(zlib.crc32(region), zlib.crc32(b"xde"))
+        self.assertEqual(bytes(out.region(4)), b"ef")
+
+    def test_clear_keeps_capacity(self):
+        out = WriteBuffer(capacity=8)
+        out.write(b"abcdefghijk")
+        capacity = len(out.data)
+
+        out.clear()
+        out.write(b"z")
+
+        self.assertEqual(out.getvalue(), b"z")
+        self.assertEqual(len(out.data), capacity)
@@ -0,0 +1,193 @@
+import struct
+import unittest
+
+from kiel import constants
+from kiel.protocol import codec, metadata, fetch, messages
+from kiel.protocol.buffers import WriteBuffer
+from kiel.protocol.part import Part
+from kiel.protocol.primitives import (
+    Array, Int8, Int16, Int32, String, Bytes, compiled_structs,
+)
+
+
+class Example(Part):
+    parts = (
+        ("one", Int8),
+        ("two", Int16),
+        ("name", String),
+        ("numbers", Array.of(Int32)),
+        ("data", Bytes),
+    )
+
+
+class CodecTests(unittest.TestCase):
+
+    def encode(self, part):
+        out = WriteBuffer()
+        part.encode(out)
+        return out.getvalue()
+
+    def test_fixed_runs_are_grouped(self):
+        parts = metadata.PartitionMetadata.parts
+
+        runs = [
+            (fixed, [name for name, _ in run])
+            for fixed, run in codec.fixed_runs(parts)
+        ]
+
+        self.assertEqual(
+            runs,
+            [
+                (True, ["error_code", "partition_id", "leader"]),
+                (False, ["replicas", "isrs"]),
+            ]
+        )
+
+    def test_encode_matches_render(self):
+        example = Example(
+            one=1, two=2, name=u"foo", numbers=[3, 4, 5], data=b"\x00\xff"
+        )
+
+        fmt, data = example.render()
+
+        self.assertEqual(self.encode(example), struct.pack("!" + fmt, *data))
+
+    def test_encode_missing_and_null_values(self):
+        example = Example(one=1, two=2, name=None, data=None)
+
+        self.assertEqual(
+            self.encode(example),
+            struct.pack("!bhhii", 1, 2, -1, 0, -1)
+        )
+
+    def test_encode_parse_is_stable(self):
+        example = Example(
+            one=1, two=2, name=u"foo", numbers=[3, 4, 5], data=u"bar"
+        )
+
+        parsed, offset = Example.parse(self.encode(example), 0)
+
+        self.assertEqual(parsed, example)
+        self.assertEqual(offset, len(self.encode(example)))
+
+    def test_parse_nested_parts(self):
+        response = metadata.MetadataResponse(
+            brokers=[metadata.Broker(broker_id=1, host="kafka01", port=9092)],
+            topics=[
+                metadata.TopicMetadata(
+                    error_code=0, name="example.foo",
+                    partitions=[
+                        metadata.PartitionMetadata(
+                            error_code=0, partition_id=0, leader=1,
+                            replicas=[1, 2], isrs=[]
+                        ),
+                    ]
+                ),
+            ]
+        )
+
+        raw = self.encode(response)
+
+        self.assertEqual(metadata.MetadataResponse.deserialize(raw), response)
+
+    def test_array_lengths_are_not_cached(self):
+        cached = set(compiled_structs)
+
+        for count in (17, 23, 31):
+            example = Example(
+                one=1, two=2, name=u"foo", numbers=list(range(count))
+            )
+            parsed, _ = Example.parse(self.encode(example), 0)
+            self.assertEqual(parsed.numbers, list(range(count)))
+
+        self.assertEqual(set(compiled_structs), cached)
+
+    def test_parse_short_buffer_raises_struct_error(self):
+        raw = self.encode(Example(one=1, two=2, name=u"foobar"))
+
+        with self.assertRaises(struct.error):
+            Example.parse(raw[:8], 0)
+
+    def test_message_set_encode_matches_render(self):
+        message_set = messages.MessageSet.compressed(
+            None, [
+                messages.Message(magic=0, attributes=0, key=None, value="foo"),
+                messages.Message(magic=0, attributes=0, key="1", value="bar"),
+            ]
+        )
+        partition = fetch.PartitionResponse(
+            partition_id=0, error_code=0, highwater_mark_offset=2,
+            message_set=message_set
+        )
+
+        fmt, data = message_set.render()
+
+        self.assertEqual(
+            self.encode(partition),
+            struct.pack("!ihq" + fmt, 0, 0, 2, *data)
+        )
+        self.assertEqual(
+            fetch.PartitionResponse.parse(self.encode(partition), 0)[0],
+            partition
+        )
+
+    def test_fetch_v10_request_wire_format(self):
+        request = fetch.FetchV10Request(
+            replica_id=-1, max_wait_time=500, min_bytes=1, max_bytes=1000,
+            isolation_level=0, session_id=7, session_epoch=2,
+            topics=[
+                fetch.TopicV9Request(name=u"foo", partitions=[
+                    fetch.PartitionV9Request(
+                        partition_id=3, current_leader_epoch=-1,
+                        offset=80, log_start_offset=-1, max_bytes=500,
+                    ),
+                ]),
+            ],
+            forgotten_topics=[
+                fetch.ForgottenTopic(name=u"bar", partitions=[1]),
+            ],
+        )
+
+        self.assertEqual(
+            self.encode(request),
+            struct.pack(
+                "!iiiibii" + "ih3s" + "iiiqqi" + "ih3sii",
+                -1, 500, 1, 1000, 0, 7, 2,
+                1, 3, b"foo",
+                1, 3, -1, 80, -1, 500,
+                1, 3, b"bar", 1, 1,
+            )
+        )
+
+    def test_memoryview_buffer_gives_bytes_views(self):
+        example = Example(one=1, two=2, name=u"foo", data=u"bar")
+        raw = bytearray(self.encode(example))
+
+        parsed, _ = Example.parse(memoryview(raw), 0)
+
+        self.assertEqual(parsed.name, u"foo")
+        self.assertIsInstance(parsed.data, memoryview)
+        self.assertEqual(parsed.data.tobytes(), b"bar")
+
+        # a view, not a copy: changes to the buffer show through
+        raw[-3:] = b"baz"
+        self.assertEqual(parsed.data.tobytes(), b"baz")
+
+    def test_memoryview_buffer_compressed_message_set(self):
+        message_set = messages.MessageSet.compressed(
+            constants.GZIP, [
+                messages.Message(magic=0, attributes=0, key=None, value="foo"),
+                messages.Message(magic=0, attributes=0, key=None, value="bar"),
+            ]
+        )
+        out = WriteBuffer()
+        message_set.encode(out)
+
+        parsed, _ = messages.MessageSet.parse(out.view(), 0)
+
+        values = [msg.value for _offset, msg in parsed.messages]
+        for value in values:
+            self.assertIsInstance(value, memoryview)
+        self.assertEqual(
+            [value.tobytes() for value in values], [b"foo", b"bar"]
+        )
@@ -1,7 +1,12 @@
 import json
 import unittest
 
-from kiel.protocol import messages
+from mock import patch
+
+from kiel import constants
+from kiel.compression import lz4, snappy
+from kiel.protocol import messages, records
+from kiel.protocol.buffers import WriteBuffer
 
 
 class MessagesTests(unittest.TestCase):
@@ -38,3 +43,153 @@ class MessagesTests(unittest.TestCase):
             repr(msg_set),
             '[foo => {"bar": "bazz"}, bar => {"bwee": "bwoo"}]'
         )
+
+    def encode(self, message_set):
+        out = WriteBuffer()
+        message_set.encode(out)
+        return out.getvalue()
+
+    def example_set(self, offsets, compression=None):
+        msgs = [
+            messages.Message(
+                magic=0, attributes=0, key=None, value="msg %d" % offset
+            )
+            for offset in offsets
+        ]
+        if compression:
+            wrapper_set = messages.MessageSet.compressed(compression, msgs)
+            _, wrapper = wrapper_set.messages[0]
+            # compressed wrappers have the offset of the last nested message
+            return messages.MessageSet([(offsets[-1], wrapper)])
+
+        return messages.MessageSet(list(zip(offsets, msgs)))
+
+    def test_parse_is_lazy(self):
+        raw = self.encode(self.example_set([3, 4, 5]))
+
+        with patch.object(messages.Message, "parse") as parse:
+            message_set, offset = messages.MessageSet.parse(raw, 0)
+
+        self.assertEqual(offset, len(raw))
+        self.assertEqual(parse.called, False)
+
+        self.assertEqual(
+            [(msg_offset, msg.value) for msg_offset, msg in message_set],
+            [(3, "msg 3"), (4, "msg 4"), (5, "msg 5")]
+        )
+
+    def test_iterate_skips_messages_below_offset(self):
+        raw = self.encode(self.example_set([3, 4, 5]))
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        self.assertEqual(
+            [msg_offset for msg_offset, _msg in message_set.iterate(4)], [4, 5]
+        )
+
+    def test_iterate_skips_compressed_wrapper_without_decompressing(self):
+        raw = self.encode(
+            self.example_set([3, 4], compression=constants.GZIP)
+        )
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        with patch.object(records.gzip, "decompress") as decompress:
+            self.assertEqual(list(message_set.iterate(5)), [])
+
+        self.assertEqual(decompress.called, False)
+
+    def test_truncated_last_message_is_dropped(self):
+        raw = self.encode(self.example_set([3, 4, 5]))
+
+        message_set, _ = messages.MessageSet.parse(raw[:-3], 0)
+
+        self.assertEqual(
+            [msg_offset for msg_offset, _msg in message_set], [3, 4]
+        )
+
+    def test_builder_encodes_same_as_message_set(self):
+        message_set = self.example_set([-1, -1, -1])
+
+        builder = messages.MessageSetBuilder()
+        builder.extend([msg for _, msg in message_set.messages])
+
+        built = builder.build()
+
+        self.assertEqual(len(builder), 3)
+        self.assertEqual(built, message_set)
+        self.assertEqual(self.encode(built), self.encode(message_set))
+
+    def test_builder_encodes_messages_as_they_are_appended(self):
+        builder = messages.MessageSetBuilder()
+
+        with patch.object(messages.Message, "encode") as encode:
+            builder.append(
+                messages.Message(magic=0, attributes=0, key=None, value="foo")
+            )
+
+        self.assertEqual(encode.call_count, 1)
+
+    def test_builder_with_compression(self):
+        msgs = [
+            messages.Message(magic=0, attributes=0, key=None, value="foo"),
+            messages.Message(magic=0, attributes=0, key=None, value="bar"),
+        ]
+        builder = messages.MessageSetBuilder()
+        builder.extend(msgs)
+
+        built = builder.build(constants.GZIP)
+
+        _, wrapper = built.messages[0]
+        self.assertEqual(wrapper.attributes, constants.GZIP)
+
+        parsed, _ = messages.MessageSet.parse(self.encode(built), 0)
+
+        self.assertEqual(
+            [msg.value for _offset, msg in parsed], ["foo", "bar"]
+        )
+
+    @unittest.skipUnless(lz4.lz4_available, "requires lz4")
+    def test_lz4_message_set_round_trip(self):
+        msgs = [
+            messages.Message(magic=0, attributes=0, key=None, value="foo"),
+            messages.Message(magic=0, attributes=0, key=None, value="bar"),
+        ]
+        message_set = messages.MessageSet.compressed(constants.LZ4, msgs)
+
+        _, wrapper = message_set.messages[0]
+        self.assertEqual(wrapper.attributes, constants.LZ4)
+
+        parsed, _ = messages.MessageSet.parse(self.encode(message_set), 0)
+
+        self.assertEqual(
+            [msg.value for _offset, msg in parsed], ["foo", "bar"]
+        )
+
+    def test_compressed_value_decoded_as_text_is_reencoded(self):
+        msg = messages.Message(
+            magic=0, attributes=constants.LZ4, key=None, value="not really"
+        )
+        out = WriteBuffer()
+        msg.encode(out)
+
+        with patch.object(records.lz4, "decompress") as decompress:
+            decompress.return_value = b""
+            messages.Message.parse(out.getvalue(), 0)
+
+        decompress.assert_called_once_with(b"not really")
+
+    @unittest.skipUnless(snappy.snappy_available, "requires python-snappy")
+    def test_binary_values_in_decompressed_sets_are_bytes(self):
+        msgs = [
+            messages.Message(
+                magic=0, attributes=0, key=None, value=b"\xff\xfe"
+            ),
+        ]
+        message_set = messages.MessageSet.compressed(constants.SNAPPY, msgs)
+
+        parsed, _ = messages.MessageSet.parse(self.encode(message_set), 0)
+
+        values = [msg.value for _offset, msg in parsed]
+        self.assertEqual(values, [b"\xff\xfe"])
+        self.assertIsInstance(values[0], bytes)
@@ -0,0 +1,63 @@
+import unittest
+
+from kiel.protocol import metadata, fetch
+from kiel.protocol.part import Part
+from kiel.protocol.primitives import Int32, String
+
+
+class Example(Part):
+    parts = (
+        ("number", Int32),
+        ("name", String),
+    )
+
+
+class ExtendedExample(Example):
+    __slots__ = ("extra",)
+
+    parts = (
+        ("number", Int32),
+        ("name", String),
+        ("other", Int32),
+    )
+
+
+class PartTests(unittest.TestCase):
+
+    def test_instances_are_slotted(self):
+        example = Example(number=1, name="foo")
+
+        self.assertEqual(Example.__slots__, ("number", "name"))
+        self.assertFalse(hasattr(example, "__dict__"))
+        with self.assertRaises(AttributeError):
+            example.unknown = True
+
+    def test_subclass_slots_only_add_new_names(self):
+        self.assertEqual(ExtendedExample.__slots__, ("extra", "other"))
+
+        example = ExtendedExample(number=1, name="foo", other=2)
+        example.extra = 3
+
+        self.assertEqual(example.extra, 3)
+
+    def test_missing_parts_default_to_none(self):
+        example = Example(number=1)
+
+        self.assertEqual(example.name, None)
+
+    def test_unknown_part_name(self):
+        with self.assertRaises(ValueError):
+            Example(number=1, nmae="foo")
+
+    def test_construct_is_positional(self):
+        example = Example.construct(1, "foo")
+
+        self.assertEqual(example, Example(number=1, name="foo"))
+
+    def test_response_and_request_attributes(self):
+        request = fetch.FetchRequest(topics=[])
+        response = metadata.MetadataResponse(brokers=[], topics=[])
+        response.correlation_id = request.correlation_id
+
+        self.assertEqual(request.api_key, 1)
+        self.assertEqual(response.correlation_id, request.correlation_id)
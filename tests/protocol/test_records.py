@@ -0,0 +1,189 @@
+import struct
+import unittest
+
+from mock import patch
+
+from kiel import constants
+from kiel.compression import lz4, zstd
+from kiel.protocol import messages, records
+from kiel.protocol.buffers import WriteBuffer
+
+
+class RecordsTests(unittest.TestCase):
+
+    def encode(self, message_set):
+        out = WriteBuffer()
+        message_set.encode(out)
+        return out.getvalue()
+
+    def example_msgs(self, count):
+        return [
+            messages.Message(
+                magic=0, attributes=0, key=None, value="msg %d" % i
+            )
+            for i in range(count)
+        ]
+
+    def example_batch(self, count, base_offset, compression=None):
+        builder = messages.RecordBatchBuilder()
+        builder.extend(self.example_msgs(count))
+
+        raw = bytearray(self.encode(builder.build(compression)))
+        # base offsets are assigned by the broker, skip the set's size
+        struct.pack_into("!q", raw, 4, base_offset)
+
+        return bytes(raw)
+
+    def test_varint_round_trip(self):
+        for value in (0, 1, -1, 63, -64, 64, -65, 300, -300, 2 ** 40):
+            encoded = records.encode_varint(value)
+
+            self.assertEqual(
+                records.decode_varint(encoded, 0), (value, len(encoded))
+            )
+
+    def test_small_varints_are_one_byte(self):
+        self.assertEqual(records.encode_varint(-1), b"\x01")
+        self.assertEqual(records.encode_varint(1), b"\x02")
+        self.assertEqual(records.encode_varint(63), b"\x7e")
+
+    def test_crc32c(self):
+        self.assertEqual(records.crc32c(b"123456789"), 0xe3069283)
+
+    def test_batch_header(self):
+        raw = self.example_batch(3, base_offset=100)
+
+        base_offset, batch_length, _, magic = (
+            records.batch_header_struct.unpack_from(raw, 4)
+        )
+        crc = records.batch_crc_struct.unpack_from(raw, 21)[0]
+
+        self.assertEqual(base_offset, 100)
+        self.assertEqual(batch_length, len(raw) - 4 - 12)
+        self.assertEqual(magic, 2)
+        self.assertEqual(crc, records.crc32c(raw[4 + records.CRC_START:]))
+
+    def test_batch_round_trip(self):
+        raw = self.example_batch(3, base_offset=100)
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        self.assertEqual(
+            [(offset, msg.value) for offset, msg in message_set],
+            [(100, "msg 0"), (101, "msg 1"), (102, "msg 2")]
+        )
+        for _, record in message_set:
+            self.assertIsInstance(record, records.Record)
+            self.assertTrue(record.timestamp > 0)
+
+    def test_compressed_batch_round_trip(self):
+        raw = self.example_batch(3, base_offset=7, compression=constants.GZIP)
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        self.assertEqual(
+            [(offset, msg.value) for offset, msg in message_set],
+            [(7, "msg 0"), (8, "msg 1"), (9, "msg 2")]
+        )
+
+    @unittest.skipUnless(lz4.lz4_available, "requires lz4")
+    def test_lz4_batch_round_trip(self):
+        raw = self.example_batch(3, base_offset=7, compression=constants.LZ4)
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        self.assertEqual(
+            [(offset, msg.value) for offset, msg in message_set],
+            [(7, "msg 0"), (8, "msg 1"), (9, "msg 2")]
+        )
+
+    @unittest.skipUnless(zstd.zstd_available, "requires zstandard")
+    def test_zstd_batch_round_trip(self):
+        raw = self.example_batch(3, base_offset=7, compression=constants.ZSTD)
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        self.assertEqual(
+            [(offset, msg.value) for offset, msg in message_set],
+            [(7, "msg 0"), (8, "msg 1"), (9, "msg 2")]
+        )
+
+    def test_zstd_requires_record_batches(self):
+        with self.assertRaises(ValueError):
+            records.compress(constants.ZSTD, b"foo", magic=1)
+
+    def test_batch_records_below_offset_skipped(self):
+        raw = self.example_batch(3, base_offset=100)
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        self.assertEqual(
+            [msg_offset for msg_offset, _msg in message_set.iterate(102)],
+            [102]
+        )
+
+    def test_batch_below_offset_not_decompressed(self):
+        raw = self.example_batch(3, base_offset=7, compression=constants.GZIP)
+
+        message_set, _ = messages.MessageSet.parse(raw, 0)
+
+        with patch.object(records.gzip, "decompress") as decompress:
+            self.assertEqual(list(message_set.iterate(10)), [])
+
+        self.assertEqual(decompress.called, False)
+
+    def test_control_batches_skipped(self):
+        raw = bytearray(self.example_batch(1, base_offset=7))
+        attributes_position = 4 + records.CRC_START
+        struct.pack_into("!h", raw, attributes_position, records.CONTROL_FLAG)
+
+        message_set, _ = messages.MessageSet.parse(bytes(raw), 0)
+
+        self.assertEqual(list(message_set), [])
+
+    def test_memoryview_batch_values(self):
+        raw = self.example_batch(2, base_offset=0)
+
+        message_set, _ = messages.MessageSet.parse(memoryview(raw), 0)
+
+        values = [msg.value for _offset, msg in message_set]
+        for value in values:
+            self.assertIsInstance(value, memoryview)
+        self.assertEqual(
+            [value.tobytes() for value in values], [b"msg 0", b"msg 1"]
+        )
+
+    def test_v1_messages_round_trip(self):
+        builder = messages.MessageSetBuilder(magic=1)
+        builder.extend(self.example_msgs(2))
+
+        message_set, _ = messages.MessageSet.parse(
+            self.encode(builder.build()), 0
+        )
+
+        parsed = list(message_set)
+        self.assertEqual(
+            [msg.value for _offset, msg in parsed], ["msg 0", "msg 1"]
+        )
+        for _, msg in parsed:
+            self.assertIsInstance(msg, messages.MessageV1)
+            self.assertEqual(msg.magic, 1)
+            self.assertTrue(msg.timestamp > 0)
+
+    def test_v1_compressed_offsets_are_relative(self):
+        builder = messages.MessageSetBuilder(magic=1)
+        builder.extend(self.example_msgs(3))
+
+        _, wrapper = builder.build(constants.GZIP).messages[0]
+        # the broker sets the wrapper offset to that of the last message
+        message_set = messages.MessageSet([(12, wrapper)])
+
+        parsed, _ = messages.MessageSet.parse(self.encode(message_set), 0)
+
+        self.assertEqual(
+            [(offset, msg.value) for offset, msg in parsed],
+            [(10, "msg 0"), (11, "msg 1"), (12, "msg 2")]
+        )
+        self.assertEqual(
+            [msg_offset for msg_offset, _msg in parsed.iterate(12)], [12]
+        )
@@ -4,7 +4,7 @@ import logging
 from tests import cases
 
 from mock import patch, Mock
-from tornado import testing, gen, iostream
+from tornado import testing, gen, iostream, concurrent
 
 from kiel.protocol import metadata, errors
 from kiel import cluster, exc
@@ -27,7 +27,7 @@ class ClusterTests(cases.AsyncTestCase):
         Connection = connection_patcher.start()
         self.addCleanup(connection_patcher.stop)
 
-        def get_conn(host, port):
+        def get_conn(host, port, **options):
             if (host, port) not in self.broker_hosts:
                 raise Exception("no such host!")
 
@@ -73,6 +73,170 @@ class ClusterTests(cases.AsyncTestCase):
         self.assertEqual(c.topics, {})
         self.assertEqual(c.leaders, {})
 
+    @testing.gen_test
+    def test_connection_options_passed_to_connections(self):
+        self.add_broker(
+            "kafka01", 9092,
+            responses=[
+                metadata.MetadataResponse(
+                    brokers=[
+                        metadata.Broker(
+                            broker_id=2, host="kafka01", port=9092
+                        ),
+                    ],
+                    topics=[]
+                )
+            ]
+        )
+
+        c = cluster.Cluster(
+            ["kafka01"], connection_options={"zero_copy": True}
+        )
+
+        yield c.start()
+
+        cluster.Connection.assert_called_with(
+            "kafka01", 9092, zero_copy=True
+        )
+
+    @testing.gen_test
+    def test_pool_per_broker_with_pool_size(self):
+        self.add_broker(
+            "kafka01", 9092,
+            responses=[
+                metadata.MetadataResponse(
+                    brokers=[
+                        metadata.Broker(
+                            broker_id=2, host="kafka01", port=9092
+                        ),
+                    ],
+                    topics=[]
+                )
+            ]
+        )
+
+        c = cluster.Cluster(
+            ["kafka01"], connection_options={"zero_copy": True},
+            pool_size=3, pool_policy="round_robin"
+        )
+
+        with patch.object(cluster, "ConnectionPool") as ConnectionPool:
+            ConnectionPool.return_value.connect.return_value = (
+                self.future_value(None)
+            )
+            yield c.start()
+
+        ConnectionPool.assert_called_once_with(
+            "kafka01", 9092, 3, "round_robin", zero_copy=True
+        )
+        self.assertEqual(c[2], ConnectionPool.return_value)
+
+    @testing.gen_test
+    def test_control_connections(self):
+        self.add_broker(
+            "kafka01", 9092,
+            responses=[
+                metadata.MetadataResponse(
+                    brokers=[
+                        metadata.Broker(
+                            broker_id=2, host="kafka01", port=9092
+                        ),
+                    ],
+                    topics=[]
+                )
+            ]
+        )
+
+        c = cluster.Cluster(["kafka01"], control_connections=True)
+
+        yield c.start()
+
+        self.assertEqual(cluster.Connection.call_count, 3)
+        self.assertEqual(
+            c.control_conns[2], self.broker_hosts[("kafka01", 9092)]
+        )
+
+    @testing.gen_test
+    def test_control_connection_failure_falls_back(self):
+        self.add_broker(
+            "kafka01", 9092,
+            connect_error=iostream.StreamClosedError(),
+        )
+
+        c = cluster.Cluster(["kafka01"], control_connections=True)
+
+        conn = Mock(closing=False)
+        c.conns = {2: conn}
+
+        missing = yield c.process_brokers([
+            metadata.Broker(broker_id=2, host="kafka01", port=9092),
+        ])
+
+        self.assertEqual(missing, set())
+        self.assertEqual(c.control_conns, {})
+        self.assertEqual(c.connection(2, "metadata"), conn)
+
+    def test_connection_routes_control_apis(self):
+        c = cluster.Cluster(["kafka01"], control_connections=True)
+
+        conn = Mock(closing=False)
+        control_conn = Mock(closing=False)
+
+        c.conns = {2: conn, 8: conn}
+        c.control_conns = {2: control_conn}
+
+        self.assertEqual(c.connection(2, "fetch"), conn)
+        self.assertEqual(c.connection(2, "produce"), conn)
+        self.assertEqual(c.connection(2, "metadata"), control_conn)
+        self.assertEqual(c.connection(2, "heartbeat"), control_conn)
+        self.assertEqual(c.connection(8, "metadata"), conn)
+
+        control_conn.closing = True
+
+        self.assertEqual(c.connection(2, "metadata"), conn)
+
+    @testing.gen_test
+    def test_heal_replaces_closing_control_connections(self):
+        self.add_broker(
+            "kafka01", 9092,
+            responses=[
+                metadata.MetadataResponse(
+                    brokers=[
+                        metadata.Broker(
+                            broker_id=2, host="kafka01", port=9092
+                        ),
+                    ],
+                    topics=[]
+                )
+            ]
+        )
+        conn = self.broker_hosts[("kafka01", 9092)]
+
+        c = cluster.Cluster(["kafka01"], control_connections=True)
+
+        closed = Mock(closing=True)
+        c.conns = {2: conn}
+        c.control_conns = {2: closed}
+
+        yield c.heal()
+
+        self.assertEqual(c.control_conns, {2: conn})
+        self.assertEqual(closed.send.called, False)
+
+    def test_stop_closes_control_connections(self):
+        c = cluster.Cluster(["kafka01"], control_connections=True)
+
+        conn = Mock()
+        control_conn = Mock()
+
+        c.conns = {3: conn}
+        c.control_conns = {3: control_conn}
+
+        c.stop()
+
+        conn.close.assert_called_once_with()
+        control_conn.close.assert_called_once_with()
+
     def test_getitem(self):
         c = cluster.Cluster(["kafka01", "kafka02"])
 
@@ -117,15 +281,16 @@ class ClusterTests(cases.AsyncTestCase):
 
         c.conns = {3: conn1, 8: conn2}
         c.leaders = {
-            "test.topic": [8, 3],
-            "other.topic": [3],
+            "test.topic": {0: 8, 1: 3},
+            "other.topic": {0: 3},
         }
 
         self.assertEqual(c.get_leader("test.topic", 0), 8)
         self.assertEqual(c.get_leader("test.topic", 1), 3)
         self.assertEqual(c.get_leader("other.topic", 0), 3)
-        with self.assertRaises(KeyError):
-            c.get_leader("no.such.topic", 3)
+        self.assertEqual(c.get_leader("other.topic", 1), None)
+        self.assertEqual(c.get_leader("no.such.topic", 3), None)
+        self.assertEqual(None in c, False)
 
     @testing.gen_test
     def test_start_uses_metadata_api(self):
@@ -162,6 +327,176 @@ class ClusterTests(cases.AsyncTestCase):
         with self.assertRaises(exc.NoBrokersError):
             yield c.start()
 
+    @testing.gen_test
+    def test_start_races_bootstrap_hosts(self):
+        self.add_broker("kafka01", 9092)
+        self.add_broker(
+            "kafka02", 9000,
+            responses=[
+                metadata.MetadataResponse(brokers=[], topics=[])
+            ]
+        )
+        hung = concurrent.Future()
+        self.broker_hosts[("kafka01", 9092)].connect.return_value = hung
+
+        c = cluster.Cluster(
+            ["kafka01", "kafka02:9000"], bootstrap_stagger=10
+        )
+
+        yield c.start()
+
+        self.assert_sent("kafka02", 9000, metadata.MetadataRequest(topics=[]))
+
+        hung.set_result(None)
+        yield gen.sleep(0.01)
+
+        self.assertEqual(self.sent[("kafka01", 9092)], [])
+        self.broker_hosts[("kafka01", 9092)].close.assert_called_once_with()
+
+    @testing.gen_test
+    def test_start_tries_next_bootstrap_host_on_failure(self):
+        self.add_broker(
+            "kafka01", 9092,
+            connect_error=iostream.StreamClosedError(),
+        )
+        self.add_broker(
+            "kafka02", 9000,
+            responses=[
+                metadata.MetadataResponse(brokers=[], topics=[])
+            ]
+        )
+
+        c = cluster.Cluster(
+            ["kafka01", "kafka02:9000"], bootstrap_stagger=60 * 1000
+        )
+
+        yield c.start()
+
+        self.assert_sent("kafka02", 9000, metadata.MetadataRequest(topics=[]))
+
+    @testing.gen_test
+    def test_process_brokers_connects_concurrently(self):
+        self.add_broker("kafka01", 9092)
+        self.add_broker("kafka02", 9000)
+        conn1 = self.broker_hosts[("kafka01", 9092)]
+        conn2 = self.broker_hosts[("kafka02", 9000)]
+        conn1.connect.return_value = concurrent.Future()
+        conn2.connect.return_value = concurrent.Future()
+
+        c = cluster.Cluster(["kafka01"])
+
+        result = c.process_brokers([
+            metadata.Broker(broker_id=2, host="kafka01", port=9092),
+            metadata.Broker(broker_id=7, host="kafka02", port=9000),
+        ])
+
+        self.assertEqual(conn1.connect.called, True)
+        self.assertEqual(conn2.connect.called, True)
+
+        conn2.connect.return_value.set_result(None)
+        conn1.connect.return_value.set_result(None)
+
+        missing = yield result
+
+        self.assertEqual(missing, set())
+        self.assertEqual(c.conns, {2: conn1, 7: conn2})
+
+    @testing.gen_test
+    def test_process_brokers_connect_timeout(self):
+        self.add_broker("kafka01", 9092)
+        self.add_broker("kafka02", 9000)
+        conn1 = self.broker_hosts[("kafka01", 9092)]
+        conn1.connect.return_value = concurrent.Future()
+
+        c = cluster.Cluster(["kafka01"], connect_timeout=10)
+
+        missing = yield c.process_brokers([
+            metadata.Broker(broker_id=2, host="kafka01", port=9092),
+            metadata.Broker(broker_id=7, host="kafka02", port=9000),
+        ])
+
+        self.assertEqual(missing, set([2]))
+        self.assertEqual(list(c.conns.keys()), [7])
+        conn1.abort.assert_called_once_with()
+
+    @testing.gen_test
+    def test_lazy_process_brokers_does_not_connect(self):
+        self.add_broker("kafka01", 9092)
+        conn1 = self.broker_hosts[("kafka01", 9092)]
+
+        c = cluster.Cluster(["kafka01"], lazy_connections=True)
+
+        missing = yield c.process_brokers([
+            metadata.Broker(broker_id=2, host="kafka01", port=9092),
+        ])
+
+        self.assertEqual(missing, set())
+        self.assertEqual(c.conns, {})
+        self.assertEqual(list(c.brokers.keys()), [2])
+        self.assertEqual(conn1.connect.called, False)
+
+    @testing.gen_test
+    def test_ensure_connections_shares_attempts(self):
+        self.add_broker("kafka01", 9092)
+        conn1 = self.broker_hosts[("kafka01", 9092)]
+        conn1.connect.return_value = concurrent.Future()
+
+        c = cluster.Cluster(["kafka01"], lazy_connections=True)
+        c.brokers = {
+            2: metadata.Broker(broker_id=2, host="kafka01", port=9092),
+        }
+
+        first = c.ensure_connections([2, 5])
+        second = c.ensure_connections([2])
+
+        conn1.connect.return_value.set_result(None)
+
+        yield [first, second]
+
+        conn1.connect.assert_called_once_with()
+        self.assertEqual(c.conns, {2: conn1})
+
+    @testing.gen_test
+    def test_ensure_connections_shares_process_brokers_attempts(self):
+        self.add_broker("kafka01", 9092)
+        conn1 = self.broker_hosts[("kafka01", 9092)]
+        conn1.connect.return_value = concurrent.Future()
+
+        c = cluster.Cluster(["kafka01"])
+
+        processing = c.process_brokers([
+            metadata.Broker(broker_id=2, host="kafka01", port=9092),
+        ])
+        ensuring = c.ensure_connections([2])
+
+        conn1.connect.return_value.set_result(None)
+
+        missing, _ = yield [processing, ensuring]
+
+        self.assertEqual(missing, set())
+        conn1.connect.assert_called_once_with()
+        self.assertEqual(c.conns, {2: conn1})
+
+    @patch("kiel.cluster.time")
+    def test_reap_idle_connections(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        c = cluster.Cluster(["kafka01"], idle_timeout=60000)
+
+        idle = Mock(in_flight=0, queued=0, last_used=900)
+        busy = Mock(in_flight=1, queued=0, last_used=900)
+        recent = Mock(in_flight=0, queued=0, last_used=990)
+
+        c.conns = {1: idle, 2: busy, 3: recent}
+        c.control_conns = {1: idle}
+
+        c.reap_idle_connections()
+
+        self.assertEqual(c.conns, {2: busy, 3: recent})
+        self.assertEqual(c.control_conns, {})
+        self.assertEqual(idle.close.call_count, 2)
+        self.assertEqual(busy.close.called, False)
+
     def test_stop_closes_all_connections(self):
         c = cluster.Cluster(["kafka01", "kafka02"])
 
@@ -256,6 +591,71 @@ class ClusterTests(cases.AsyncTestCase):
 
         conn3.abort.assert_called_once_with()
 
+    @testing.gen_test
+    def test_concurrent_heals_share_one_refresh(self):
+        c = cluster.Cluster(["kafka01"])
+
+        response = concurrent.Future()
+        c.get_metadata = Mock(return_value=response)
+        c.process_brokers = Mock(return_value=self.future_value(set()))
+        c.process_topics = Mock(return_value=set())
+
+        first = c.heal()
+        second = c.heal()
+
+        response.set_result(
+            metadata.MetadataResponse(brokers=[], topics=[])
+        )
+
+        yield [first, second]
+
+        c.get_metadata.assert_called_once_with()
+
+        yield c.heal()
+
+        self.assertEqual(c.get_metadata.call_count, 2)
+
+    @testing.gen_test
+    def test_heal_backs_off_between_retries(self):
+        c = cluster.Cluster(["kafka01"])
+
+        c.get_metadata = Mock(return_value=self.future_value(
+            metadata.MetadataResponse(brokers=[], topics=[])
+        ))
+        c.process_brokers = Mock(return_value=self.future_value(set()))
+        c.process_topics = Mock(side_effect=[
+            set(["test.topic"]), set(["test.topic"]), set()
+        ])
+        c.backoff = Mock(return_value=self.future_value(None))
+
+        yield c.heal()
+
+        self.assertEqual(
+            [call[0] for call in c.backoff.call_args_list], [(0,), (1,)]
+        )
+
+    @patch("kiel.cluster.gen.sleep")
+    @patch("kiel.cluster.random")
+    def test_backoff_is_jittered_and_capped(self, mock_random, sleep):
+        mock_random.uniform.side_effect = lambda low, high: high
+
+        c = cluster.Cluster(
+            ["kafka01"], heal_backoff=100, max_heal_backoff=1000
+        )
+
+        c.backoff(0)
+        c.backoff(3)
+        c.backoff(10)
+
+        self.assertEqual(
+            [call[0] for call in mock_random.uniform.call_args_list],
+            [(0, 100), (0, 800), (0, 1000)]
+        )
+        self.assertEqual(
+            [call[0] for call in sleep.call_args_list],
+            [(0.1,), (0.8,), (1.0,)]
+        )
+
     @testing.gen_test
     def test_heal_with_no_working_connections_raises_no_brokers(self):
         c = cluster.Cluster(["kafka01", "kafka02:900"])
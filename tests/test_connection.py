@@ -1,13 +1,17 @@
+import pickle
 import struct
 
 from tests import cases
 
-from tornado import testing
+from tornado import testing, iostream, concurrent, gen
 from mock import patch, Mock
 
-from kiel import exc
-from kiel.protocol import metadata
-from kiel.connection import Connection
+from kiel import constants, exc
+from kiel.protocol import api_versions, metadata, fetch, messages
+from kiel.protocol.buffers import WriteBuffer
+from kiel.connection import (
+    Connection, decode_fetch_response, MAX_SPARE_BUFFER_CAPACITY
+)
 
 
 class ConnectionTests(cases.AsyncTestCase):
@@ -17,7 +21,7 @@ class ConnectionTests(cases.AsyncTestCase):
     def test_connect_sets_stream(self, IOStream):
         IOStream.return_value.connect.return_value = self.future_value(None)
 
-        conn = Connection("localhost", 1234)
+        conn = Connection("localhost", 1234, negotiate_versions=False)
 
         self.assertEqual(conn.stream, None)
 
@@ -28,6 +32,107 @@ class ConnectionTests(cases.AsyncTestCase):
             ("localhost", 1234)
         )
 
+    @patch.object(Connection, "read_loop")
+    @patch.object(Connection, "send")
+    @patch("tornado.iostream.IOStream")
+    @testing.gen_test
+    def test_connect_negotiates_api_versions(self, IOStream, send, read_loop):
+        IOStream.return_value.connect.return_value = self.future_value(None)
+        send.return_value = self.future_value(
+            api_versions.ApiVersionsResponse(
+                error_code=0,
+                api_versions=[
+                    api_versions.ApiVersionRange(
+                        api_key=1, min_version=0, max_version=5
+                    ),
+                    api_versions.ApiVersionRange(
+                        api_key=3, min_version=0, max_version=2
+                    ),
+                    api_versions.ApiVersionRange(
+                        api_key=999, min_version=0, max_version=1
+                    ),
+                ]
+            )
+        )
+
+        conn = Connection("localhost", 1234)
+
+        yield conn.connect()
+
+        request = send.call_args[0][0]
+        self.assertIsInstance(request, api_versions.ApiVersionsRequest)
+        self.assertEqual(
+            conn.api_versions, {"fetch": (0, 5), "metadata": (0, 2)}
+        )
+
+    @patch.object(Connection, "read_loop")
+    @patch.object(Connection, "send")
+    @patch("tornado.iostream.IOStream")
+    @testing.gen_test
+    def test_connect_falls_back_if_negotiation_drops_connection(
+            self, IOStream, send, read_loop
+    ):
+        first_stream, second_stream = Mock(), Mock()
+        first_stream.connect.return_value = self.future_value(None)
+        second_stream.connect.return_value = self.future_value(None)
+        IOStream.side_effect = [first_stream, second_stream]
+        send.return_value = self.future_error(iostream.StreamClosedError())
+
+        conn = Connection("localhost", 1234)
+
+        yield conn.connect()
+
+        self.assertEqual(IOStream.call_count, 2)
+        first_stream.close.assert_called_once_with()
+        self.assertEqual(conn.stream, second_stream)
+        self.assertEqual(conn.closing, False)
+        self.assertEqual(conn.api_versions, {})
+        self.assertEqual(conn.api_version("fetch"), 0)
+
+    @patch.object(Connection, "read_loop")
+    @patch.object(Connection, "send")
+    @patch("tornado.iostream.IOStream")
+    @testing.gen_test
+    def test_connect_fails_if_negotiation_errors(
+            self, IOStream, send, read_loop
+    ):
+        IOStream.return_value.connect.return_value = self.future_value(None)
+        send.return_value = self.future_error(
+            exc.BrokerConnectionError("localhost", 1234)
+        )
+
+        conn = Connection("localhost", 1234)
+
+        with self.assertRaises(exc.BrokerConnectionError):
+            yield conn.connect()
+
+        self.assertEqual(IOStream.call_count, 1)
+        self.assertEqual(conn.closing, True)
+        IOStream.return_value.close.assert_called_once_with()
+
+    def test_api_version_picks_highest_mutual_version(self):
+        conn = Connection("localhost", 1234)
+        conn.api_versions = {
+            "fetch": (0, 10),
+            "produce": (0, 2),
+            "offset": (0, 1),
+            "offset_commit": (3, 5),
+        }
+
+        self.assertEqual(conn.api_version("fetch"), 10)
+        self.assertEqual(conn.api_version("offset"), 0)
+        self.assertEqual(conn.api_version("produce"), 2)
+        self.assertEqual(conn.api_version("metadata"), 0)
+        self.assertEqual(conn.api_version("offset_commit"), 0)
+
+    def test_api_version_capped(self):
+        conn = Connection("localhost", 1234)
+        conn.api_versions = {"produce": (0, 3), "fetch": (4, 10)}
+
+        self.assertEqual(conn.api_version("produce", max_version=2), 2)
+        self.assertEqual(conn.api_version("produce", max_version=10), 3)
+        self.assertEqual(conn.api_version("fetch", max_version=3), 0)
+
     def test_close(self):
         conn = Connection("localhost", 1234)
         conn.stream = Mock()
@@ -77,6 +182,156 @@ class ConnectionTests(cases.AsyncTestCase):
         self.assertEqual(conn.closing, True)
         conn.stream.close.assert_called_once_with()
 
+    @testing.gen_test
+    def test_send_writes_size_prefixed_request(self):
+        request = metadata.MetadataRequest(topics=["example.foo"])
+
+        conn = Connection("localhost", 1234)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        conn.send(request)
+
+        yield gen.moment
+
+        payload = request.serialize()
+        self.assertEqual(
+            conn.stream.write.call_args[0][0].tobytes(),
+            struct.pack("!i", len(payload)) + payload
+        )
+
+    @patch("kiel.connection.time")
+    def test_send_updates_last_used(self, mock_time):
+        mock_time.time.return_value = 1000
+
+        conn = Connection("localhost", 1234)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        mock_time.time.return_value = 1060
+
+        conn.send(metadata.MetadataRequest())
+
+        self.assertEqual(conn.last_used, 1060)
+
+    @testing.gen_test
+    def test_write_buffers_are_reused(self):
+        conn = Connection("localhost", 1234)
+        conn.stream = Mock()
+        pending_write = self.future_value(None)
+        conn.stream.write.return_value = pending_write
+
+        conn.send(metadata.MetadataRequest())
+        yield gen.moment
+
+        self.assertEqual(len(conn.spare_buffers), 1)
+        spare = conn.spare_buffers[0]
+        self.assertEqual(spare.size, 0)
+
+        conn.send(metadata.MetadataRequest())
+        yield gen.moment
+
+        self.assertEqual(conn.spare_buffers, [spare])
+
+    @testing.gen_test
+    def test_sends_in_same_iteration_coalesced(self):
+        request1 = metadata.MetadataRequest()
+        request2 = metadata.MetadataRequest(topics=["example.foo"])
+
+        conn = Connection("localhost", 1234)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        conn.send(request1)
+        conn.send(request2)
+
+        self.assertEqual(conn.stream.write.called, False)
+
+        yield gen.moment
+
+        self.assertEqual(conn.stream.write.call_count, 1)
+        self.assertEqual(
+            conn.stream.write.call_args[0][0].tobytes(),
+            b"".join([
+                struct.pack("!i", len(payload)) + payload
+                for payload in (request1.serialize(), request2.serialize())
+            ])
+        )
+
+    @testing.gen_test
+    def test_coalesced_sends_written_once_past_threshold(self):
+        conn = Connection("localhost", 1234, coalesce_threshold=40)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        conn.send(metadata.MetadataRequest(topics=["example.foo"]))
+
+        self.assertEqual(conn.stream.write.called, False)
+
+        conn.send(metadata.MetadataRequest(topics=["example.foo"]))
+
+        self.assertEqual(conn.stream.write.call_count, 1)
+        self.assertEqual(conn.write_buffer, None)
+
+        yield gen.moment
+
+        self.assertEqual(conn.stream.write.call_count, 1)
+
+    def test_zero_coalesce_threshold_writes_right_away(self):
+        conn = Connection("localhost", 1234, coalesce_threshold=0)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        conn.send(metadata.MetadataRequest())
+        conn.send(metadata.MetadataRequest())
+
+        self.assertEqual(conn.stream.write.call_count, 2)
+
+    @testing.gen_test
+    def test_failed_serialization_leaves_coalesced_requests(self):
+        request = metadata.MetadataRequest(topics=["example.foo"])
+
+        conn = Connection("localhost", 1234)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        conn.send(request)
+
+        def partial_write(out):
+            out.write(b"garbage")
+            raise ValueError("oh no!")
+
+        bad_request = Mock()
+        bad_request.write.side_effect = partial_write
+
+        self.assertRaises(ValueError, conn.send, bad_request)
+
+        yield gen.moment
+
+        payload = request.serialize()
+        self.assertEqual(
+            conn.stream.write.call_args[0][0].tobytes(),
+            struct.pack("!i", len(payload)) + payload
+        )
+
+    @testing.gen_test
+    def test_stream_closed_fails_pending_requests(self):
+        conn = Connection("localhost", 1234)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+        conn.stream.read_bytes.return_value = self.future_error(
+            iostream.StreamClosedError()
+        )
+
+        response = conn.send(metadata.MetadataRequest())
+
+        yield conn.read_loop()
+
+        self.assertEqual(conn.closing, True)
+        self.assertIsInstance(
+            response.exception(), iostream.StreamClosedError
+        )
+
     @testing.gen_test
     def test_immediate_error_writing_to_stream_aborts(self):
 
@@ -170,6 +425,216 @@ class ConnectionTests(cases.AsyncTestCase):
             self.assertEqual(error.host, "localhost")
             self.assertEqual(error.port, 1234)
 
+    @patch.object(Connection, "read_message")
+    @testing.gen_test
+    def test_requests_wait_for_in_flight_slots(self, read_message):
+        request1 = metadata.MetadataRequest()
+        request2 = metadata.MetadataRequest(topics=["example.foo"])
+
+        responses = [
+            Mock(correlation_id=request1.correlation_id),
+            Mock(correlation_id=request2.correlation_id),
+        ]
+
+        conn = Connection("localhost", 1234, max_in_flight=1)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        futures = [conn.send(request1), conn.send(request2)]
+
+        self.assertEqual(conn.in_flight, 1)
+        self.assertEqual(conn.queued, 1)
+        self.assertEqual(list(conn.pending), [request1.correlation_id])
+
+        def get_next_response(*args):
+            return self.future_value(responses.pop(0))
+
+        read_message.side_effect = get_next_response
+
+        yield conn.read_loop()
+
+        self.assertEqual(
+            [future.result().correlation_id for future in futures],
+            [request1.correlation_id, request2.correlation_id]
+        )
+        self.assertEqual(conn.queued, 0)
+
+    def test_abort_fails_waiting_requests(self):
+        conn = Connection("localhost", 1234, max_in_flight=1)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        conn.send(metadata.MetadataRequest())
+        waiting = conn.send(metadata.MetadataRequest())
+
+        conn.abort()
+
+        self.assertIsInstance(waiting.exception(), exc.BrokerConnectionError)
+        self.assertEqual(conn.queued, 0)
+
+    def test_waiting_request_serialization_error(self):
+        conn = Connection("localhost", 1234, max_in_flight=1)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        request = metadata.MetadataRequest()
+        conn.send(request)
+
+        bad_request = Mock()
+        bad_request.write.side_effect = ValueError("oh no!")
+        waiting = conn.send(bad_request)
+
+        conn.pending.pop(request.correlation_id)
+        conn.send_waiting()
+
+        self.assertIsInstance(waiting.exception(), ValueError)
+        self.assertEqual(conn.closing, False)
+
+    @testing.gen_test
+    def test_request_timeout(self):
+        conn = Connection("localhost", 1234, request_timeout=10)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        request = metadata.MetadataRequest()
+        response = conn.send(request)
+
+        with self.assertRaises(exc.RequestTimeoutError) as context:
+            yield response
+
+        self.assertEqual(context.exception.api, "metadata")
+        self.assertEqual(conn.pending, {})
+        self.assertEqual(conn.api_correlation, {})
+        self.assertEqual(conn.timeouts, {})
+        self.assertEqual(conn.closing, False)
+
+    @testing.gen_test
+    def test_request_timeout_recycles_connection(self):
+        conn = Connection(
+            "localhost", 1234, request_timeout=10, recycle_on_timeout=True
+        )
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        with self.assertRaises(exc.RequestTimeoutError):
+            yield conn.send(metadata.MetadataRequest())
+
+        self.assertEqual(conn.closing, True)
+
+    def test_timeout_includes_requested_wait_time(self):
+        conn = Connection("localhost", 1234, request_timeout=1000)
+        conn.stream = Mock()
+
+        request = fetch.FetchRequest(
+            replica_id=-1, max_wait_time=500, min_bytes=1, topics=[]
+        )
+
+        with patch("kiel.connection.ioloop.IOLoop.current") as current:
+            conn.send(request)
+
+        current.return_value.call_later.assert_called_once_with(
+            1.5, conn.time_out, request.correlation_id
+        )
+
+    def test_no_timeout(self):
+        conn = Connection("localhost", 1234, request_timeout=None)
+        conn.stream = Mock()
+
+        conn.send(metadata.MetadataRequest())
+
+        self.assertEqual(conn.timeouts, {})
+
+    @patch.object(Connection, "read_message")
+    @testing.gen_test
+    def test_response_cancels_timeout(self, read_message):
+        request = metadata.MetadataRequest()
+        responses = [Mock(correlation_id=request.correlation_id)]
+
+        def get_next_response(*args):
+            return self.future_value(responses.pop(0))
+
+        read_message.side_effect = get_next_response
+
+        conn = Connection("localhost", 1234, request_timeout=10)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        response = conn.send(request)
+
+        yield conn.read_loop()
+
+        self.assertEqual(conn.timeouts, {})
+        self.assertEqual(
+            response.result().correlation_id, request.correlation_id
+        )
+
+    @testing.gen_test
+    def test_late_response_discarded(self):
+        raw_response = self.metadata_payload("broker01")
+
+        conn = Connection("localhost", 1234)
+        conn.stream = Mock()
+        conn.stream.read_bytes.side_effect = [
+            self.future_value(struct.pack("!ii", len(raw_response) + 4, 555)),
+            self.future_value(raw_response),
+        ]
+
+        message = yield conn.read_message()
+
+        self.assertEqual(message, None)
+        conn.stream.read_bytes.assert_called_with(len(raw_response))
+
+    @testing.gen_test
+    def test_timeout_while_reading_response(self):
+        raw_response = self.metadata_payload("broker01")
+
+        conn = Connection("localhost", 1234, request_timeout=10)
+        conn.stream = Mock()
+        conn.stream.write.return_value = self.future_value(None)
+
+        request = metadata.MetadataRequest()
+        response = conn.send(request)
+
+        header = struct.pack(
+            "!ii", len(raw_response) + 4, request.correlation_id
+        )
+        conn.stream.read_bytes.side_effect = [
+            self.future_value(header),
+            self.future_error(iostream.StreamClosedError()),
+        ]
+        payload = concurrent.Future()
+
+        def read_into(buff):
+            buff[:] = raw_response
+            return payload
+
+        conn.stream.read_into.side_effect = read_into
+
+        reading = conn.read_loop()
+
+        with self.assertRaises(exc.RequestTimeoutError):
+            yield response
+
+        payload.set_result(len(raw_response))
+        yield reading
+
+        # the late response was dropped, the loop went on to the next one
+        self.assertEqual(conn.stream.read_bytes.call_count, 2)
+        self.assertEqual(conn.pending, {})
+        self.assertEqual(conn.api_correlation, {})
+
+    def mock_stream(self, conn, raw_response):
+        conn.stream = Mock()
+        conn.stream.read_bytes.return_value = self.future_value(
+            struct.pack("!ii", len(raw_response) + 4, 555)
+        )
+
+        def read_into(buff):
+            buff[:] = raw_response
+            return self.future_value(len(raw_response))
+
+        conn.stream.read_into.side_effect = read_into
+
     @testing.gen_test
     def test_read_message(self):
         response_format = "".join([
@@ -192,21 +657,10 @@ class ConnectionTests(cases.AsyncTestCase):
             2, 1, 2, 2, 2, 1,  # two replicas: on 1 & 2, both are in ISR set
         )
 
-        raw_data = [
-            # size of full response (incl. correlation)
-            struct.pack("!i", struct.calcsize(response_format) + 4),
-            struct.pack("!i", 555),  # correlation id
-            raw_response
-        ]
-
-        def get_raw_data(*args):
-            return self.future_value(raw_data.pop(0))
-
         conn = Connection("localhost", 1234)
-        conn.api_correlation = {555: "metadata"}
+        conn.api_correlation = {555: ("metadata", 0)}
 
-        conn.stream = Mock()
-        conn.stream.read_bytes.side_effect = get_raw_data
+        self.mock_stream(conn, raw_response)
 
         message = yield conn.read_message()
 
@@ -238,3 +692,283 @@ class ConnectionTests(cases.AsyncTestCase):
         )
 
         self.assertEqual(message, expected)
+
+    @testing.gen_test
+    def test_read_message_zero_copy_fetch(self):
+        response = fetch.FetchResponse(
+            topics=[
+                fetch.TopicResponse(
+                    name="example.foo",
+                    partitions=[
+                        fetch.PartitionResponse(
+                            partition_id=0,
+                            error_code=0,
+                            highwater_mark_offset=2,
+                            message_set=messages.MessageSet([
+                                (0, messages.Message(
+                                    crc=0, magic=0, attributes=0,
+                                    key=None, value=b'{"foo": "bar"}'
+                                )),
+                            ])
+                        ),
+                    ]
+                ),
+            ]
+        )
+        out = WriteBuffer()
+        response.encode(out)
+        raw_response = out.getvalue()
+
+        conn = Connection("localhost", 1234, zero_copy=True)
+        conn.api_correlation = {555: ("fetch", 0)}
+
+        self.mock_stream(conn, raw_response)
+
+        message = yield conn.read_message()
+
+        partition = message.topics[0].partitions[0]
+        _, msg = partition.message_set.messages[0]
+
+        self.assertEqual(message.topics[0].name, "example.foo")
+        self.assertIsInstance(msg.value, memoryview)
+        self.assertEqual(msg.value.tobytes(), b'{"foo": "bar"}')
+
+    @testing.gen_test
+    def test_read_message_uses_versioned_response_class(self):
+        response = fetch.FetchV4Response(
+            throttle_time=0,
+            topics=[
+                fetch.TopicV4Response(
+                    name="example.foo",
+                    partitions=[
+                        fetch.PartitionV4Response(
+                            partition_id=0,
+                            error_code=0,
+                            highwater_mark_offset=3,
+                            last_stable_offset=3,
+                            aborted_transactions=None,
+                            message_set=messages.MessageSet([]),
+                        ),
+                    ]
+                ),
+            ]
+        )
+        out = WriteBuffer()
+        response.encode(out)
+        raw_response = out.getvalue()
+
+        conn = Connection("localhost", 1234)
+        conn.api_correlation = {555: ("fetch", 4)}
+
+        self.mock_stream(conn, raw_response)
+
+        message = yield conn.read_message()
+
+        self.assertIsInstance(message, fetch.FetchV4Response)
+        partition = message.topics[0].partitions[0]
+        self.assertEqual(partition.last_stable_offset, 3)
+        self.assertEqual(partition.aborted_transactions, [])
+
+    def metadata_payload(self, host):
+        response = metadata.MetadataResponse(
+            brokers=[
+                metadata.Broker(broker_id=8, host=host, port=1234)
+            ],
+            topics=[],
+        )
+        out = WriteBuffer()
+        response.encode(out)
+
+        return out.getvalue()
+
+    @testing.gen_test
+    def test_receive_buffer_reused_for_responses(self):
+        conn = Connection("localhost", 1234)
+
+        conn.api_correlation = {555: ("metadata", 0)}
+        self.mock_stream(conn, self.metadata_payload("broker01.example"))
+
+        first = yield conn.read_message()
+        receive_buffer = conn.receive_buffer
+
+        conn.api_correlation = {555: ("metadata", 0)}
+        self.mock_stream(conn, self.metadata_payload("broker02"))
+
+        second = yield conn.read_message()
+
+        self.assertIs(conn.receive_buffer, receive_buffer)
+        self.assertEqual(first.brokers[0].host, "broker01.example")
+        self.assertEqual(second.brokers[0].host, "broker02")
+
+    def test_receive_buffer_grows_as_needed(self):
+        conn = Connection("localhost", 1234)
+
+        self.assertEqual(len(conn.receive_payload_buffer(100)), 100)
+        self.assertEqual(len(conn.receive_payload_buffer(10)), 100)
+        self.assertEqual(len(conn.receive_payload_buffer(150)), 200)
+
+        huge = conn.receive_payload_buffer(MAX_SPARE_BUFFER_CAPACITY + 1)
+
+        self.assertIsNot(huge, conn.receive_buffer)
+        self.assertEqual(len(conn.receive_buffer), 200)
+
+    @testing.gen_test
+    def test_zero_copy_fetch_values_not_in_receive_buffer(self):
+        response = fetch.FetchResponse(
+            topics=[
+                fetch.TopicResponse(
+                    name="example.foo",
+                    partitions=[
+                        fetch.PartitionResponse(
+                            partition_id=0,
+                            error_code=0,
+                            highwater_mark_offset=2,
+                            message_set=messages.MessageSet([
+                                (0, messages.Message(
+                                    crc=0, magic=0, attributes=0,
+                                    key=None, value=b"bar"
+                                )),
+                            ])
+                        ),
+                    ]
+                ),
+            ]
+        )
+        out = WriteBuffer()
+        response.encode(out)
+
+        conn = Connection("localhost", 1234, zero_copy=True)
+        conn.api_correlation = {555: ("fetch", 0)}
+        self.mock_stream(conn, out.getvalue())
+
+        message = yield conn.read_message()
+
+        conn.api_correlation = {555: ("metadata", 0)}
+        self.mock_stream(conn, self.metadata_payload("x" * 100))
+
+        yield conn.read_message()
+
+        _, msg = message.topics[0].partitions[0].message_set.messages[0]
+
+        self.assertEqual(msg.value.tobytes(), b"bar")
+
+    @testing.gen_test
+    def test_read_message_without_read_into(self):
+        raw_response = self.metadata_payload("broker01")
+        raw_data = [
+            struct.pack("!ii", len(raw_response) + 4, 555),
+            raw_response,
+        ]
+
+        def get_raw_data(*args):
+            return self.future_value(raw_data.pop(0))
+
+        conn = Connection("localhost", 1234)
+        conn.api_correlation = {555: ("metadata", 0)}
+        conn.stream = Mock(spec=["read_bytes"])
+        conn.stream.read_bytes.side_effect = get_raw_data
+
+        message = yield conn.read_message()
+
+        self.assertEqual(message.brokers[0].host, "broker01")
+        self.assertEqual(message.correlation_id, 555)
+
+    def gzipped_fetch_payload(self):
+        response = fetch.FetchResponse(
+            topics=[
+                fetch.TopicResponse(
+                    name="example.foo",
+                    partitions=[
+                        fetch.PartitionResponse(
+                            partition_id=0,
+                            error_code=0,
+                            highwater_mark_offset=2,
+                            message_set=messages.MessageSet.compressed(
+                                constants.GZIP, [
+                                    messages.Message(
+                                        magic=0, attributes=0,
+                                        key=None, value='{"foo": "bar"}'
+                                    ),
+                                ]
+                            )
+                        ),
+                    ]
+                ),
+            ]
+        )
+        out = WriteBuffer()
+        response.encode(out)
+
+        return out.getvalue()
+
+    def mock_read_fetch(self, conn, raw_response):
+        conn.api_correlation = {555: ("fetch", 0)}
+        self.mock_stream(conn, raw_response)
+
+    def mock_executor(self):
+        executor = Mock()
+
+        def submit(fn, *args):
+            future = concurrent.Future()
+            future.set_result(fn(*args))
+            return future
+
+        executor.submit.side_effect = submit
+
+        return executor
+
+    @testing.gen_test
+    def test_large_fetch_decoded_in_executor(self):
+        raw_response = self.gzipped_fetch_payload()
+        executor = self.mock_executor()
+
+        conn = Connection(
+            "localhost", 1234,
+            decode_executor=executor, decode_threshold=len(raw_response)
+        )
+        self.mock_read_fetch(conn, raw_response)
+
+        message = yield conn.read_message()
+
+        executor.submit.assert_called_once_with(
+            decode_fetch_response, fetch.FetchResponse, raw_response, False
+        )
+        self.assertEqual(message.correlation_id, 555)
+
+        message_set = message.topics[0].partitions[0].message_set
+        self.assertEqual(message_set.raw, None)
+        self.assertEqual(
+            [(offset, msg.value) for offset, msg in message_set.parsed],
+            [(-1, '{"foo": "bar"}')]
+        )
+
+    @testing.gen_test
+    def test_small_fetch_decoded_inline(self):
+        raw_response = self.gzipped_fetch_payload()
+        executor = self.mock_executor()
+
+        conn = Connection(
+            "localhost", 1234,
+            decode_executor=executor, decode_threshold=len(raw_response) + 1
+        )
+        self.mock_read_fetch(conn, raw_response)
+
+        message = yield conn.read_message()
+
+        self.assertEqual(executor.submit.called, False)
+
+        message_set = message.topics[0].partitions[0].message_set
+        self.assertEqual(message_set.parsed, None)
+
+    def test_decoded_fetch_response_can_be_pickled(self):
+        response = decode_fetch_response(
+            fetch.FetchResponse, self.gzipped_fetch_payload()
+        )
+
+        unpickled = pickle.loads(pickle.dumps(response, 2))
+
+        message_set = unpickled.topics[0].partitions[0].message_set
+        self.assertEqual(
+            [(offset, msg.value) for offset, msg in message_set],
+            [(-1, '{"foo": "bar"}')]
+        )
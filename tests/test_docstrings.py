@@ -9,11 +9,18 @@ import kiel.clients.single
 import kiel.cluster
 import kiel.compression.gzip
 import kiel.compression.snappy
+import kiel.compression.lz4
+import kiel.compression.zstd
+import kiel.compression.dictionary
 import kiel.connection
 import kiel.constants
 import kiel.events
 import kiel.exc
 import kiel.iterables
+import kiel.pool
+import kiel.protocol.buffers
+import kiel.protocol.api_versions
+import kiel.protocol.codec
 import kiel.protocol.coordinator
 import kiel.protocol.describe_groups
 import kiel.protocol.fetch
@@ -28,6 +35,7 @@ import kiel.protocol.offset_fetch
 import kiel.protocol.part
 import kiel.protocol.primitives
 import kiel.protocol.produce
+import kiel.protocol.records
 import kiel.protocol.request
 import kiel.protocol.response
 import kiel.protocol.sync_group
@@ -45,11 +53,18 @@ modules_to_test = (
     kiel.cluster,
     kiel.compression.gzip,
     kiel.compression.snappy,
+    kiel.compression.lz4,
+    kiel.compression.zstd,
+    kiel.compression.dictionary,
     kiel.connection,
     kiel.constants,
     kiel.events,
     kiel.exc,
     kiel.iterables,
+    kiel.pool,
+    kiel.protocol.buffers,
+    kiel.protocol.api_versions,
+    kiel.protocol.codec,
     kiel.protocol.coordinator,
     kiel.protocol.describe_groups,
     kiel.protocol.fetch,
@@ -64,6 +79,7 @@ modules_to_test = (
     kiel.protocol.part,
     kiel.protocol.primitives,
     kiel.protocol.produce,
+    kiel.protocol.records,
     kiel.protocol.request,
     kiel.protocol.response,
     kiel.protocol.sync_group,
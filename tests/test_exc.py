@@ -22,6 +22,16 @@ class ExceptionTests(unittest.TestCase):
 
         self.assertEqual(str(e), "Error connecting to kafka01:4455")
 
+    def test_request_timeout_error(self):
+        e = exc.RequestTimeoutError("kafka01", 4455, "fetch")
+
+        self.assertIsInstance(e, exc.BrokerConnectionError)
+        self.assertEqual(e.api, "fetch")
+
+        self.assertEqual(
+            str(e), "Timed out waiting on fetch response from kafka01:4455"
+        )
+
     def test_unhanded_response_error(self):
         e = exc.UnhandledResponseError("offset")
 
@@ -0,0 +1,166 @@
+from tests import cases
+
+from tornado import testing
+from mock import patch, Mock
+
+from kiel import exc, pool
+
+
+class ConnectionPoolTests(cases.AsyncTestCase):
+
+    def setUp(self):
+        super(ConnectionPoolTests, self).setUp()
+
+        connection_patcher = patch.object(pool, "Connection")
+        self.Connection = connection_patcher.start()
+        self.addCleanup(connection_patcher.stop)
+
+        def make_connection(host, port, **kwargs):
+            conn = Mock(host=host, port=port, closing=False)
+            conn.in_flight = 0
+            conn.queued = 0
+            conn.connect.return_value = self.future_value(None)
+            return conn
+
+        self.Connection.side_effect = make_connection
+
+    def test_connections_created_with_options(self):
+        p = pool.ConnectionPool("kafka01", 9092, 3, zero_copy=True)
+
+        self.assertEqual(len(p.connections), 3)
+        self.Connection.assert_called_with("kafka01", 9092, zero_copy=True)
+
+    def test_invalid_policy(self):
+        self.assertRaises(
+            ValueError,
+            pool.ConnectionPool, "kafka01", 9092, 2, policy="random"
+        )
+
+    @testing.gen_test
+    def test_connect_connects_all(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2)
+
+        yield p.connect()
+
+        for conn in p.connections:
+            conn.connect.assert_called_once_with()
+
+    @testing.gen_test
+    def test_connect_failure_aborts_all(self):
+        p = pool.ConnectionPool("kafka01", 9092, 3)
+        p.connections[1].connect.return_value = self.future_error(
+            exc.BrokerConnectionError("kafka01", 9092)
+        )
+
+        with self.assertRaises(exc.BrokerConnectionError):
+            yield p.connect()
+
+        for conn in p.connections:
+            conn.abort.assert_called_once_with()
+
+    def test_round_robin(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2, policy=pool.ROUND_ROBIN)
+        conn1, conn2 = p.connections
+
+        for _ in range(3):
+            p.send(Mock())
+
+        self.assertEqual(conn1.send.call_count, 2)
+        self.assertEqual(conn2.send.call_count, 1)
+
+    def test_least_loaded(self):
+        p = pool.ConnectionPool("kafka01", 9092, 3)
+        conn1, conn2, conn3 = p.connections
+        conn1.in_flight = 2
+        conn2.in_flight = 1
+        conn2.queued = 2
+        conn3.in_flight = 2
+
+        request = Mock()
+        response = p.send(request)
+
+        conn1.send.assert_called_once_with(request)
+        self.assertEqual(response, conn1.send.return_value)
+
+    def test_round_robin_skips_closing_connections(self):
+        p = pool.ConnectionPool("kafka01", 9092, 3, policy=pool.ROUND_ROBIN)
+        conn1, conn2, conn3 = p.connections
+        conn2.closing = True
+
+        for _ in range(4):
+            p.send(Mock())
+
+        self.assertEqual(conn1.send.call_count, 2)
+        self.assertEqual(conn2.send.call_count, 0)
+        self.assertEqual(conn3.send.call_count, 2)
+
+    def test_least_loaded_skips_closing_connections(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2)
+        conn1, conn2 = p.connections
+        conn1.closing = True
+        conn2.in_flight = 3
+
+        request = Mock()
+        p.send(request)
+
+        self.assertEqual(conn1.send.called, False)
+        conn2.send.assert_called_once_with(request)
+
+    def test_send_fails_if_all_connections_closing(self):
+        for policy in pool.POLICIES:
+            p = pool.ConnectionPool("kafka01", 9092, 2, policy=policy)
+            for conn in p.connections:
+                conn.closing = True
+
+            response = p.send(Mock())
+
+            self.assertIsInstance(
+                response.exception(), exc.BrokerConnectionError
+            )
+            for conn in p.connections:
+                self.assertEqual(conn.send.called, False)
+
+    def test_load_totals(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2)
+        conn1, conn2 = p.connections
+        conn1.in_flight = 2
+        conn2.in_flight = 1
+        conn2.queued = 4
+
+        self.assertEqual(p.in_flight, 3)
+        self.assertEqual(p.queued, 4)
+
+    def test_last_used_is_latest_of_connections(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2)
+        conn1, conn2 = p.connections
+        conn1.last_used = 1000
+        conn2.last_used = 1200
+
+        self.assertEqual(p.last_used, 1200)
+
+    def test_closing_if_any_connection_is(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2)
+
+        self.assertEqual(p.closing, False)
+
+        p.connections[1].closing = True
+
+        self.assertEqual(p.closing, True)
+
+    def test_api_versions_from_first_connection(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2)
+        p.connections[0].api_version.return_value = 7
+
+        self.assertEqual(p.api_version("fetch"), 7)
+        p.connections[0].api_version.assert_called_once_with("fetch", None)
+        self.assertEqual(p.api_versions, p.connections[0].api_versions)
+
+    def test_close_and_abort(self):
+        p = pool.ConnectionPool("kafka01", 9092, 2)
+
+        p.close()
+        p.abort()
+
+        for conn in p.connections:
+            conn.close.assert_called_once_with()
+            conn.abort.assert_called_once_with()